@@ -0,0 +1,114 @@
+""" A local server that answers the Ollama chat API with canned responses after a fixed delay.
+    It lets OLLAMA_SCRIPT be benchmarked without a GPU, the delay stands in for the time the LLM takes.
+"""
+import json
+import time
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# The lines of the script the detailer looks for.
+DETAIL_PATTERNS = ["VISUAL: ", "HOST: ", "MUSIC: "]
+
+
+def fake_script(scenes:int) -> str:
+    """ A script in the format of the script system prompt.
+        Args:
+            scenes (int): The number of scenes, every scene has a visual, a dialogue and a music line.
+        Returns:
+            str: The script.
+    """
+    lines = []
+    for scene in range(1, scenes + 1):
+        lines.append(f"SCENE {scene}")
+        lines.append(f"VISUAL: A wide shot of a flat earth seen from space, scene {scene}.")
+        lines.append(f"HOST: This is what the horizon would look like in scene {scene}, if the earth was flat.")
+        lines.append(f"MUSIC: Slow ambient pads with a soft piano melody, part {scene}.")
+        lines.append("")
+    return "\n".join(lines)
+
+
+class FAKE_OLLAMA:
+    """ Serves /api/chat like Ollama. The script prompt gets a script back, a line of the script gets one detailed line.
+    """
+    def __init__(self, latency:float=0.05, scenes:int=4, host:str="127.0.0.1", port:int=0):
+        """ Initialize the server, it starts answering after start.
+            Args:
+                latency (float): Seconds every response takes.
+                scenes (int): The number of scenes in the script.
+                host (str): The address to listen on.
+                port (int): The port to listen on, 0 picks a free one.
+        """
+        self.latency = latency
+        self.scenes = scenes
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        """ The address to set as OLLAMA_HOST.
+        """
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def respond(self, messages:list) -> str:
+        """ Picks the response for the chat messages.
+        """
+        prompt = messages[-1]["content"]
+        if any(f" : {pattern}" in prompt for pattern in DETAIL_PATTERNS):
+            return f"A detailed description of {prompt.split(' : ', 1)[1]}"
+        return fake_script(self.scenes)
+
+    def make_handler(self):
+        """ Creates the HTTP handler.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if self.path != "/api/chat":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                with fake.lock:
+                    fake.requests += 1
+                time.sleep(fake.latency)
+
+                content = fake.respond(body["messages"])
+                # Words stand in for the tokens.
+                data = json.dumps({"model": body["model"],
+                                   "created_at": datetime.now(timezone.utc).isoformat(),
+                                   "message": {"role": "assistant", "content": content},
+                                   "done": True,
+                                   "done_reason": "stop",
+                                   "prompt_eval_count": sum(len(message["content"].split()) for message in body["messages"]),
+                                   "eval_count": len(content.split())}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self) -> str:
+        """ Starts answering on a background thread.
+            Returns:
+                str: The address to set as OLLAMA_HOST.
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        """ Stops the server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
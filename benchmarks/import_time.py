@@ -0,0 +1,94 @@
+""" Measures how long gen_ai takes to start for the paths that don't need the models, in a new interpreter every time.
+    It fails when a path takes longer than its budget or loads one of the heavy packages, so an eager import that
+    comes back (like torch at the top of a shared module) is caught.
+
+    Run it from the root of the repo:
+        python -m benchmarks.import_time
+        python -m benchmarks.import_time --repeat 5 --budget 0.5
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The packages the paths below shouldn't load, they take seconds together.
+HEAVY = ["torch", "torchao", "diffusers", "transformers", "TTS", "scipy", "soundfile"]
+
+# The paths that should start fast, as the arguments after the python executable.
+PATHS = {"package": ["-c", "import gen_ai"],
+         "script": ["-c", "from gen_ai import OLLAMA_SCRIPT"],
+         "utilities": ["-c", "from gen_ai import INIT_PROJECT, BACKGROUND_SAVER, MODEL_REGISTRY, TELEMETRY"],
+         "worker_help": ["-m", "gen_ai.worker", "--help"],
+         "benchmarks_help": ["-m", "benchmarks.run_benchmarks", "--help"]}
+
+
+def parse_importtime(stderr:str) -> dict:
+    """ Reads the output of python -X importtime.
+        Returns:
+            dict: The top level packages that were imported mapped to their cumulative seconds.
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # The nested imports are indented after the space that follows the bar, only the ones at the top are counted
+        # so the time of a package isn't added more than once.
+        name = name.rstrip()[1:]
+        if name and not name.startswith(" "):
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + int(cumulative) / 1e6
+    return packages
+
+
+def measure(arguments:list) -> dict:
+    """ Runs a path in a new interpreter.
+        Args:
+            arguments (list): The arguments after the python executable.
+        Returns:
+            dict: The seconds the import statements took and the heavy packages that were imported.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", *arguments], capture_output=True, text=True, cwd=ROOT)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(arguments)} failed:\n{result.stderr[-2000:]}")
+
+    packages = parse_importtime(result.stderr)
+    return {"seconds": sum(packages.values()),
+            "heavy": sorted(package for package in packages if package in HEAVY)}
+
+
+def run(paths:list, repeat:int) -> dict:
+    """ Measures every path repeat times.
+        Returns:
+            dict: The median seconds and the heavy packages of every path.
+    """
+    results = {}
+    for path in paths:
+        runs = [measure(PATHS[path]) for _ in range(repeat)]
+        results[path] = {"seconds": statistics.median(run["seconds"] for run in runs),
+                         "heavy": runs[0]["heavy"]}
+    return results
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Measures the start up time of gen_ai without the models.")
+    parser.add_argument("--paths", nargs="+", default=list(PATHS), choices=list(PATHS), help="The paths to measure.")
+    parser.add_argument("--repeat", type=int, default=3, help="The runs of every path, the median is reported.")
+    parser.add_argument("--budget", type=float, default=1.0, help="The seconds a path can take.")
+    parser.add_argument("--json", action="store_true", help="Print the results as json.")
+    args = parser.parse_args()
+
+    results = run(args.paths, args.repeat)
+    failed = [path for path, result in results.items() if result["seconds"] > args.budget or result["heavy"]]
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        for path, result in results.items():
+            print(f"{path:<16} {result['seconds']:>8.3f}s  {', '.join(result['heavy']) or '-'}"
+                  f"{'  FAILED' if path in failed else ''}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,467 @@
+""" Benchmarks every generator class and the flow of simple_pipeline.py on a CPU.
+    The models are the tiny stand-ins of stub_models.py and Ollama is replaced by fake_ollama.py, so the numbers measure
+    the code around the models (batching, saving, the manifest, the script detailer) and not the models themselves.
+
+    Run it from the root of the repo:
+        python -m benchmarks.run_benchmarks
+        python -m benchmarks.run_benchmarks --stages script sdxl --items 8 --repeat 3
+        python -m benchmarks.run_benchmarks --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+from .fake_ollama import FAKE_OLLAMA
+
+
+STAGES = ["script", "music", "music_batch", "music_long", "speech", "speech_deduped", "speech_stream", "sdxl", "sana", "ltx", "wan", "pipeline"]
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+IDEA = "What if the earth was flat?"
+
+
+def make_prompts(count:int) -> list:
+    """ Prompts for the media stages, they are all different so nothing is reused.
+    """
+    return [f"A wide shot of a flat earth seen from space with the sun rising over the edge, take {i}." for i in range(count)]
+
+
+class RSS_SAMPLER:
+    """ Samples the resident memory of the process while a stage runs and keeps the peak.
+        The peak of the whole process is only used where the current memory can't be read.
+    """
+    def __init__(self, interval:float=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    @staticmethod
+    def rss() -> int:
+        """ Gets the resident memory in bytes.
+        """
+        from gen_ai.telemetry import cpu_memory
+
+        memory = cpu_memory()
+        return memory.get("rss", memory.get("rss_peak", 0))
+
+    def sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.rss())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.rss()
+        self.peak = self.start
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+class IO_TIMER:
+    """ Times every call of file_saver, wherever the generators call it from (their thread or a BACKGROUND_SAVER thread).
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self.lock = threading.Lock()
+
+    def wrap(self, file_saver):
+        def timed_file_saver(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return file_saver(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds += time.perf_counter() - start
+                    self.files += 1
+        return timed_file_saver
+
+    def __enter__(self):
+        import gen_ai.script
+        import gen_ai.background_saver
+
+        # The generators save through these two names.
+        self.modules = [gen_ai.script, gen_ai.background_saver]
+        self.originals = [module.file_saver for module in self.modules]
+        for module, original in zip(self.modules, self.originals):
+            module.file_saver = self.wrap(original)
+        return self
+
+    def __exit__(self, *exc):
+        for module, original in zip(self.modules, self.originals):
+            module.file_saver = original
+
+
+def make_speech(output_folder:str, registry, saver=None):
+    """ Creates XTTSv2_SPEECH without reading models/XTTS-v2/config.json, the stub model doesn't need the config.
+        The voice is a random recording in a voices folder next to the projects, so the repeats reuse its latents.
+    """
+    import numpy as np
+    from scipy.io import wavfile
+    from gen_ai import XTTSv2_SPEECH
+    from gen_ai.voice_library import get_voice_library
+    from .stub_models import stub_xtts_config
+
+    voices_folder = os.path.join(os.path.dirname(output_folder), "voices")
+    os.makedirs(voices_folder, exist_ok=True)
+    if not os.path.exists(os.path.join(voices_folder, "narrator.wav")):
+        wavfile.write(os.path.join(voices_folder, "narrator.wav"), 22050,
+                      np.random.default_rng(0).uniform(-1, 1, 22050 * 6).astype(np.float32))
+
+    speech = XTTSv2_SPEECH.__new__(XTTSv2_SPEECH)
+    speech.output_folder = output_folder
+    speech.voice = "narrator"
+    speech.voices = get_voice_library(voices_folder)
+    speech.config = stub_xtts_config()
+    speech.registry = registry
+    speech.saver = saver
+    return speech
+
+
+def run_script(output_folder:str, registry, args) -> int:
+    from gen_ai import OLLAMA_SCRIPT
+
+    # The cache would answer every request after the first run.
+    obj = OLLAMA_SCRIPT(output_folder, num_parallel=args.num_parallel, use_cache=False)
+    obj.generate_script(IDEA)
+    obj.script_detailer()
+
+    # The script and one detailed line per visual (image and video), dialogue and music line.
+    return 1 + args.scenes * 4
+
+
+def run_music(output_folder:str, registry, args) -> int:
+    from gen_ai import GEN_MUSIC
+
+    obj = GEN_MUSIC(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    for index, prompt in enumerate(prompts):
+        obj.generate_music(prompt, index=index)
+    return len(prompts)
+
+
+def run_music_batch(output_folder:str, registry, args) -> int:
+    from gen_ai import GEN_MUSIC
+
+    obj = GEN_MUSIC(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    obj.generate_music_batch(prompts, batch_size=args.batch_size, indexes=list(range(len(prompts))))
+    return len(prompts)
+
+
+def run_music_long(output_folder:str, registry, args) -> int:
+    """ Generates 5 minutes of music per prompt in 30 second windows, the RSS shows if the memory grows with the length.
+    """
+    from gen_ai import GEN_MUSIC
+
+    obj = GEN_MUSIC(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    for index, prompt in enumerate(prompts):
+        obj.generate_long_music(prompt, duration=300, index=index)
+    return len(prompts)
+
+
+def run_speech(output_folder:str, registry, args) -> int:
+    obj = make_speech(output_folder, registry)
+    prompts = make_prompts(args.items)
+    for index, prompt in enumerate(prompts):
+        obj.generate_speech(prompt, index=index)
+    return len(prompts)
+
+
+def run_speech_deduped(output_folder:str, registry, args) -> int:
+    obj = make_speech(output_folder, registry)
+    prompts = make_prompts(args.items)
+    obj.generate_speech_deduped(prompts, indexes=list(range(len(prompts))))
+    return len(prompts)
+
+
+def run_speech_stream(output_folder:str, registry, args) -> int:
+    """ Streams the speech, the telemetry has the time to the first chunk of every line.
+    """
+    obj = make_speech(output_folder, registry)
+    prompts = make_prompts(args.items)
+    for index, prompt in enumerate(prompts):
+        obj.generate_speech(prompt, index=index, stream=True)
+    return len(prompts)
+
+
+def run_sdxl(output_folder:str, registry, args) -> int:
+    from gen_ai import SDXL_IMAGE
+
+    obj = SDXL_IMAGE(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    obj.generate_images(prompts, batch_size=args.batch_size, indexes=list(range(len(prompts))))
+    return len(prompts)
+
+
+def run_sana(output_folder:str, registry, args) -> int:
+    from gen_ai import SANA_IMAGE
+
+    obj = SANA_IMAGE(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    # Every other prompt is seeded, the batches mix both like a chunk of RUN_SHARDED with some of the seeds.
+    seeds = [i if i % 2 else None for i in range(len(prompts))]
+    obj.generate_images(prompts, img_size=[64, 64], seeds=seeds, batch_size=args.batch_size, indexes=list(range(len(prompts))))
+    return len(prompts)
+
+
+def run_ltx(output_folder:str, registry, args) -> int:
+    from gen_ai import LTX_VIDEO
+
+    obj = LTX_VIDEO(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    for index, prompt in enumerate(prompts):
+        obj.generate_video(prompt, index=index)
+    return len(prompts)
+
+
+def run_wan(output_folder:str, registry, args) -> int:
+    from gen_ai import WAN_VIDEO
+
+    obj = WAN_VIDEO(output_folder, registry=registry)
+    prompts = make_prompts(args.items)
+    for index, prompt in enumerate(prompts):
+        obj.generate_video(prompt, index=index)
+    return len(prompts)
+
+
+def run_pipeline(output_folder:str, registry, args) -> int:
+    """ The flow of simple_pipeline.py: script, music, speech, SDXL images and LTX videos saved in the background.
+    """
+    from gen_ai import OLLAMA_SCRIPT, GEN_MUSIC, SDXL_IMAGE, LTX_VIDEO, BACKGROUND_SAVER
+
+    def read_lines(path):
+        with open(path, 'r', encoding="utf-8") as f:
+            return [line.rstrip("\n") for line in f.readlines()]
+
+    obj = OLLAMA_SCRIPT(output_folder, num_parallel=args.num_parallel, use_cache=False)
+    obj.generate_script(IDEA)
+    generated_files = obj.script_detailer()
+    items = 1 + args.scenes * 4
+
+    obj = GEN_MUSIC(output_folder, registry=registry)
+    lines = read_lines(generated_files["music"])
+    obj.generate_music_batch(lines, batch_size=8, indexes=list(range(len(lines))))
+
+    obj = make_speech(output_folder, registry)
+    lines = read_lines(generated_files["dialogue"])
+    obj.generate_speech_deduped(lines, indexes=list(range(len(lines))))
+
+    obj = SDXL_IMAGE(output_folder, registry=registry)
+    lines = read_lines(generated_files["image"])
+    obj.generate_images(lines, batch_size=2, indexes=list(range(len(lines))))
+
+    saver = BACKGROUND_SAVER(max_pending=2)
+    obj = LTX_VIDEO(output_folder, registry=registry, saver=saver)
+    for index, line in enumerate(read_lines(generated_files["video"])):
+        obj.generate_video(line, index=index)
+    saver.close()
+
+    return items + args.scenes * 4
+
+
+RUNNERS = {"script": run_script,
+           "music": run_music,
+           "music_batch": run_music_batch,
+           "music_long": run_music_long,
+           "speech": run_speech,
+           "speech_deduped": run_speech_deduped,
+           "speech_stream": run_speech_stream,
+           "sdxl": run_sdxl,
+           "sana": run_sana,
+           "ltx": run_ltx,
+           "wan": run_wan,
+           "pipeline": run_pipeline}
+
+
+def run_stage(stage:str, args, root:str) -> dict:
+    """ Runs a stage args.repeat times, every run in a new project so the manifest doesn't skip anything.
+        The models are loaded by the first run and kept by the registry for the others.
+        Args:
+            stage (str): One of STAGES.
+            args: The parsed command line.
+            root (str): The folder the projects are created in.
+        Returns:
+            dict: The measurements of every run and of the median run, or why the stage was skipped.
+    """
+    from gen_ai import INIT_PROJECT, TELEMETRY
+    from .stub_models import STUB_REGISTRY
+
+    registry = STUB_REGISTRY()
+    runs = []
+    for repeat in range(args.repeat):
+        output_folder = INIT_PROJECT(IDEA, os.path.join(root, f"{stage}_{repeat}"))
+        loads, load_seconds = registry.loads, registry.load_seconds
+        TELEMETRY.clear()
+
+        with RSS_SAMPLER() as rss, IO_TIMER() as io:
+            start = time.perf_counter()
+            items = RUNNERS[stage](output_folder, registry, args)
+            seconds = time.perf_counter() - start
+
+        load_seconds = registry.load_seconds - load_seconds
+        runs.append({"seconds": seconds,
+                     "items": items,
+                     # Loading the models is measured on its own, the throughput is of the generation.
+                     "items_per_second": items / max(seconds - load_seconds, 1e-9),
+                     "loads": registry.loads - loads,
+                     "load_seconds": load_seconds,
+                     "io_seconds": io.seconds,
+                     "files": io.files,
+                     "rss_start_mb": rss.start / 1024**2,
+                     "peak_rss_mb": rss.peak / 1024**2,
+                     # The time of the loads, inference calls, Ollama chats and file writes recorded by gen_ai.
+                     "telemetry": TELEMETRY.summary()})
+
+    median = sorted(runs, key=lambda run: run["seconds"])[len(runs) // 2]
+    return {**median, "runs": runs}
+
+
+def git_revision() -> tuple:
+    """ Gets the commit the benchmark runs on and if the tree has changes that aren't committed.
+    """
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return sha, dirty
+
+
+def package_versions() -> dict:
+    """ The versions of the packages the numbers depend on.
+    """
+    from importlib.metadata import version, PackageNotFoundError
+
+    versions = {"python": platform.python_version()}
+    for package in ["torch", "diffusers", "transformers", "ollama"]:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def run(args) -> str:
+    """ Runs the stages and writes the results to benchmarks/results/<commit>.json.
+        Returns:
+            str: The path of the results.
+    """
+    fake = FAKE_OLLAMA(latency=args.latency, scenes=args.scenes)
+    # The ollama package reads OLLAMA_HOST when it's imported, so it has to be set before gen_ai is.
+    os.environ["OLLAMA_HOST"] = fake.start()
+
+    from gen_ai import TELEMETRY
+    TELEMETRY.enable()
+
+    root = tempfile.mkdtemp(prefix="gen_ai_benchmark_")
+    stages = {}
+    try:
+        for stage in args.stages:
+            print(f"Running {stage}...")
+            try:
+                stages[stage] = run_stage(stage, args, root)
+            except ImportError as e:
+                # Stages whose packages (or pipelines in the installed diffusers) are missing are skipped.
+                stages[stage] = {"skipped": repr(e)}
+            except Exception as e:
+                stages[stage] = {"error": repr(e)}
+            print(f"    {json.dumps({key: value for key, value in stages[stage].items() if key != 'runs'})}")
+    finally:
+        fake.stop()
+        if args.keep:
+            print(f"The generated files are in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    sha, dirty = git_revision()
+    results = {"commit": sha,
+               "dirty": dirty,
+               "created": time.time(),
+               "platform": platform.platform(),
+               "versions": package_versions(),
+               "settings": {"items": args.items, "scenes": args.scenes, "repeat": args.repeat, "latency": args.latency,
+                            "batch_size": args.batch_size, "num_parallel": args.num_parallel},
+               "stages": stages}
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{sha}{'-dirty' if dirty else ''}.json")
+    with open(path, 'w', encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+    return path
+
+
+# The metrics compared between two results, and if a higher value is better.
+METRICS = {"seconds": False, "items_per_second": True, "load_seconds": False, "io_seconds": False, "peak_rss_mb": False}
+
+
+def compare(old_path:str, new_path:str, threshold:float) -> list:
+    """ Prints the change of every metric between two results.
+        Args:
+            old_path (str): The results of the baseline.
+            new_path (str): The results to check.
+            threshold (float): The relative change that counts as a regression, like 0.1 for 10%.
+        Returns:
+            list: The (stage, metric) pairs that regressed.
+    """
+    with open(old_path, 'r', encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, 'r', encoding="utf-8") as f:
+        new = json.load(f)
+
+    print(f"{old['commit']} -> {new['commit']}")
+    if old["settings"] != new["settings"]:
+        print(f"The settings differ, the numbers may not be comparable: {old['settings']} vs {new['settings']}")
+
+    regressions = []
+    for stage in new["stages"]:
+        before, after = old["stages"].get(stage, {}), new["stages"][stage]
+        if "seconds" not in before or "seconds" not in after:
+            print(f"{stage:<10} not comparable")
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            change = (after[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            regressed = -change > threshold if higher_is_better else change > threshold
+            if regressed:
+                regressions.append((stage, metric))
+            print(f"{stage:<10} {metric:<18} {before[metric]:>12.3f} {after[metric]:>12.3f} {change:>+9.1%}"
+                  f"{'  REGRESSION' if regressed else ''}")
+
+    return regressions
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the generators on a CPU with tiny stand-in models.")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="The stages to run.")
+    parser.add_argument("--items", type=int, default=4, help="The prompts given to every generator.")
+    parser.add_argument("--scenes", type=int, default=4, help="The scenes in the fake script.")
+    parser.add_argument("--repeat", type=int, default=1, help="The runs of every stage, the median run is reported.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every fake Ollama response takes.")
+    parser.add_argument("--batch-size", type=int, default=2, help="The batch size of the image generators.")
+    parser.add_argument("--num-parallel", type=int, default=1, help="The detailer requests sent to Ollama at once.")
+    parser.add_argument("--output", default=RESULTS_FOLDER, help="The folder the results are written to.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated files.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results instead of running.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="The relative change --compare reports as a regression.")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    print(run(args))
@@ -0,0 +1,78 @@
+""" Checks the step cache of gen_ai on a CPU with the tiny randomly initialized Sana, LTX-Video and WAN of stub_models.py.
+    Every model generates the same prompt and seed without the cache and with it at each threshold, and the time, the
+    hit rate and the difference to the output without the cache (PSNR, mean and max) are reported.
+    The tiny models are random, so their hit rates only show the cache works, not what the real models get.
+
+    Run it from the root of the repo:
+        python -m benchmarks.step_cache
+        python -m benchmarks.step_cache --models wan --thresholds 0.02 0.05 0.1 --steps 30
+"""
+import json
+import time
+import argparse
+
+import torch
+
+from gen_ai.step_cache import step_caching, compare_outputs
+from .stub_models import tiny_sana, tiny_ltx, tiny_wan
+
+PROMPT = "A wide shot of a flat earth seen from space with the sun rising over the edge."
+
+# The stand-in of every model, the transformer calls at every step (WAN runs the negative prompt apart) and the size it generates.
+MODELS = {"sana": (tiny_sana, 1, {"height": 64, "width": 64, "use_resolution_binning": False}),
+          "ltx": (tiny_ltx, 1, {"height": 32, "width": 32, "num_frames": 9}),
+          "wan": (tiny_wan, 2, {"height": 32, "width": 32, "num_frames": 9})}
+
+
+def generate(pipe, slots:int, size:dict, steps:int, seed:int, threshold:float=None) -> tuple:
+    """ Generates the prompt once.
+        Returns:
+            tuple: The images or frames as an array, the seconds it took and the stats of the cache (None without it).
+    """
+    start = time.perf_counter()
+    with step_caching(pipe.transformer, threshold, slots) as cache:
+        output = pipe(PROMPT, num_inference_steps=steps, output_type="np",
+                      generator=torch.Generator("cpu").manual_seed(seed), **size)[0]
+    return output, time.perf_counter() - start, cache.stats() if cache else None
+
+
+def run(models:list, thresholds:list, steps:int, num_layers:int, seed:int) -> dict:
+    """ Runs every model without the cache and with it at every threshold.
+        Returns:
+            dict: The results of every threshold of every model.
+    """
+    results = {}
+    for model in models:
+        loader, slots, size = MODELS[model]
+        # The pipeline itself, FIXED_ARGS would replace the steps.
+        pipe = loader(num_layers=num_layers).pipe
+
+        reference, seconds, _ = generate(pipe, slots, size, steps, seed)
+        results[model] = {"uncached": {"seconds": seconds}}
+        for threshold in thresholds:
+            output, seconds, stats = generate(pipe, slots, size, steps, seed, threshold)
+            results[model][str(threshold)] = {"seconds": seconds, **stats, **compare_outputs(reference, output)}
+    return results
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Measures the hits and the quality of the step cache with tiny models on a CPU.")
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=list(MODELS), help="The models to run.")
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[0.02, 0.05, 0.1], help="The thresholds of the cache.")
+    parser.add_argument("--steps", type=int, default=25, help="The inference steps.")
+    parser.add_argument("--num_layers", type=int, default=4, help="The blocks of the tiny transformers, the cache skips all but the first.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of every generation.")
+    parser.add_argument("--json", action="store_true", help="Print the results as json.")
+    args = parser.parse_args()
+
+    results = run(args.models, args.thresholds, args.steps, args.num_layers, args.seed)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        for model, runs in results.items():
+            print(f"{model:<6} uncached   {runs['uncached']['seconds']:>8.3f}s")
+            for threshold in args.thresholds:
+                result = runs[str(threshold)]
+                print(f"{model:<6} {threshold:<10} {result['seconds']:>8.3f}s  hit rate {result['hit_rate']:.2f}  "
+                      f"PSNR {result['psnr']:.1f} dB  max diff {result['max_abs_diff']:.4f}")
@@ -0,0 +1,273 @@
+""" Tiny stand-ins for the models of gen_ai so the generators can be benchmarked on a CPU in seconds.
+    The diffusers pipelines are the real pipelines with tiny randomly initialized weights (the same sizes the diffusers
+    tests use), only the tokenizers come from the small hf-internal-testing repos. MusicGen and XTTS-v2 are replaced
+    by stubs with the same call signature that return random audio of a realistic length.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from gen_ai.registry import MODEL_REGISTRY
+
+
+class FIXED_ARGS:
+    """ Wraps a pipeline and fills in arguments the generator classes don't expose, like a small video size.
+        Everything else is forwarded to the pipeline, so the registry can still measure its components.
+    """
+    def __init__(self, pipe, **defaults):
+        self.pipe = pipe
+        self.defaults = defaults
+        # inspect.signature reads the arguments of the pipeline through it.
+        self.__wrapped__ = pipe
+
+    def __call__(self, *args, **kwargs):
+        return self.pipe(*args, **{**kwargs, **self.defaults})
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+
+def tiny_sdxl_base():
+    """ SDXL base with a two block UNet and two 5 layer CLIP text encoders, it generates 64x64 images.
+    """
+    from diffusers import AutoencoderKL, EulerAncestralDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(block_out_channels=(2, 4), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+                                down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+                                up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+                                attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+                                addition_time_embed_dim=8, transformer_layers_per_block=(1, 2),
+                                # 6 time ids of 8 dims and the 32 dims of the pooled text embedding.
+                                projection_class_embeddings_input_dim=80, cross_attention_dim=64, norm_num_groups=1)
+    vae = AutoencoderKL(block_out_channels=[32, 64], in_channels=3, out_channels=3,
+                        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+                        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"], latent_channels=4, sample_size=128)
+    text_config = CLIPTextConfig(bos_token_id=0, eos_token_id=2, hidden_size=32, intermediate_size=37, layer_norm_eps=1e-05,
+                                 num_attention_heads=4, num_hidden_layers=5, pad_token_id=1, vocab_size=1000,
+                                 hidden_act="gelu", projection_dim=32)
+    scheduler = EulerAncestralDiscreteScheduler(beta_start=0.00085, beta_end=0.012, steps_offset=1,
+                                                beta_schedule="scaled_linear", timestep_spacing="leading")
+
+    return StableDiffusionXLPipeline(vae=vae, unet=unet, scheduler=scheduler,
+                                     text_encoder=CLIPTextModel(text_config),
+                                     tokenizer=CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip"),
+                                     text_encoder_2=CLIPTextModelWithProjection(text_config),
+                                     tokenizer_2=CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip"))
+
+
+def tiny_sdxl_refiner():
+    """ SDXL refiner with the same UNet as tiny_sdxl_base, conditioned only on the second text encoder.
+    """
+    from diffusers import AutoencoderKL, EulerAncestralDiscreteScheduler, StableDiffusionXLImg2ImgPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModelWithProjection, CLIPTokenizer
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(block_out_channels=(2, 4), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+                                down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+                                up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+                                attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+                                addition_time_embed_dim=8, transformer_layers_per_block=(1, 2),
+                                # 5 time ids (with the aesthetic score) of 8 dims and the pooled text embedding.
+                                projection_class_embeddings_input_dim=72, cross_attention_dim=32, norm_num_groups=1)
+    vae = AutoencoderKL(block_out_channels=[32, 64], in_channels=3, out_channels=3,
+                        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+                        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"], latent_channels=4, sample_size=128)
+    text_config = CLIPTextConfig(bos_token_id=0, eos_token_id=2, hidden_size=32, intermediate_size=37, layer_norm_eps=1e-05,
+                                 num_attention_heads=4, num_hidden_layers=5, pad_token_id=1, vocab_size=1000,
+                                 hidden_act="gelu", projection_dim=32)
+    scheduler = EulerAncestralDiscreteScheduler(beta_start=0.00085, beta_end=0.012, steps_offset=1,
+                                                beta_schedule="scaled_linear", timestep_spacing="leading")
+
+    return StableDiffusionXLImg2ImgPipeline(vae=vae, unet=unet, scheduler=scheduler, text_encoder=None, tokenizer=None,
+                                            text_encoder_2=CLIPTextModelWithProjection(text_config),
+                                            tokenizer_2=CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip"),
+                                            requires_aesthetics_score=True)
+
+
+def tiny_sana(num_layers:int=1):
+    """ Sana with a single layer transformer, a two block DC-AE and a single layer Gemma2 text encoder.
+        The resolution binning is turned off, else any size is snapped to the 512px aspect ratios.
+        More layers can be asked for, the step cache needs a few to skip.
+    """
+    from diffusers import AutoencoderDC, FlowMatchEulerDiscreteScheduler, SanaPipeline, SanaTransformer2DModel
+    from transformers import Gemma2Config, Gemma2Model, GemmaTokenizer
+
+    torch.manual_seed(0)
+    transformer = SanaTransformer2DModel(patch_size=1, in_channels=4, out_channels=4, num_layers=num_layers, num_attention_heads=2,
+                                         attention_head_dim=4, num_cross_attention_heads=2, cross_attention_head_dim=4,
+                                         cross_attention_dim=8, caption_channels=8, sample_size=16)
+    vae = AutoencoderDC(in_channels=3, latent_channels=4, attention_head_dim=2,
+                        encoder_block_types=("ResBlock", "EfficientViTBlock"), decoder_block_types=("ResBlock", "EfficientViTBlock"),
+                        encoder_block_out_channels=(8, 8), decoder_block_out_channels=(8, 8),
+                        encoder_qkv_multiscales=((), (5,)), decoder_qkv_multiscales=((), (5,)),
+                        encoder_layers_per_block=(1, 1), decoder_layers_per_block=[1, 1],
+                        downsample_block_type="conv", upsample_block_type="interpolate",
+                        decoder_norm_types="rms_norm", decoder_act_fns="silu", scaling_factor=0.41407)
+    text_config = Gemma2Config(head_dim=16, hidden_size=8, initializer_range=0.02, intermediate_size=64,
+                               max_position_embeddings=8192, model_type="gemma2", num_attention_heads=2, num_hidden_layers=1,
+                               num_key_value_heads=2, vocab_size=8, attn_implementation="eager")
+
+    pipe = SanaPipeline(tokenizer=GemmaTokenizer.from_pretrained("hf-internal-testing/dummy-gemma"),
+                        text_encoder=Gemma2Model(text_config), vae=vae, transformer=transformer,
+                        scheduler=FlowMatchEulerDiscreteScheduler(shift=7.0))
+    return FIXED_ARGS(pipe, use_resolution_binning=False)
+
+
+def tiny_ltx(num_layers:int=1):
+    """ LTX-Video with a single layer transformer and a small causal video VAE, it generates 9 frames of 32x32.
+        The frames are fixed too, LTX_VIDEO asks for 241 by default.
+    """
+    from diffusers import AutoencoderKLLTXVideo, FlowMatchEulerDiscreteScheduler, LTXPipeline, LTXVideoTransformer3DModel
+    from transformers import AutoTokenizer, T5EncoderModel
+
+    torch.manual_seed(0)
+    transformer = LTXVideoTransformer3DModel(in_channels=8, out_channels=8, patch_size=1, patch_size_t=1, num_attention_heads=4,
+                                             attention_head_dim=8, cross_attention_dim=32, num_layers=num_layers, caption_channels=32)
+    vae = AutoencoderKLLTXVideo(in_channels=3, out_channels=3, latent_channels=8, block_out_channels=(8, 8, 8, 8),
+                                decoder_block_out_channels=(8, 8, 8, 8), layers_per_block=(1, 1, 1, 1, 1),
+                                decoder_layers_per_block=(1, 1, 1, 1, 1),
+                                spatio_temporal_scaling=(True, True, False, False),
+                                decoder_spatio_temporal_scaling=(True, True, False, False),
+                                decoder_inject_noise=(False, False, False, False, False),
+                                upsample_residual=(False, False, False, False), upsample_factor=(1, 1, 1, 1),
+                                timestep_conditioning=False, patch_size=1, patch_size_t=1,
+                                encoder_causal=True, decoder_causal=False)
+    vae.use_framewise_encoding = False
+    vae.use_framewise_decoding = False
+
+    pipe = LTXPipeline(scheduler=FlowMatchEulerDiscreteScheduler(), vae=vae,
+                       text_encoder=T5EncoderModel.from_pretrained("hf-internal-testing/tiny-random-t5"),
+                       tokenizer=AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-t5"),
+                       transformer=transformer)
+    return FIXED_ARGS(pipe, height=32, width=32, num_frames=9, num_inference_steps=10)
+
+
+def tiny_wan(num_layers:int=2):
+    """ WAN 2.1 with a two layer transformer and a small video VAE, it generates 9 frames of 32x32.
+    """
+    from diffusers import AutoencoderKLWan, FlowMatchEulerDiscreteScheduler, WanPipeline, WanTransformer3DModel
+    from transformers import AutoTokenizer, T5EncoderModel
+
+    torch.manual_seed(0)
+    vae = AutoencoderKLWan(base_dim=3, z_dim=16, dim_mult=[1, 1, 1, 1], num_res_blocks=1, temperal_downsample=[False, True, True])
+    transformer = WanTransformer3DModel(patch_size=(1, 2, 2), num_attention_heads=2, attention_head_dim=12, in_channels=16,
+                                        out_channels=16, text_dim=32, freq_dim=256, ffn_dim=32, num_layers=num_layers,
+                                        cross_attn_norm=True, qk_norm="rms_norm_across_heads", rope_max_seq_len=32)
+
+    pipe = WanPipeline(tokenizer=AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-t5"),
+                       text_encoder=T5EncoderModel.from_pretrained("hf-internal-testing/tiny-random-t5"),
+                       transformer=transformer, vae=vae, scheduler=FlowMatchEulerDiscreteScheduler(shift=7.0))
+    return FIXED_ARGS(pipe, height=32, width=32, num_frames=9, num_inference_steps=10)
+
+
+class STUB_INPUTS(dict):
+    """ The processor output, moved to a device like a BatchFeature.
+    """
+    def to(self, device):
+        return self
+
+
+class STUB_MUSICGEN_MODEL(torch.nn.Module):
+    """ Stands in for the Musicgen model, generate returns the audio prompt followed by random audio of the requested length.
+    """
+    def __init__(self, sampling_rate:int=32000, frame_rate:int=50):
+        super().__init__()
+        self.config = SimpleNamespace(audio_encoder=SimpleNamespace(sampling_rate=sampling_rate, frame_rate=frame_rate))
+        self.weights = torch.nn.Linear(64, 64)
+
+    @property
+    def device(self):
+        return self.weights.weight.device
+
+    def generate(self, input_ids=None, input_values=None, max_new_tokens:int=256, **kwargs):
+        encoder = self.config.audio_encoder
+        prompt = input_values.shape[-1] if input_values is not None else 0
+        return torch.rand(1, 1, prompt + max_new_tokens * encoder.sampling_rate // encoder.frame_rate) * 2 - 1
+
+
+def stub_musicgen_processor(text=None, audio=None, sampling_rate=None, **kwargs):
+    """ Stands in for the Musicgen processor.
+    """
+    inputs = STUB_INPUTS(input_ids=torch.zeros(len(text), 8, dtype=torch.long))
+    if audio is not None:
+        inputs["input_values"] = torch.from_numpy(np.stack(audio)).unsqueeze(1)
+    return inputs
+
+
+class STUB_MUSICGEN(torch.nn.Module):
+    """ Stands in for the text-to-audio pipeline of MusicGen, returns random audio of the length MusicGen generates.
+    """
+    def __init__(self, seconds:float=5, sampling_rate:int=32000):
+        super().__init__()
+        self.samples = int(seconds * sampling_rate)
+        self.sampling_rate = sampling_rate
+        self.model = STUB_MUSICGEN_MODEL(sampling_rate)
+        self.processor = stub_musicgen_processor
+
+    def __call__(self, prompt, forward_params=None, batch_size=1):
+        if isinstance(prompt, list):
+            return [self(text) for text in prompt]
+        audio = np.random.default_rng(len(prompt)).uniform(-1, 1, self.samples).astype(np.float32)
+        return {"audio": audio, "sampling_rate": self.sampling_rate}
+
+
+class STUB_XTTS(torch.nn.Module):
+    """ Stands in for XTTS-v2, returns random speech as long as the text would take to read.
+    """
+    def __init__(self, words_per_second:float=2.5, sampling_rate:int=24000):
+        super().__init__()
+        self.words_per_second = words_per_second
+        self.sampling_rate = sampling_rate
+        self.weights = torch.nn.Linear(64, 64)
+        self.tokenizer = SimpleNamespace(char_limits={"en": 250})
+
+    @property
+    def device(self):
+        return self.weights.weight.device
+
+    def get_conditioning_latents(self, audio_path, **kwargs):
+        # The shapes of the real GPT conditioning latents and speaker embedding.
+        return torch.zeros(1, 32, 1024), torch.zeros(1, 512, 1)
+
+    def speak(self, text:str):
+        samples = int(len(text.split()) / self.words_per_second * self.sampling_rate)
+        return np.random.default_rng(len(text)).uniform(-1, 1, samples).astype(np.float32)
+
+    def inference(self, text, language, gpt_cond_latent, speaker_embedding, **kwargs):
+        return {"wav": self.speak(text)}
+
+    def inference_stream(self, text, language, gpt_cond_latent, speaker_embedding, **kwargs):
+        # XTTS streams every sentence in chunks.
+        for sentence in text.split(". "):
+            audio = self.speak(sentence)
+            for start in range(0, len(audio), self.sampling_rate // 2):
+                yield torch.from_numpy(audio[start:start + self.sampling_rate // 2])
+
+
+def stub_xtts_config():
+    """ The settings of the XTTS-v2 config that XTTSv2_SPEECH reads.
+    """
+    return SimpleNamespace(temperature=0.75, length_penalty=1.0, repetition_penalty=10.0, top_k=50, top_p=0.85,
+                           gpt_cond_chunk_len=4, max_ref_len=30, sound_norm_refs=False)
+
+
+# The registry keys of the generator classes mapped to the stand-ins that replace their loaders.
+STUB_LOADERS = {"sana": tiny_sana,
+                "sdxl_base": tiny_sdxl_base,
+                "sdxl_refiner": tiny_sdxl_refiner,
+                "musicgen_small": STUB_MUSICGEN,
+                "xtts_v2": STUB_XTTS,
+                "wan2.1_t2v": tiny_wan,
+                "ltx_video": tiny_ltx}
+
+
+class STUB_REGISTRY(MODEL_REGISTRY):
+    """ A MODEL_REGISTRY that loads the stand-ins instead of the real weights.
+        Passing it to a generator class runs the class code unchanged against the tiny models.
+    """
+    def get(self, key:str, loader):
+        # The SDXL base key has the LoRA after a colon.
+        return super().get(key, STUB_LOADERS[key.split(":")[0]])
@@ -1,6 +1,36 @@
-from .image import SANA_IMAGE, SDXL_IMAGE
-from .music import GEN_MUSIC
-from .script import OLLAMA_SCRIPT
-from .video import WAN_VIDEO, LTX_VIDEO
-from .speech import XTTSv2_SPEECH
-from .gen_ai_utilities import initialize_project as INIT_PROJECT
+import importlib
+
+# The names gen_ai exports and where they are defined. A module is imported the first time one of its names is used,
+# so a job that only writes the script doesn't wait for torch, diffusers, transformers and TTS to load.
+EXPORTS = {"SANA_IMAGE": (".image", "SANA_IMAGE"),
+           "SDXL_IMAGE": (".image", "SDXL_IMAGE"),
+           "GEN_MUSIC": (".music", "GEN_MUSIC"),
+           "OLLAMA_SCRIPT": (".script", "OLLAMA_SCRIPT"),
+           "WAN_VIDEO": (".video", "WAN_VIDEO"),
+           "LTX_VIDEO": (".video", "LTX_VIDEO"),
+           "XTTSv2_SPEECH": (".speech", "XTTSv2_SPEECH"),
+           "STREAM_PIPELINE": (".pipeline", "STREAM_PIPELINE"),
+           "MODEL_REGISTRY": (".registry", "MODEL_REGISTRY"),
+           "BACKGROUND_SAVER": (".background_saver", "BACKGROUND_SAVER"),
+           "TELEMETRY": (".telemetry", "telemetry"),
+           "INIT_PROJECT": (".gen_ai_utilities", "initialize_project"),
+           "RUN_SHARDED": (".sharding", "run_sharded")}
+
+__all__ = list(EXPORTS)
+
+
+def __getattr__(name:str):
+    """ Imports the module of an exported name when it's first used (PEP 562).
+    """
+    if name not in EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module, attribute = EXPORTS[name]
+    value = getattr(importlib.import_module(module, __name__), attribute)
+    # The next lookup finds it without coming here.
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
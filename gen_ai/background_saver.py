@@ -0,0 +1,114 @@
+import atexit
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .gen_ai_utilities import file_saver
+
+
+class BACKGROUND_SAVER:
+    """ Saves the generated content with file_saver on background threads.
+        Encoding a PNG, a WAV or a long video takes a while, this lets the generator start on the next prompt meanwhile.
+    """
+    def __init__(self, max_workers:int=2, max_pending:int=4):
+        """ Initialize the threads.
+            Args:
+                max_workers (int): The number of files encoded at once.
+                max_pending (int): The number of files that can wait to be saved, save blocks when it's reached.
+                    Every waiting file keeps its content in memory, so keep it low for videos.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="file_saver")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        # The files being saved and the saves that failed, for flush. A saved file is forgotten, its future was
+        # returned to the caller, so a long running worker doesn't keep all of them.
+        self.pending = set()
+        self.lock = threading.Lock()
+
+        # Whatever is still waiting gets saved before the interpreter exits.
+        atexit.register(self.flush)
+
+    def save(self, output_folder:str, **content) -> Future:
+        """ Queues the content to be saved.
+            Args:
+                output_folder (str): The folder of the project.
+                content: The arguments of file_saver, like image=... and item=...
+            Returns:
+                Future: Resolves to the path of the saved file, or raises the error of file_saver.
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(file_saver, output_folder, **content)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future:Future):
+        """ Forgets a saved file, a failed one is kept for flush to raise.
+        """
+        self.slots.release()
+        if future.exception() is None:
+            with self.lock:
+                self.pending.discard(future)
+
+    @staticmethod
+    def completed(path:str) -> Future:
+        """ Wraps the path of a file saved before, so the generators return futures either way.
+            Args:
+                path (str): The path of the file.
+            Returns:
+                Future: Resolved to the path.
+        """
+        future = Future()
+        future.set_result(path)
+        return future
+
+    def flush(self):
+        """ Waits till every queued file is saved, the paths are the results of the futures save returned.
+            Raises the first error of the saves that failed since the last flush, after everything else was saved.
+        """
+        with self.lock:
+            futures = list(self.pending)
+        for future in futures:
+            future.exception()
+
+        failed = [future for future in futures if future.exception() is not None]
+        with self.lock:
+            self.pending.difference_update(failed)
+        if failed:
+            failed[0].result()
+
+    def close(self):
+        """ Saves what's queued and stops the threads.
+        """
+        self.flush()
+        self.executor.shutdown()
+
+
+def save_output(saver:BACKGROUND_SAVER, output_folder:str, **content):
+    """ Saves the content in the background if there is a saver, else right away.
+        Args:
+            saver (BACKGROUND_SAVER): The saver of the generator, None saves right away.
+            output_folder (str): The folder of the project.
+            content: The arguments of file_saver.
+        Returns:
+            Future or str: A future resolving to the path with a saver, else the path.
+    """
+    if saver:
+        return saver.save(output_folder, **content)
+    return file_saver(output_folder, **content)
+
+
+def reuse_output(saver:BACKGROUND_SAVER, path:str):
+    """ Returns a file generated before the same way save_output would.
+        Args:
+            saver (BACKGROUND_SAVER): The saver of the generator.
+            path (str): The path of the file.
+        Returns:
+            Future or str: A resolved future with a saver, else the path.
+    """
+    if saver:
+        return saver.completed(path)
+    return path
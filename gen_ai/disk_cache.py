@@ -0,0 +1,108 @@
+import os
+import threading
+
+
+class DISK_CACHE:
+    """ A content addressed disk cache with one file per key, the least recently used files are removed when the folder
+        grows over its size. The size of the folder is kept as a running total, so it's only scanned when the total
+        goes over the limit (other processes writing to the same folder are counted then).
+        A subclass sets the extension and the errors a missing or broken file raises, and stores its values with
+        read and write.
+    """
+    extension = ""
+    read_errors = (OSError,)
+
+    def __init__(self, cache_folder:str, max_size_mb:int):
+        """ Initialize the cache folder.
+            Args:
+                cache_folder (str): The folder where the values are stored.
+                max_size_mb (int): The size of the folder after which the least recently used values are removed.
+        """
+        self.cache_folder = cache_folder
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        # The cache can be used from several threads at once.
+        self.lock = threading.Lock()
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def path(self, key:str) -> str:
+        """ The file of a key.
+        """
+        return os.path.join(self.cache_folder, f"{key}{self.extension}")
+
+    def entries(self) -> list:
+        """ Lists the stored files.
+            Returns:
+                list: The last use, size and path of every file.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_folder):
+            if entry.name.endswith(self.extension) and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def read(self, key:str, load):
+        """ Reads a stored value.
+            Args:
+                key (str): The key.
+                load (function): Reads the value from the path of the file.
+            Returns:
+                The value, None if it's not stored.
+        """
+        name = self.path(key)
+        with self.lock:
+            try:
+                value = load(name)
+            except self.read_errors:
+                self.misses += 1
+                return None
+
+            # Touching the file marks it as recently used.
+            os.utime(name)
+            self.hits += 1
+            return value
+
+    def write(self, key:str, save):
+        """ Stores a value and removes the old ones if the cache is too big.
+            Args:
+                key (str): The key.
+                save (function): Writes the value to the path it's given.
+        """
+        name = self.path(key)
+        with self.lock:
+            previous = os.path.getsize(name) if os.path.exists(name) else 0
+            # Write to a temporary file first so a crash never leaves a half written value.
+            save(f"{name}.tmp")
+            os.replace(f"{name}.tmp", name)
+            self.size += os.path.getsize(name) - previous
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ Removes the least recently used values till the cache fits in max_size, called with the lock held.
+        """
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process sharing the folder removed it first.
+                pass
+            size -= file_size
+        self.size = size
+
+    def stats(self) -> dict:
+        """ Gets the hit and miss counters.
+            Returns:
+                dict: The hits, misses and the hit rate.
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,171 @@
+import inspect
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+# The arguments of a pipeline's __call__ that change what encode_prompt returns.
+ENCODE_OPTIONS = ["complex_human_instruction", "clean_caption", "max_sequence_length"]
+
+# The outputs of encode_prompt, they are passed back to the pipeline under these names.
+ENCODE_OUTPUTS = {"sana": ["prompt_embeds", "prompt_attention_mask", "negative_prompt_embeds", "negative_prompt_attention_mask"],
+                  "ltx": ["prompt_embeds", "prompt_attention_mask", "negative_prompt_embeds", "negative_prompt_attention_mask"],
+                  "wan": ["prompt_embeds", "negative_prompt_embeds"]}
+
+
+class EMBEDDING_CACHE:
+    """ Keeps the prompt embeddings of the text encoders in memory, keyed by the model, prompt and negative prompt.
+        With CPU offload every encode moves the text encoder to the GPU and back, a re-rolled seed or a prompt used
+        by more than one model (the SDXL base and refiner) reuses the embeddings instead.
+        The least recently used embeddings are dropped when the cache grows over its size.
+    """
+    def __init__(self, max_size_mb:int=256):
+        """ Initialize the cache.
+            Args:
+                max_size_mb (int): The size of the embeddings after which the least recently used ones are dropped.
+        """
+        self.max_size = max_size_mb * 1024 * 1024
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        # The worker and the scheduler run generators on other threads.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(entry:dict) -> int:
+        """ Gets the bytes of the tensors of an entry.
+        """
+        return sum(tensor.numel() * tensor.element_size() for tensor in entry.values() if tensor is not None)
+
+    def peek(self, key:tuple) -> dict:
+        """ Gets an entry without encoding it or counting it as a hit.
+            Args:
+                key (tuple): The model, prompt and negative prompt.
+            Returns:
+                dict: The tensors on the CPU, None if they aren't stored.
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def get(self, key:tuple, encode) -> dict:
+        """ Gets the embeddings of a prompt, they are encoded the first time.
+            Args:
+                key (tuple): The model, prompt and negative prompt.
+                encode (function): Encodes the prompt, returns a dict of tensors.
+            Returns:
+                dict: The tensors on the CPU.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        # Encoding takes a while, the lock isn't held for it.
+        entry = {name: None if tensor is None else tensor.detach().cpu() for name, tensor in encode().items()}
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = entry
+                self.size += self.entry_size(entry)
+                self.evict()
+        return entry
+
+    def evict(self):
+        """ Drops the least recently used embeddings till the cache fits in max_size, the newest one is always kept.
+        """
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= self.entry_size(entry)
+
+    def clear(self):
+        """ Drops every entry.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """ Gets the hit and miss counters.
+            Returns:
+                dict: The hits, misses, the hit rate and the bytes stored.
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "size": self.size}
+
+
+# Shared by every generator, so the SDXL refiner can find the embeddings of the base.
+embedding_cache = EMBEDDING_CACHE()
+
+
+def batch_entries(entries:list, names:list, device) -> dict:
+    """ Stacks the entries of a batch into the arguments of a pipeline.
+    """
+    return {name: torch.cat([entry[name] for entry in entries]).to(device) for name in names if entries[0][name] is not None}
+
+
+def sdxl_prompt_embeds(pipe, model:str, prompts:list, base_model:str=None) -> dict:
+    """ Gets the prompt embeddings of an SDXL base or refiner for a batch.
+        The refiner only has the second text encoder of the base, so its embeddings are the last part of the embeddings
+        of the base when the base encoded the prompt already.
+        Args:
+            pipe (StableDiffusionXLPipeline or StableDiffusionXLImg2ImgPipeline): The pipeline.
+            model (str): The model name in the keys, like its registry key.
+            prompts (list): The prompts of the batch.
+            base_model (str): The model name of the base for a refiner, None if the embeddings can't be shared (with a LoRA).
+        Returns:
+            dict: prompt_embeds, pooled_prompt_embeds and the negative ones if the pipeline doesn't use zeros for them.
+    """
+    device = pipe._execution_device
+
+    def encode(text):
+        if base_model:
+            base = embedding_cache.peek((base_model, text, None))
+            if base:
+                width = pipe.text_encoder_2.config.hidden_size
+                return {"prompt_embeds": base["prompt_embeds"][..., -width:].clone(), "pooled_prompt_embeds": base["pooled_prompt_embeds"]}
+        prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(text, device=device, do_classifier_free_guidance=False)
+        return {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds}
+
+    entries = [embedding_cache.get((model, prompt, None), lambda prompt=prompt: encode(prompt)) for prompt in prompts]
+    embeds = batch_entries(entries, ["prompt_embeds", "pooled_prompt_embeds"], device)
+
+    # The base uses zeros for an empty negative prompt, the refiner encodes it.
+    if not pipe.config.force_zeros_for_empty_prompt:
+        negative = embedding_cache.get((model, "", None), lambda: encode(""))
+        embeds["negative_prompt_embeds"] = negative["prompt_embeds"].to(device).repeat(len(prompts), 1, 1)
+        embeds["negative_pooled_prompt_embeds"] = negative["pooled_prompt_embeds"].to(device).repeat(len(prompts), 1)
+    return embeds
+
+
+def encoded_prompts(pipe, model:str, family:str, prompts:list, negative_prompt:str=None) -> dict:
+    """ Gets the prompt embeddings of a Sana, LTX-Video or WAN pipeline for a batch, with the same settings its __call__ uses.
+        Args:
+            pipe (DiffusionPipeline): The pipeline.
+            model (str): The model name in the keys, like its registry key.
+            family (str): sana, ltx or wan, see ENCODE_OUTPUTS.
+            prompts (list): The prompts of the batch.
+            negative_prompt (str): The negative prompt, None uses the default of the pipeline.
+        Returns:
+            dict: The embeddings and attention masks, passed to the pipeline in place of the prompt and negative prompt.
+    """
+    device = pipe._execution_device
+    defaults = {name: parameter.default for name, parameter in inspect.signature(pipe).parameters.items()}
+    if negative_prompt is None:
+        negative_prompt = defaults.get("negative_prompt")
+    options = {name: defaults[name] for name in ENCODE_OPTIONS
+               if name in defaults and name in inspect.signature(pipe.encode_prompt).parameters}
+
+    names = ENCODE_OUTPUTS[family]
+
+    def encode(prompt):
+        return dict(zip(names, pipe.encode_prompt(prompt, negative_prompt=negative_prompt, do_classifier_free_guidance=True,
+                                                  device=device, **options)))
+
+    entries = [embedding_cache.get((model, prompt, negative_prompt), lambda prompt=prompt: encode(prompt)) for prompt in prompts]
+    # The negative prompt is in its embeddings, the pipeline doesn't take both.
+    return {"negative_prompt": None, **batch_entries(entries, names, device)}
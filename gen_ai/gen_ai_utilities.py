@@ -1,8 +1,12 @@
 import os
+import sys
+import json
+import hashlib
+import threading
 from datetime import datetime
-from scipy.io import wavfile
-from torchao.quantization import quantize_, int8_weight_only
-from diffusers.utils import export_to_video
+
+from .manifest import get_manifest
+from .telemetry import telemetry
 
 
 def get_current_time() -> str:
@@ -10,19 +14,147 @@ def get_current_time() -> str:
     """
     return datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
 
-def optimize_model(pipe, quantize=False, seq=False):
+def get_device(device:str=None) -> str:
+    """ Picks the device the models run on.
+        Args:
+            device (str): A torch device like cuda, cuda:1, mps or cpu. Defaults to the GEN_AI_DEVICE environment variable,
+                else the GPU if there is one, else the CPU.
+        Returns:
+            str: The device.
+    """
+    import torch
+
+    device = device or os.environ.get("GEN_AI_DEVICE")
+    if device:
+        # Raises on a device torch doesn't know.
+        return str(torch.device(device))
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def make_generator(device:str, seed:int):
+    """ Creates a seeded torch.Generator on the device the pipeline runs on, None seeds it randomly.
+    """
+    import torch
+
+    generator = torch.Generator(device)
+    if seed is None:
+        generator.seed()
+        return generator
+    return generator.manual_seed(seed)
+
+
+def batch_generators(device:str, seeds:list) -> dict:
+    """ Gets the generator argument of a pipeline for a batch, a generator per image.
+        The images without a seed get a random one, so the seeded images of the batch stay reproducible.
+        Returns:
+            dict: The generator argument, empty if none of the images has a seed.
+    """
+    if all(seed is None for seed in seeds):
+        return {}
+    return {"generator": [make_generator(device, seed) for seed in seeds]}
+
+
+def memory_budget() -> dict:
+    """ Reads the memory budget of the pipelines from the GEN_AI_VRAM_GB and GEN_AI_RAM_GB environment variables.
+        Returns:
+            dict: vram_gb and ram_gb (None for the one that isn't set), None if neither is set.
+    """
+    budget = {"vram_gb": os.environ.get("GEN_AI_VRAM_GB"), "ram_gb": os.environ.get("GEN_AI_RAM_GB")}
+    if not any(budget.values()):
+        return None
+    return {name: float(value) if value else None for name, value in budget.items()}
+
+
+def optimize_model(pipe, quantize=False, seq=False, device:str=None, budget:dict=None) -> dict:
     """ Quantizes the model to take less memory.
+        The model is offloaded to the CPU between its uses of the device, on the CPU it stays where it is.
+        With a budget, like {"vram_gb": 8, "ram_gb": 32} (the free memory is used for the one left out), the placement of every
+        component is planned for it instead, see plan_offload. It defaults to memory_budget(), seq ignores it.
+        When nothing else fits the plan offloads the largest components one layer at a time like seq, see its fallback.
+        Returns:
+            dict: The plan with a budget, else None.
     """
     if quantize:
+        # Imported here so the script stage doesn't load torchao.
+        from torchao.quantization import quantize_, int8_weight_only
+
         # The below lines save some memory by quantizing the model while loading
         quantize_(pipe.text_encoder, int8_weight_only())
         quantize_(pipe.transformer, int8_weight_only())
 
+    device = get_device(device)
+    if device == "cpu":
+        return None
+
+    budget = budget or memory_budget()
+    if budget and not seq:
+        from .offload_planner import pipe_components, plan_offload, apply_plan, budget_bytes
+
+        # The components quantized above are planned with their quantized size. When nothing else fits the plan
+        # offloads them one layer at a time, its fallback and fits say so.
+        plan = plan_offload(pipe_components(pipe), *budget_bytes(budget))
+        apply_plan(pipe, plan, device)
+        return plan
+
     if seq:
         # Super slow but requires less than 2GB VRAM as everything is offloaded to CPU.
-        pipe.enable_sequential_cpu_offload()
+        pipe.enable_sequential_cpu_offload(device=device)
     else:
-        pipe.enable_model_cpu_offload()
+        pipe.enable_model_cpu_offload(device=device)
+    return None
+
+
+def available_memory() -> dict:
+    """ Gets the memory that's free right now.
+        Returns:
+            dict: The free bytes of the GPU (None without one) and of the RAM (None if it can't be read).
+    """
+    import torch
+
+    memory = {"cuda": torch.cuda.mem_get_info()[0] if torch.cuda.is_available() else None, "cpu": None}
+    try:
+        # psutil comes with accelerate.
+        import psutil
+        memory["cpu"] = psutil.virtual_memory().available
+    except ImportError:
+        try:
+            memory["cpu"] = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            pass
+    return memory
+
+
+def run_in_batches(generate, items:list, batch_size:int) -> list:
+    """ Runs the items through generate in micro-batches. The batch size is halved when the GPU runs out of memory.
+        Args:
+            generate (function): Takes a list of items and returns a list with a result for each.
+            items (list): All the items.
+            batch_size (int): The largest number of items passed to generate at once.
+        Returns:
+            list: The results in the order of items.
+    """
+    import torch
+
+    results = []
+    start = 0
+    while start < len(items):
+        batch = items[start:start+batch_size]
+        try:
+            results.extend(generate(batch))
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            # Free what the failed batch allocated and retry the same items with a smaller batch.
+            torch.cuda.empty_cache()
+            batch_size = batch_size // 2
+            continue
+        start += len(batch)
+
+    return results
 
 
 def initialize_project_name(project: str) -> str:
@@ -68,44 +200,249 @@ def initialize_project(topic, output_folder=None):
     return output_folder
 
 
-def file_saver(output_folder, script=None, image=None, speech=None, music=None, video=None) -> str:
+# XTTS-v2 generates 24kHz audio.
+SPEECH_SAMPLE_RATE = 24000
+
+# The sub folder and the extension of the files of every stage.
+OUTPUT_FOLDERS = {"script": "scripts", "image": "images", "speech": "speech", "music": "music", "video": "videos"}
+OUTPUT_EXTENSIONS = {"script": ".txt", "image": ".png", "speech": ".wav", "music": ".wav", "video": ".mp4"}
+
+
+# The names given out by unique_name, a file saved in the background only exists once it's written.
+reserved_names = set()
+reserved_names_lock = threading.Lock()
+
+
+def unique_name(name:str, extension:str) -> str:
+    """ Adds a counter to the name if the file already exists, fast generators save more than one file in the same second.
+    """
+    counter = 1
+    unique = f"{name}{extension}"
+    with reserved_names_lock:
+        while os.path.exists(unique) or unique in reserved_names:
+            unique = f"{name}_{counter}{extension}"
+            counter += 1
+        reserved_names.add(unique)
+    return unique
+
+
+def release_name(name:str):
+    """ Forgets a name given out by unique_name, once its file exists (or failed to be written) it isn't needed.
+    """
+    with reserved_names_lock:
+        reserved_names.discard(name)
+
+
+def work_item(index:int, line:str, seed:int=None, params:dict=None) -> dict:
+    """ Creates the work item passed to file_saver, it names the output and registers it in the project's manifest.
+        Args:
+            index (int): The index of the item in its stage, None doesn't record anything.
+            line (str): The prompt given to the generator.
+            seed (int): The seed given to the generator.
+            params (dict): The other settings of the generator that change the output, like the image size.
+        Returns:
+            dict: The item, None if there is no index.
+    """
+    if index is None:
+        return None
+    return {"index": index, "line": line, "seed": seed, "params": params}
+
+
+def output_path(output_folder:str, stage:str, item:dict=None) -> str:
+    """ Gets the path a stage saves its output to.
+        The output of a work item is named after its stage, index and a hash of its prompt, seed and settings,
+        so the same item always goes to the same file and nothing else can overwrite it.
+        Args:
+            output_folder (str): The folder of the project.
+            stage (str): script, image, speech, music or video.
+            item (dict): The work item from work_item, without it the name has the current time.
+        Returns:
+            str: The path of the file.
+    """
+    folder = f"{output_folder}/{OUTPUT_FOLDERS[stage]}"
+    extension = OUTPUT_EXTENSIONS[stage]
+
+    # The detailer reads the script from this fixed name.
+    if stage == "script":
+        return f"{folder}/script{extension}"
+    if not item:
+        return unique_name(f"{folder}/{stage}_{get_current_time()}", extension)
+
+    params = json.dumps([item["line"], item["seed"], item["params"]], sort_keys=True)
+    return f"{folder}/{stage}_{item['index']:03d}_{hashlib.sha256(params.encode('utf-8')).hexdigest()[:8]}{extension}"
+
+
+def start_item(output_folder:str, stage:str, index:int, line:str, seed:int=None, params:dict=None) -> str:
+    """ Marks a work item as running, unless it was already generated.
+        Args:
+            output_folder (str): The folder of the project.
+            stage (str): script, image, speech, music or video.
+            index (int): The index of the item in its stage, None doesn't record anything.
+            line (str): The prompt given to the generator.
+            seed (int): The seed given to the generator.
+            params (dict): The other settings of the generator that change the output.
+        Returns:
+            str: The path of the file generated before, None if it has to be generated.
+    """
+    item = work_item(index, line, seed, params)
+    if not item:
+        return None
+
+    manifest = get_manifest(output_folder)
+    path = manifest.completed(stage, **item)
+    if path:
+        return path
+
+    # The files are only renamed to their final name when they are complete, so an existing file can be reused.
+    # Unless the manifest has a different file for it, then the file was changed after it was saved.
+    # The script has a fixed name without the hash of its idea, only the manifest can tell which idea it was made from.
+    path = output_path(output_folder, stage, item)
+    if stage != "script" and os.path.exists(path) and manifest.items.get(f"{stage}:{index}", {}).get("status") != "done":
+        manifest.register(stage, path=path, status="done", **item)
+        return path
+
+    manifest.register(stage, **item)
+    return None
+
+
+def file_saver(output_folder, script=None, image=None, speech=None, music=None, video=None, item=None, fps:int=12) -> str:
     """ Saves content based on what was passed.
+        The content is written to a temporary file which is renamed when it's complete.
+        If item (from work_item) is passed, the file is named after it and registered in the project's manifest.
+        The video is encoded at fps frames per second.
     """
     if script:
-        folder = f"{output_folder}/scripts"
-        os.makedirs(folder, exist_ok=True)
-        name = f"{folder}/script.txt"
-        with open(name, 'w', encoding='utf-8') as f:
-            f.write(script)
-        return name
+        stage = "script"
     elif image:
-        folder = f"{output_folder}/images"
-        os.makedirs(folder, exist_ok=True)
-        name = f"{folder}/image_{get_current_time()}.png"
-        image.save(name)
-        return name
+        stage = "image"
     elif speech:
-        folder = f"{output_folder}/speech"
-        os.makedirs(folder, exist_ok=True)
-        name = f"{folder}/speech_{get_current_time()}.wav"
-        wavfile.write(name, rate=22050, data=speech["wav"])
-        return name
+        stage = "speech"
     elif music:
-        folder = f"{output_folder}/music"
-        os.makedirs(folder, exist_ok=True)
-        name = f"{folder}/music_{get_current_time()}.wav"
-        wavfile.write(name, rate=music["sampling_rate"], data=music["audio"])
-        return name
+        stage = "music"
     # elif video:
     else:
-        folder = f"{output_folder}/videos"
-        os.makedirs(folder, exist_ok=True)
-        name = f"{folder}/video_{get_current_time()}.mp4"
+        stage = "video"
+
+    os.makedirs(f"{output_folder}/{OUTPUT_FOLDERS[stage]}", exist_ok=True)
+    name = output_path(output_folder, stage, item)
+
+    # Keep the extension, the image and video writers pick the format from it.
+    temp_name = f"{name[:-len(OUTPUT_EXTENSIONS[stage])]}.partial{OUTPUT_EXTENSIONS[stage]}"
+
+    with telemetry.span("io", stage) as span:
         try:
-            export_to_video(video, name, fps=12)
-            return name
-        except:
-            return None
+            if script:
+                with open(temp_name, 'w', encoding='utf-8') as f:
+                    f.write(script)
+            elif image:
+                image.save(temp_name)
+            elif speech:
+                from scipy.io import wavfile
+                wavfile.write(temp_name, rate=SPEECH_SAMPLE_RATE, data=speech["wav"])
+            elif music:
+                from scipy.io import wavfile
+                wavfile.write(temp_name, rate=music["sampling_rate"], data=music["audio"])
+            # elif video:
+            else:
+                from diffusers.utils import export_to_video
+                export_to_video(video, temp_name, fps=fps)
+        except Exception:
+            # Don't leave half written files behind, the error goes to the caller.
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            release_name(name)
+            raise
+
+        span["bytes"] = os.path.getsize(temp_name)
+        os.replace(temp_name, name)
+        # The file exists now, unique_name sees it without the reservation.
+        release_name(name)
+
+    if item:
+        get_manifest(output_folder).register(stage, path=name, status="done", **item)
+
+    return name
+
+def generate_in_batches(output_folder:str, stage:str, generate, prompts:list, seeds:list, indexes:list, batch_size:int,
+                        params:dict=None, saver=None, length=None) -> list:
+    """ Runs the prompts through generate in batches, skipping the ones the project's manifest has as done.
+        Args:
+            output_folder (str): The folder of the project.
+            stage (str): image, music or speech.
+            generate (function): Takes a batch of (prompt, seed, index) and returns the path of each output.
+            prompts (list): The prompts.
+            seeds (list): A seed for each prompt or None.
+            indexes (list): The index of each prompt in the project or None.
+            batch_size (int): The largest number of prompts generated at once.
+            params (dict): The settings that change the outputs, they are part of the names of the files.
+            saver (BACKGROUND_SAVER): The saver of the generator, the outputs generated before are returned as futures too.
+            length (function): Gets the length of a prompt. The prompts are batched with the ones closest in length,
+                so the shorter ones are padded less.
+        Returns:
+            list: The paths (or their futures) of the outputs in the order of the prompts.
+    """
+    # Imported here as background_saver imports this module.
+    from .background_saver import reuse_output
+
+    items = list(zip(prompts, seeds or [None]*len(prompts), indexes or [None]*len(prompts)))
+    paths = [start_item(output_folder, stage, index, prompt, seed, params) for prompt, seed, index in items]
+
+    missing = [i for i, path in enumerate(paths) if not path]
+    if length:
+        missing.sort(key=lambda i: length(items[i][0]))
+
+    paths = [reuse_output(saver, path) if path else None for path in paths]
+    for i, path in zip(missing, run_in_batches(generate, [items[i] for i in missing], batch_size)):
+        paths[i] = path
+
+    return paths
+
+
+def audio_stream_saver(output_folder:str, stage:str, chunks, sample_rate:int, item:dict=None, on_chunk=None) -> str:
+    """ Writes audio to a wav file chunk by chunk as it's generated, instead of keeping all of it till the end.
+        Like file_saver, it's written to a temporary file which is renamed when it's complete.
+        Args:
+            output_folder (str): The folder of the project.
+            stage (str): speech or music.
+            chunks: An iterable of the audio chunks (numpy arrays or tensors of samples).
+            sample_rate (int): The sample rate of the audio.
+            item (dict): The work item from work_item, the file is named after it and registered in the project's manifest.
+            on_chunk (function): Called with every chunk after it's written, to play the audio while the rest is generated.
+        Returns:
+            str: The path of the file.
+    """
+    os.makedirs(f"{output_folder}/{OUTPUT_FOLDERS[stage]}", exist_ok=True)
+    name = output_path(output_folder, stage, item)
+    temp_name = f"{name[:-len(OUTPUT_EXTENSIONS[stage])]}.partial{OUTPUT_EXTENSIONS[stage]}"
+
+    import soundfile
+    # Only a generator that already loaded torch gives tensors.
+    torch = sys.modules.get("torch")
+
+    with telemetry.span("io", stage) as span:
+        try:
+            with soundfile.SoundFile(temp_name, 'w', samplerate=sample_rate, channels=1) as f:
+                for chunk in chunks:
+                    if torch and isinstance(chunk, torch.Tensor):
+                        chunk = chunk.detach().float().cpu().numpy()
+                    f.write(chunk.reshape(-1))
+                    if on_chunk:
+                        on_chunk(chunk)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            release_name(name)
+            raise
+
+        span["bytes"] = os.path.getsize(temp_name)
+        os.replace(temp_name, name)
+        release_name(name)
+
+    if item:
+        get_manifest(output_folder).register(stage, path=name, status="done", **item)
+
+    return name
+
 
 script = """
 You are Scripter, an AI Agent. Your sole task is to generate a complete, highly structured YouTube video script approximately 10 minutes long, based on the user's topic.
@@ -206,3 +543,50 @@ system_prompts = {"img": image,
                   "dia": dialogue,
                   "music": music,
                   "script": script}
+
+
+def video_stream_saver(output_folder:str, segments, fps:int, item:dict=None) -> str:
+    """ Encodes a video segment by segment as the segments are generated, the memory doesn't grow with the length of the video.
+        Like file_saver, it's written to a temporary file which is renamed when it's complete.
+        Only the writes are recorded as io spans, the segments are generated between them.
+        Args:
+            output_folder (str): The folder of the project.
+            segments: An iterable of the segments, each a list of frames (PIL images or uint8 arrays of height x width x 3).
+            fps (int): The frames per second of the video.
+            item (dict): The work item from work_item, the file is named after it and registered in the project's manifest.
+        Returns:
+            str: The path of the file.
+    """
+    import imageio
+    import numpy as np
+
+    os.makedirs(f"{output_folder}/{OUTPUT_FOLDERS['video']}", exist_ok=True)
+    name = output_path(output_folder, "video", item)
+    temp_name = f"{name[:-len(OUTPUT_EXTENSIONS['video'])]}.partial{OUTPUT_EXTENSIONS['video']}"
+
+    # The ffmpeg writer of imageio, the one export_to_video uses.
+    writer = imageio.get_writer(temp_name, fps=fps)
+    try:
+        for segment in segments:
+            with telemetry.span("io", "video", frames=len(segment)):
+                for frame in segment:
+                    writer.append_data(np.asarray(frame, dtype=np.uint8))
+
+        # Closing waits for ffmpeg to encode the frames it still has.
+        with telemetry.span("io", "video") as span:
+            writer.close()
+            span["bytes"] = os.path.getsize(temp_name)
+    except BaseException:
+        writer.close()
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        release_name(name)
+        raise
+
+    os.replace(temp_name, name)
+    release_name(name)
+
+    if item:
+        get_manifest(output_folder).register("video", path=name, status="done", **item)
+
+    return name
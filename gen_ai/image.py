@@ -1,116 +1,469 @@
 import os
+from contextlib import nullcontext
 import torch
 from diffusers import SanaPipeline, StableDiffusionXLPipeline, EulerAncestralDiscreteScheduler, StableDiffusionXLImg2ImgPipeline
-from .gen_ai_utilities import file_saver, optimize_model
+from .gen_ai_utilities import optimize_model, generate_in_batches, work_item, available_memory, get_device, make_generator, batch_generators
+from .background_saver import save_output
+from .latent_cache import LATENT_CACHE
+from .embedding_cache import encoded_prompts, sdxl_prompt_embeds
+from .weight_cache import weight_cache
+from .step_cache import STEP_CACHE
+from .telemetry import telemetry
+
+
+# Rough bytes the DC-AE decoder of Sana needs per output pixel in bfloat16, its last blocks keep 128 channels at full size.
+SANA_DECODE_BYTES_PER_PIXEL = 1536
+
+# Sana's DC-AE downsamples 32 times, the width and height have to be multiples of it.
+SANA_SIZE_MULTIPLE = 32
+
+# The Sana model SANA_IMAGE loads by default.
+SANA_MODEL_ID = "Efficient-Large-Model/SANA1.5_1.6B_1024px_diffusers"
+
+
+def round_size(size:int, multiple:int) -> int:
+    """ Rounds a width or height to the closest multiple the model accepts.
+    """
+    return max(multiple, round(size / multiple) * multiple)
+
+
+def plan_vae_memory(decode_pixels:int, batch_size:int, bytes_per_pixel:int, free:int, headroom:float=0.8) -> dict:
+    """ Picks the VAE settings that keep the decode of a batch within the free memory.
+        Slicing decodes the images of a batch one at a time, tiling decodes an image in overlapping tiles.
+        Args:
+            decode_pixels (int): The pixels of one decoded image.
+            batch_size (int): The images decoded together.
+            bytes_per_pixel (int): The memory the decoder needs per pixel.
+            free (int): The free bytes where the VAE runs, None if it isn't known (nothing is enabled then).
+            headroom (float): The part of the free memory the decode can use.
+        Returns:
+            dict: The estimate and the choices, vae_slicing and vae_tiling.
+    """
+    image_bytes = decode_pixels * bytes_per_pixel
+    budget = free * headroom if free else None
+
+    slicing = bool(budget) and batch_size > 1 and image_bytes * batch_size > budget
+    tiling = bool(budget) and image_bytes > budget
+
+    return {"decode_bytes": image_bytes * (1 if slicing else batch_size),
+            "free_bytes": free,
+            "vae_slicing": slicing,
+            "vae_tiling": tiling}
 
 
 class SANA_IMAGE:
     """ A class that uses Sana 1.5 1.6B model to generate images.
     """
-    def __init__(self, output_folder: str):
+    def __init__(self, output_folder: str, registry=None, saver=None, model_id: str = SANA_MODEL_ID,
+                 device: str = None):
         """ Initialize the SanaPipeline
             Args:
                 output_folder (str): The location to store the generated images.
+                registry (MODEL_REGISTRY): Loads the model on first use and shares it, else it's loaded right away.
+                saver (BACKGROUND_SAVER): Saves the files in the background, the generate functions then return futures of the paths.
+                model_id (str): The Sana model, like Efficient-Large-Model/Sana_1600M_4Kpx_BF16_diffusers for native 4K images.
+                device (str): The device the model runs on, like cuda:1 or cpu, see get_device.
         """
         self.output_folder = output_folder
-        self.pipe = SanaPipeline.from_pretrained(
-            "Efficient-Large-Model/SANA1.5_1.6B_1024px_diffusers",
+        self.model_id = model_id
+        self.device = get_device(device)
+        self.registry = registry
+        self.saver = saver
+
+        # The settings picked by plan_memory for the last generate_images.
+        self.memory_plan = None
+        # The hits of the step cache in the last generate_images that used it.
+        self.step_cache_stats = None
+
+        if not registry:
+            self._pipe = self.load_pipe()
+
+    @property
+    def pipe(self):
+        """ The SanaPipeline, from the registry if there is one.
+        """
+        if self.registry:
+            return self.registry.get(f"sana:{self.model_id}", self.load_pipe)
+        return self._pipe
+
+    @telemetry.trace("load", "sana")
+    def load_pipe(self):
+        """ Loads the SanaPipeline.
+        """
+        from transformers import Gemma2Model
+
+        # The text encoder in bfloat16 is stored once, later loads map it from the disk instead of casting it again.
+        text_encoder = weight_cache.load(Gemma2Model, self.model_id, "text_encoder", torch.bfloat16)
+        pipe = SanaPipeline.from_pretrained(
+            self.model_id,
+            text_encoder=text_encoder,
             torch_dtype=torch.bfloat16,
         )
-        self.pipe.text_encoder.to(torch.bfloat16)
         
         # This makes the model fit in low VRAM
-        optimize_model(self.pipe)
+        optimize_model(pipe, device=self.device)
+        return pipe
     
-    def generate_image(self, prompt: str, img_size: list = [1920, 1080], seed: int = None) -> str:
+    def generate_image(self, prompt: str, img_size: list = [1920, 1080], seed: int = None, index: int = None, binning: bool = True,
+                       step_cache: float = None) -> str:
         """ Create the image with optional deterministic seed.
             Args:
                 prompt (str): The image prompt.
                 (Optional)
                 img_size (list): The image width and height.
                 seed (int): The manual seed for consistent results.
+                index (int): The index of the prompt in the project, the image is recorded in the manifest and reused on a rerun.
+                binning (bool): Generates the trained size closest to img_size and resizes it, see generate_images.
+                step_cache (float): The threshold of the step cache, see generate_images.
             Return:
                 (str): The path of the generated image.
         """
-        image = self.pipe(
-            prompt=prompt,
-            width=img_size[0],
-            height=img_size[1],
-            # guidance_scale=4.5,
-            num_inference_steps=25,
-            **({"generator":torch.Generator("cuda").manual_seed(seed)} if seed else {})
-        )[0]
+        return self.generate_images([prompt], img_size=img_size, seeds=[seed] if seed is not None else None,
+                                    indexes=None if index is None else [index], binning=binning, step_cache=step_cache)[0]
+
+    def plan_memory(self, img_size: list, batch_size: int, binning: bool = True) -> dict:
+        """ Plans the decode of a batch of images so it fits in the free memory, and applies it to the pipe.
+            The VAE decode at full size is the peak of the memory, it's sliced (one image at a time) and tiled when it wouldn't fit.
+            Args:
+                img_size (list): The image width and height.
+                batch_size (int): The images generated together.
+                binning (bool): If the pipeline generates the closest trained size and resizes it to img_size.
+            Returns:
+                dict: The plan, it's kept in memory_plan as well.
+        """
+        pipe = self.pipe
+        width, height = img_size
+        if binning:
+            # The trained sizes are about sample_size * 32 pixels on each side.
+            side = pipe.transformer.config.sample_size * pipe.vae_scale_factor
+            decode_pixels = side * side
+        else:
+            width, height = round_size(width, SANA_SIZE_MULTIPLE), round_size(height, SANA_SIZE_MULTIPLE)
+            decode_pixels = width * height
+
+        free = available_memory()
+        # The offloaded VAE decodes on the GPU if there is one.
+        plan = plan_vae_memory(decode_pixels, batch_size, SANA_DECODE_BYTES_PER_PIXEL, free["cuda"] or free["cpu"])
+
+        if plan["vae_slicing"]:
+            pipe.vae.enable_slicing()
+        else:
+            pipe.vae.disable_slicing()
+        if plan["vae_tiling"]:
+            pipe.vae.enable_tiling()
+        else:
+            pipe.vae.disable_tiling()
+
+        self.memory_plan = {"img_size": [width, height], "requested_size": list(img_size), "binning": binning,
+                            "batch_size": batch_size, "decode_pixels": decode_pixels, **plan}
+        return self.memory_plan
 
-        return file_saver(self.output_folder, image=image[0])
+    def generate_images(self, prompts: list, img_size: list = [1920, 1080], seeds: list = None, batch_size: int = 4, indexes: list = None,
+                        binning: bool = True, step_cache: float = None) -> list:
+        """ Create the images in batches, every prompt gets its own image.
+            Args:
+                prompts (list): The image prompts.
+                (Optional)
+                img_size (list): The image width and height.
+                seeds (list): A manual seed for each prompt for consistent results.
+                batch_size (int): The number of prompts generated at once, it's reduced if the GPU runs out of memory.
+                indexes (list): The index of each prompt in the project, the images are recorded in the manifest and reused on a rerun.
+                binning (bool): Generates the trained size closest to img_size and resizes it, else img_size (rounded to a multiple of 32)
+                    is generated as it is, use it with a model trained at that size like the 4K Sana.
+                step_cache (float): Skips the transformer blocks at the steps where they would change little when the first block
+                    changed less than this (like 0.05), see STEP_CACHE. The hits are in step_cache_stats.
+            Return:
+                (list): The paths of the generated images in the order of the prompts.
+        """
+        size = list(img_size) if binning else [round_size(side, SANA_SIZE_MULTIPLE) for side in img_size]
+        params = {"img_size": size, "steps": 25}
+        if not binning:
+            params["binning"] = False
+        if step_cache is not None:
+            params["step_cache"] = step_cache
+        # The outputs of another checkpoint (like the 4K one) aren't reused, the names of the default one stay the same.
+        if self.model_id != SANA_MODEL_ID:
+            params["model_id"] = self.model_id
+        # One cache for all the batches, its stats add up.
+        cache = STEP_CACHE(step_cache) if step_cache is not None else None
+
+        def generate(batch):
+            # Get the pipe first, so loading it isn't counted as inference.
+            pipe = self.pipe
+            self.plan_memory(img_size, len(batch), binning)
+            with telemetry.span("inference", "sana", images=len(batch), steps=25) as span, \
+                 (cache.attach(pipe.transformer) if cache else nullcontext()):
+                images = pipe(
+                    **encoded_prompts(pipe, f"sana:{self.model_id}", "sana", [prompt for prompt, _, _ in batch]),
+                    width=size[0],
+                    height=size[1],
+                    # guidance_scale=4.5,
+                    num_inference_steps=25,
+                    use_resolution_binning=binning,
+                    **batch_generators(self.device, [seed for _, seed, _ in batch])
+                )[0]
+                if cache:
+                    self.step_cache_stats = span["step_cache"] = cache.stats()
+            return [save_output(self.saver, self.output_folder, image=image, item=work_item(index, prompt, seed, params))
+                    for image, (prompt, seed, index) in zip(images, batch)]
+
+        return generate_in_batches(self.output_folder, "image", generate, prompts, seeds, indexes, batch_size, params, self.saver)
+
+
+# The quality modes of SDXL_IMAGE.
+# base generates with the base alone, refine hands the last steps of the base to the refiner (the refiner is loaded with the base),
+# on_demand generates like base and loads the refiner only when refine_images is called.
+SDXL_QUALITY_MODES = ["base", "refine", "on_demand"]
+
+
+def decode_latents(pipe, latents:torch.Tensor) -> list:
+    """ Decodes the latents of an SDXL pipeline to images, the same way the pipeline does with output_type="pil".
+        Args:
+            pipe (StableDiffusionXLPipeline): The pipeline that made the latents.
+            latents (torch.Tensor): The batch of latents.
+        Returns:
+            list: The PIL images.
+    """
+    vae = pipe.vae
+    # The fp16 SDXL VAE overflows, the pipeline decodes in fp32.
+    upcast = vae.dtype == torch.float16 and vae.config.force_upcast
+    if upcast:
+        pipe.upcast_vae()
+    latents = latents.to(dtype=next(iter(vae.post_quant_conv.parameters())).dtype)
+
+    with torch.no_grad():
+        images = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+
+    if upcast:
+        vae.to(dtype=torch.float16)
+    return pipe.image_processor.postprocess(images, output_type="pil")
 
 
 class SDXL_IMAGE:
     """ A class to generate images using SDXL.
     """
-    def __init__(self, output_folder:str, lora_path:str=None):
+    def __init__(self, output_folder:str, lora_path:str=None, registry=None, saver=None, quality:str="refine", use_cache:bool=True,
+                 device:str=None):
         """ Initialize the base and refiner.
             Args:
                 output_folder (str): The location to store the generated images.
                 lora_path (str): The SDXL LoRA you want to add.
+                registry (MODEL_REGISTRY): Loads the models on first use and shares them, else they are loaded right away.
+                saver (BACKGROUND_SAVER): Saves the files in the background, the generate functions then return futures of the paths.
+                quality (str): base, refine or on_demand, see SDXL_QUALITY_MODES. Without a registry the refiner is loaded right away only with refine.
+                use_cache (bool): Store the latents of the base for the images with a seed, so they can be refined later without the base.
+                device (str): The device the models run on, like cuda:1 or cpu, see get_device.
         """
+        if quality not in SDXL_QUALITY_MODES:
+            raise ValueError(f"Unknown quality {quality}, it can be one of {SDXL_QUALITY_MODES}")
+
         self.output_folder = output_folder
-        # Load SDXL base
-        self.base = StableDiffusionXLPipeline.from_pretrained(
+        self.lora_path = lora_path
+        self.registry = registry
+        self.saver = saver
+        self.quality = quality
+        self.device = get_device(device)
+        self.latent_cache = LATENT_CACHE() if use_cache else None
+
+        # Inference settings
+        self.n_steps = 40
+        self.high_noise_frac = 0.8
+
+        self._refiner = None
+        if not registry:
+            self._base = self.load_base()
+            if quality == "refine":
+                self._refiner = self.load_refiner()
+
+    @property
+    def base(self):
+        """ The SDXL base, from the registry if there is one.
+        """
+        if self.registry:
+            # The LoRA is loaded into the base, so each LoRA is a different model.
+            return self.registry.get(f"sdxl_base:{self.lora_path}", self.load_base)
+        return self._base
+
+    @property
+    def refiner(self):
+        """ The SDXL refiner, from the registry if there is one. It's loaded on first use with base and on_demand,
+            generate_images doesn't use it with those, only refine_images does.
+        """
+        if self.registry:
+            return self.registry.get("sdxl_refiner", self.load_refiner)
+        if self._refiner is None:
+            self._refiner = self.load_refiner()
+        return self._refiner
+
+    @telemetry.trace("load", "sdxl_base")
+    def load_base(self):
+        """ Loads the SDXL base and the LoRA.
+        """
+        base = StableDiffusionXLPipeline.from_pretrained(
             "stabilityai/stable-diffusion-xl-base-1.0",
             torch_dtype=torch.float16,
             variant="fp16",
             use_safetensors=True
         )
-        self.base.scheduler = EulerAncestralDiscreteScheduler.from_config(self.base.scheduler.config)
+        base.scheduler = EulerAncestralDiscreteScheduler.from_config(base.scheduler.config)
 
-        optimize_model(self.base)
+        optimize_model(base, device=self.device)
 
-        if lora_path:
-            if os.path.exists(lora_path):
-                self.base.load_lora_weights(lora_path, adapter_name="lora")
-                self.base.set_adapters(["lora"])
+        if self.lora_path:
+            if os.path.exists(self.lora_path):
+                base.load_lora_weights(self.lora_path, adapter_name="lora")
+                base.set_adapters(["lora"])
             else:
                 print("LoRA path doesn't exist.")
+        return base
 
-        # Load SDXL refiner 
-        self.refiner = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+    @telemetry.trace("load", "sdxl_refiner")
+    def load_refiner(self):
+        """ Loads the SDXL refiner.
+        """
+        refiner = StableDiffusionXLImg2ImgPipeline.from_pretrained(
             "stabilityai/stable-diffusion-xl-refiner-1.0",
             torch_dtype=torch.float16,
             use_safetensors=True,
             variant="fp16",
         )
-        self.refiner.scheduler = EulerAncestralDiscreteScheduler.from_config(self.refiner.scheduler.config)
+        refiner.scheduler = EulerAncestralDiscreteScheduler.from_config(refiner.scheduler.config)
         
-        optimize_model(self.refiner)
+        optimize_model(refiner, device=self.device)
+        return refiner
+
+    def base_latents(self, batch:list, denoising_end:float=None) -> torch.Tensor:
+        """ Runs the base for a batch, the latents of the items with a seed are read from the cache when they were made before.
+            Args:
+                batch (list): The (prompt, seed, index) of every image.
+                denoising_end (float): The part of the steps the base runs, None runs all of them.
+            Returns:
+                torch.Tensor: The latents of the batch in its order.
+        """
+        params = {"steps": self.n_steps, "denoising_end": denoising_end}
+        model = f"sdxl_base:{self.lora_path}"
+        keys = [LATENT_CACHE.make_key(model, prompt, seed, params) if self.latent_cache and seed is not None else None
+                for prompt, seed, _ in batch]
+
+        latents = [self.latent_cache.get(key) if key else None for key in keys]
+        missing = [i for i, latent in enumerate(latents) if latent is None]
+        if missing:
+            base = self.base
+            seeds = [batch[i][1] for i in missing]
+            with telemetry.span("inference", "sdxl_base", images=len(missing), steps=self.n_steps):
+                generated = base(
+                    **sdxl_prompt_embeds(base, model, [batch[i][0] for i in missing]),
+                    num_inference_steps=self.n_steps,
+                    denoising_end=denoising_end,
+                    output_type="latent",
+                    # Every seeded latent comes from its own generator, even in a batch with unseeded ones.
+                    **batch_generators(self.device, seeds)
+                ).images
+
+            for i, latent in zip(missing, generated):
+                latents[i] = latent.cpu()
+                if keys[i]:
+                    self.latent_cache.put(keys[i], latent)
+
+        return torch.stack(latents)
+
+    def refiner_prompt_embeds(self, refiner, prompts:list) -> dict:
+        """ Gets the prompt embeddings of the refiner, from the ones of the base when it encoded the prompts.
+            A LoRA can change the text encoders of the base, then the refiner encodes the prompts itself.
+        """
+        return sdxl_prompt_embeds(refiner, "sdxl_refiner", prompts, base_model=None if self.lora_path else "sdxl_base:None")
     
-    def generate_image(self, prompt:str) -> str:
-        """ This function generated the image and refines it as well.
+    def generate_image(self, prompt:str, seed:int=None, index:int=None) -> str:
+        """ This function generated the image and refines it as well with the refine quality.
             Args:
                 prompt (str): The prompt to generate the image.
+                (Optional)
+                seed (int): The manual seed for consistent results.
+                index (int): The index of the prompt in the project, the image is recorded in the manifest and reused on a rerun.
             Returns:
                 str: The path of the file generated.
         """
-        # Inference settings
-        n_steps = 40
-        high_noise_frac = 0.8
-
-        # Step 1: Generate latent image with base
-        latents = self.base(
-            prompt=prompt,
-            num_inference_steps=n_steps,
-            denoising_end=high_noise_frac,
-            output_type="latent"
-        ).images
-
-        # Step 2: Refine image
-        image = self.refiner(
-            prompt=prompt,
-            num_inference_steps=n_steps,
-            denoising_start=high_noise_frac,
-            image=latents
-        ).images[0]
-
-        return file_saver(self.output_folder, image=image)
+        return self.generate_images([prompt], seeds=[seed] if seed is not None else None, indexes=None if index is None else [index])[0]
+
+    def generate_images(self, prompts:list, seeds:list=None, batch_size:int=4, indexes:list=None) -> list:
+        """ Generates the images in batches, every prompt gets its own image. They are refined as well with the refine quality.
+            Args:
+                prompts (list): The prompts to generate the images.
+                (Optional)
+                seeds (list): A manual seed for each prompt for consistent results.
+                batch_size (int): The number of prompts generated at once, it's reduced if the GPU runs out of memory.
+                indexes (list): The index of each prompt in the project, the images are recorded in the manifest and reused on a rerun.
+            Returns:
+                list: The paths of the files generated in the order of the prompts.
+        """
+        refine = self.quality == "refine"
+        if refine:
+            params = {"steps": self.n_steps, "high_noise_frac": self.high_noise_frac, "lora": self.lora_path}
+        else:
+            params = {"steps": self.n_steps, "lora": self.lora_path, "quality": "base"}
+
+        def generate(batch):
+            if not refine:
+                latents = self.base_latents(batch)
+                with telemetry.span("inference", "sdxl_decode", images=len(batch)):
+                    images = decode_latents(self.base, latents)
+                return [save_output(self.saver, self.output_folder, image=image, item=work_item(index, line, seed, params))
+                        for image, (line, seed, index) in zip(images, batch)]
+
+            # Step 1: Generate latent image with base
+            latents = self.base_latents(batch, denoising_end=self.high_noise_frac)
+
+            # Step 2: Refine image
+            refiner = self.refiner
+            with telemetry.span("inference", "sdxl_refiner", images=len(batch), steps=self.n_steps):
+                images = refiner(
+                    **self.refiner_prompt_embeds(refiner, [prompt for prompt, _, _ in batch]),
+                    num_inference_steps=self.n_steps,
+                    denoising_start=self.high_noise_frac,
+                    image=latents,
+                    **batch_generators(self.device, [seed for _, seed, _ in batch])
+                ).images
+
+            return [save_output(self.saver, self.output_folder, image=image, item=work_item(index, line, seed, params))
+                    for image, (line, seed, index) in zip(images, batch)]
+
+        return generate_in_batches(self.output_folder, "image", generate, prompts, seeds, indexes, batch_size, params, self.saver)
+
+    def refine_images(self, prompts:list, seeds:list, strength:float=0.3, batch_size:int=4, indexes:list=None) -> list:
+        """ Refines the images made by generate_images with the base or on_demand quality, the refiner is loaded on the first call.
+            The latents of the base are read from the cache, so only the refiner runs and the same images can be refined
+            again at another strength. The refined image takes the place of the draft in the manifest.
+            Args:
+                prompts (list): The prompts of the images.
+                seeds (list): The seeds the images were generated with.
+                (Optional)
+                strength (float): How much the refiner changes the image, the part of the steps it runs from 0 to 1.
+                batch_size (int): The number of prompts refined at once, it's reduced if the GPU runs out of memory.
+                indexes (list): The index of each prompt in the project, the images are recorded in the manifest and reused on a rerun.
+            Returns:
+                list: The paths of the refined images in the order of the prompts.
+        """
+        if not seeds or None in seeds:
+            raise ValueError("The latents of the base are found by their seeds, every prompt needs its seed.")
+        params = {"steps": self.n_steps, "lora": self.lora_path, "refine_strength": strength}
+
+        def generate(batch):
+            latents = self.base_latents(batch)
+
+            refiner = self.refiner
+            with telemetry.span("inference", "sdxl_refiner", images=len(batch), steps=round(self.n_steps * strength)):
+                images = refiner(
+                    **self.refiner_prompt_embeds(refiner, [prompt for prompt, _, _ in batch]),
+                    num_inference_steps=self.n_steps,
+                    strength=strength,
+                    image=latents,
+                    generator=[make_generator(self.device, seed) for _, seed, _ in batch]
+                ).images
+
+            return [save_output(self.saver, self.output_folder, image=image, item=work_item(index, line, seed, params))
+                    for image, (line, seed, index) in zip(images, batch)]
+
+        return generate_in_batches(self.output_folder, "image", generate, prompts, seeds, indexes, batch_size, params, self.saver)
 
     
 if __name__=="__main__":
@@ -121,6 +474,7 @@ if __name__=="__main__":
 
     del obj
 
-    obj = SDXL_IMG("outputs")
+    obj = SDXL_IMAGE("outputs")
     obj.generate_image(prompt)
+    obj.generate_images([prompt, prompt], seeds=[1, 2])
 
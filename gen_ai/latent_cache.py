@@ -0,0 +1,59 @@
+import json
+import hashlib
+
+import torch
+
+from .disk_cache import DISK_CACHE
+
+
+class LATENT_CACHE(DISK_CACHE):
+    """ A content addressed disk cache for the latents of a diffusion model, like the output of the SDXL base.
+        The same prompt, seed and settings always give the same latents, so those are hashed into the key and a stored
+        latent can be refined again, at another strength, without running the base.
+    """
+    extension = ".pt"
+    read_errors = (OSError, RuntimeError, EOFError)
+
+    def __init__(self, cache_folder:str="outputs/.cache/latents", max_size_mb:int=512):
+        """ Initialize the cache folder.
+            Args:
+                cache_folder (str): The folder where the latents are stored, one .pt file per image.
+                max_size_mb (int): The size of the folder after which the least recently used latents are removed.
+        """
+        # The background saver and the worker can use it from other threads.
+        super().__init__(cache_folder, max_size_mb)
+
+    @staticmethod
+    def make_key(model:str, prompt:str, seed:int, params:dict) -> str:
+        """ Creates the key of a latent.
+            Args:
+                model (str): The model that made the latent, with its LoRA.
+                prompt (str): The prompt.
+                seed (int): The seed, a latent without one can't be made again and isn't stored.
+                params (dict): The settings that change the latent, like the steps.
+            Returns:
+                str: The sha256 of the request.
+        """
+        request = json.dumps({"model": model, "prompt": prompt, "seed": seed, "params": params}, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key:str) -> torch.Tensor:
+        """ Gets a stored latent.
+            Args:
+                key (str): The key from make_key.
+            Returns:
+                torch.Tensor: The latent on the CPU, None if it's not stored.
+        """
+        return self.read(key, lambda name: torch.load(name, map_location="cpu", weights_only=True))
+
+    def put(self, key:str, latent:torch.Tensor):
+        """ Stores a latent and removes the old ones if the cache is too big.
+            Args:
+                key (str): The key from make_key.
+                latent (torch.Tensor): The latent of one image.
+        """
+        def save(name):
+            with open(name, 'wb') as f:
+                torch.save(latent.detach().cpu().clone(), f)
+
+        self.write(key, save)
@@ -0,0 +1,59 @@
+import json
+import hashlib
+
+from .disk_cache import DISK_CACHE
+
+
+class LLM_CACHE(DISK_CACHE):
+    """ A content addressed disk cache for the LLM responses.
+        Ollama gives the same answer for the same model, prompts, seed and options, so those are hashed into the key.
+    """
+    extension = ".json"
+    read_errors = (OSError, ValueError, KeyError)
+
+    def __init__(self, cache_folder:str="outputs/.cache/llm", max_size_mb:int=64):
+        """ Initialize the cache folder.
+            Args:
+                cache_folder (str): The folder where the responses are stored, one json file per response.
+                max_size_mb (int): The size of the folder after which the least recently used responses are removed.
+        """
+        # The detailer calls it from several threads at once.
+        super().__init__(cache_folder, max_size_mb)
+
+    @staticmethod
+    def make_key(model:str, messages:list, options:dict) -> str:
+        """ Creates the key of a request.
+            Args:
+                model (str): The Ollama model name.
+                messages (list): The chat messages, system prompt and user input.
+                options (dict): The options passed to Ollama, it has the seed as well.
+            Returns:
+                str: The sha256 of the request.
+        """
+        request = json.dumps({"model": model, "messages": messages, "options": options}, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key:str) -> str:
+        """ Gets a stored response.
+            Args:
+                key (str): The key from make_key.
+            Returns:
+                str: The response, None if it's not stored.
+        """
+        def load(name):
+            with open(name, 'r', encoding="utf-8") as f:
+                return json.load(f)["content"]
+
+        return self.read(key, load)
+
+    def put(self, key:str, content:str):
+        """ Stores a response and removes the old ones if the cache is too big.
+            Args:
+                key (str): The key from make_key.
+                content (str): The response to store.
+        """
+        def save(name):
+            with open(name, 'w', encoding="utf-8") as f:
+                json.dump({"content": content}, f)
+
+        self.write(key, save)
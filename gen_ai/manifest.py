@@ -0,0 +1,182 @@
+import os
+import json
+import glob
+import hashlib
+import threading
+
+
+# Set in the worker processes of run_sharded, they write the items they change to manifest.<shard>.journal.jsonl instead
+# of the journal of the project, so they don't write over each other. The parent merges them with merge_shards.
+manifest_shard = None
+
+
+def set_manifest_shard(shard:str):
+    """ Makes the manifests of this process write to manifest.<shard>.journal.jsonl, see merge_shards.
+    """
+    global manifest_shard
+    manifest_shard = shard
+
+
+def file_hash(path:str) -> str:
+    """ Gets the sha256 of a file.
+        Args:
+            path (str): The file.
+        Returns:
+            str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PROJECT_MANIFEST:
+    """ Records every work item of a project in manifest.json inside the output folder.
+        An item is a line of the script given to a generator, the manifest keeps its input, seed, settings, output file,
+        status and the hash of the output, so a resumed run only generates the items that are missing.
+        Every change is appended to manifest.journal.jsonl, which is folded into manifest.json once it has as many
+        lines as the manifest has items, so a stage of N items doesn't write the whole manifest N times.
+    """
+    # The journal is folded in after at least this many changes.
+    MIN_JOURNAL_LINES = 64
+
+    def __init__(self, output_folder:str):
+        """ Loads the manifest of a project, it's created if it doesn't exist yet.
+            Args:
+                output_folder (str): The folder of the project from initialize_project.
+        """
+        self.path = os.path.join(output_folder, "manifest.json")
+        self.journal_path = os.path.join(output_folder, "manifest.journal.jsonl")
+        # A shard only appends to its own journal, merge_shards adds it to the manifest.
+        self.shard_journal_path = os.path.join(output_folder, f"manifest.{manifest_shard}.journal.jsonl") if manifest_shard else None
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding="utf-8") as f:
+                self.items = json.load(f)["items"]
+        else:
+            self.items = {}
+        self.journal_lines = self.replay(self.journal_path)
+        # The journal of an earlier run is folded in, its last line can be cut off by a crash and the next changes
+        # would continue it. The shards leave the files of the project to the parent.
+        if self.journal_lines and not self.shard_journal_path:
+            self.save()
+
+    def replay(self, path:str) -> int:
+        """ Applies the changes of a journal to the items.
+            Returns:
+                int: The number of changes, 0 if the journal doesn't exist.
+        """
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r', encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # The last line of a crashed run can be half written.
+                    continue
+                self.items[f"{item['stage']}:{item['index']}"] = item
+                count += 1
+        return count
+
+    def save(self):
+        """ Writes the manifest to a temporary file and renames it, so it's never half written, then empties the journal.
+            Called with the lock held.
+        """
+        with open(f"{self.path}.tmp", 'w', encoding="utf-8") as f:
+            json.dump({"items": self.items}, f, indent=4)
+        os.replace(f"{self.path}.tmp", self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_lines = 0
+
+    def merge_shards(self):
+        """ Adds the items the worker processes wrote to their manifest.<shard>.journal.jsonl and removes those files.
+        """
+        with self.lock:
+            folder = glob.escape(os.path.dirname(self.path))
+            shards = glob.glob(os.path.join(folder, "manifest.*.journal.jsonl"))
+            for path in shards:
+                self.replay(path)
+            if shards or self.journal_lines:
+                self.save()
+            for path in shards:
+                os.remove(path)
+
+    def register(self, stage:str, index:int, line:str, seed:int=None, params:dict=None, path:str=None, status:str="running"):
+        """ Adds or updates a work item.
+            Args:
+                stage (str): script, image, speech, music or video.
+                index (int): The index of the item in its stage.
+                line (str): The prompt given to the generator.
+                seed (int): The seed given to the generator.
+                params (dict): The other settings of the generator that change the output, like the image size.
+                path (str): The generated file.
+                status (str): running till the output is saved, then done.
+        """
+        item = {"stage": stage,
+                "index": index,
+                "line": line,
+                "seed": seed,
+                "params": params,
+                "path": path,
+                "status": status,
+                "hash": file_hash(path) if path and status == "done" else None}
+        with self.lock:
+            self.items[f"{stage}:{index}"] = item
+            # One line per change, a crash keeps everything registered before it.
+            with open(self.shard_journal_path or self.journal_path, 'a', encoding="utf-8") as f:
+                f.write(json.dumps(item) + "\n")
+            if self.shard_journal_path:
+                return
+            self.journal_lines += 1
+            if self.journal_lines >= max(self.MIN_JOURNAL_LINES, len(self.items)):
+                self.save()
+
+    def completed(self, stage:str, index:int, line:str, seed:int=None, params:dict=None) -> str:
+        """ Checks if an item was already generated with the same input, seed and settings, and its output is still intact.
+            Args:
+                stage (str): script, image, speech, music or video.
+                index (int): The index of the item in its stage.
+                line (str): The prompt given to the generator.
+                seed (int): The seed given to the generator.
+                params (dict): The other settings of the generator that change the output.
+            Returns:
+                str: The path of the generated file, None if it has to be generated.
+        """
+        item = self.items.get(f"{stage}:{index}")
+        if not item or item["status"] != "done" or item["line"] != line or item["seed"] != seed or item.get("params") != params:
+            return None
+        if not os.path.exists(item["path"]) or file_hash(item["path"]) != item["hash"]:
+            return None
+        return item["path"]
+
+    def pending(self) -> list:
+        """ Gets the items that were started but never saved, like the ones running when a generator crashed.
+            Returns:
+                list: The items.
+        """
+        return [item for item in self.items.values() if item["status"] != "done"]
+
+
+# One manifest per project, the generators of a project share it.
+manifests = {}
+manifests_lock = threading.Lock()
+
+
+def get_manifest(output_folder:str) -> PROJECT_MANIFEST:
+    """ Gets the manifest of a project.
+        Args:
+            output_folder (str): The folder of the project.
+        Returns:
+            PROJECT_MANIFEST: The manifest shared by every generator of the project.
+    """
+    key = os.path.abspath(output_folder)
+    with manifests_lock:
+        if key not in manifests:
+            manifests[key] = PROJECT_MANIFEST(output_folder)
+        return manifests[key]
+
@@ -1,27 +1,161 @@
-from transformers import pipeline
-from .gen_ai_utilities import file_saver
+import numpy as np
+from transformers import pipeline, AutoProcessor
+from .gen_ai_utilities import start_item, work_item, audio_stream_saver, generate_in_batches, get_device
+from .background_saver import save_output, reuse_output
+from .telemetry import telemetry
 
 
 class GEN_MUSIC:
     """ Generates music based on a prompt.
     """
-    def __init__(self, output_folder:str):
+    def __init__(self, output_folder:str, registry=None, saver=None, device:str=None):
+        """ Initialize the text-to-audio pipeline.
+            Args:
+                output_folder (str): The location to store the generated music.
+                registry (MODEL_REGISTRY): Loads the model on first use and shares it, else it's loaded right away.
+                saver (BACKGROUND_SAVER): Saves the files in the background, the generate functions then return futures of the paths.
+                device (str): The device the model runs on, like cuda:1 or cpu, see get_device.
+        """
         self.output_folder = output_folder
-        self.synthesiser = pipeline("text-to-audio", "facebook/musicgen-small", device="cuda")
+        self.device = get_device(device)
+        self.registry = registry
+        self.saver = saver
+        if not registry:
+            self._synthesiser = self.load_synthesiser()
+
+    @property
+    def synthesiser(self):
+        """ The text-to-audio pipeline, from the registry if there is one.
+        """
+        if self.registry:
+            return self.registry.get("musicgen_small", self.load_synthesiser)
+        return self._synthesiser
+
+    @telemetry.trace("load", "musicgen_small")
+    def load_synthesiser(self):
+        """ Loads Musicgen Small.
+        """
+        synthesiser = pipeline("text-to-audio", "facebook/musicgen-small", device=self.device)
+
+        # The processor encodes the audio prompts of generate_long_music, older pipelines don't load it.
+        if getattr(synthesiser, "processor", None) is None:
+            synthesiser.processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
+        return synthesiser
     
-    def generate_music(self, prompt) -> str:
+    def generate_music(self, prompt, index:int=None) -> str:
         """ Creates music based on a prompt.
             Args:
                 user_prompt (str): The prompt passed by the user.
+                (Optional)
+                index (int): The index of the prompt in the project, the music is recorded in the manifest and reused on a rerun.
+            Returns:
+                str: The path to the generated music.
+        """
+        done = start_item(self.output_folder, "music", index, prompt)
+        if done:
+            return reuse_output(self.saver, done)
+
+        synthesiser = self.synthesiser
+        with telemetry.span("inference", "musicgen_small") as span:
+            music = synthesiser(prompt, forward_params={"do_sample": True})
+            span["audio_seconds"] = music["audio"].shape[-1] / music["sampling_rate"]
+
+        return save_output(self.saver, self.output_folder, music=music, item=work_item(index, prompt))
+
+    def generate_music_batch(self, prompts:list, batch_size:int=8, indexes:list=None) -> list:
+        """ Creates the music of many prompts, batch_size prompts are generated in one forward pass.
+            The prompts are grouped with the ones closest in length, so the text is padded as little as possible.
+            Args:
+                prompts (list): The prompts, like the lines of music.txt.
+                (Optional)
+                batch_size (int): The number of prompts generated at once, it's reduced if the GPU runs out of memory.
+                indexes (list): The index of each prompt in the project, the music is recorded in the manifest and reused on a rerun.
+            Returns:
+                list: The paths (or their futures with a saver) of the generated music in the order of the prompts.
+        """
+        def generate(batch):
+            synthesiser = self.synthesiser
+            with telemetry.span("inference", "musicgen_small", prompts=len(batch)) as span:
+                music = synthesiser([prompt for prompt, _, _ in batch], forward_params={"do_sample": True}, batch_size=len(batch))
+                span["audio_seconds"] = sum(output["audio"].shape[-1] / output["sampling_rate"] for output in music)
+            return [save_output(self.saver, self.output_folder, music=output, item=work_item(index, prompt))
+                    for output, (prompt, _, index) in zip(music, batch)]
+
+        # The words are close enough to the tokens, and counting them doesn't need the model loaded.
+        return generate_in_batches(self.output_folder, "music", generate, prompts, None, indexes, batch_size,
+                                   saver=self.saver, length=lambda prompt: len(prompt.split()))
+
+    def generate_long_music(self, prompt:str, duration:float=600, window:float=30, overlap:float=10, crossfade:float=2,
+                            index:int=None, on_chunk=None) -> str:
+        """ Creates music of any length. Musicgen generates a window at a time, each window continues the last seconds
+            of the one before it (they are passed to Musicgen as an audio prompt) and the windows are crossfaded.
+            Every window is written to the wav file as soon as it's generated, only the overlap is kept in memory.
+            Args:
+                prompt (str): The prompt passed by the user.
+                (Optional)
+                duration (float): The seconds of music to generate.
+                window (float): The seconds generated at once including the overlap, Musicgen is trained on 30 second clips.
+                overlap (float): The seconds at the end of a window the next one continues.
+                crossfade (float): The seconds over which the end of a window fades into the start of the next one.
+                index (int): The index of the prompt in the project, the music is recorded in the manifest and reused on a rerun.
+                on_chunk (function): Called with the audio (a numpy array) of every window after it's written.
             Returns:
                 str: The path to the generated music.
         """
-        music = self.synthesiser(prompt, forward_params={"do_sample": True})
+        if not 0 < crossfade <= overlap < window:
+            raise ValueError("The windows need 0 < crossfade <= overlap < window.")
+
+        params = {"duration": duration, "window": window, "overlap": overlap, "crossfade": crossfade}
+        done = start_item(self.output_folder, "music", index, prompt, params=params)
+        if done:
+            return reuse_output(self.saver, done)
+
+        synthesiser = self.synthesiser
+        model, processor = synthesiser.model, synthesiser.processor
+        sampling_rate = model.config.audio_encoder.sampling_rate
+        frame_rate = model.config.audio_encoder.frame_rate
+
+        overlap_samples = int(overlap * sampling_rate)
+        crossfade_samples = int(crossfade * sampling_rate)
+        fade_in = np.linspace(0, 1, crossfade_samples, dtype=np.float32)
+
+        def generate(seconds, tail=None):
+            # The output starts with the audio prompt decoded again, followed by the continuation.
+            if tail is None:
+                inputs = processor(text=[prompt], padding=True, return_tensors="pt")
+            else:
+                inputs = processor(audio=[tail], sampling_rate=sampling_rate, text=[prompt], padding=True, return_tensors="pt")
+            with telemetry.span("inference", "musicgen_small", audio_seconds=seconds):
+                audio = model.generate(**inputs.to(model.device), do_sample=True, max_new_tokens=int(seconds * frame_rate))
+            return audio[0, 0].float().cpu().numpy()
+
+        def windows():
+            # The end of the last window, its last crossfade seconds are held back till they are faded into the next window.
+            tail = generate(min(window, duration + crossfade))
+            written = 0
+            while True:
+                remaining = duration - written / sampling_rate
+                if remaining <= len(tail) / sampling_rate:
+                    yield tail[:int(remaining * sampling_rate)]
+                    return
+
+                yield tail[:-crossfade_samples]
+                written += len(tail) - crossfade_samples
+                tail = tail[-overlap_samples:]
+
+                # The last window only generates what's left.
+                audio = generate(min(window - overlap, duration - written / sampling_rate), tail)
+                # The held back seconds of the last window are faded out into the same seconds of the new window.
+                start = len(tail) - crossfade_samples
+                faded = tail[start:] * fade_in[::-1] + audio[start:len(tail)] * fade_in
+                tail = np.concatenate([faded, audio[len(tail):]])
 
-        return file_saver(self.output_folder, music=music)
+        return reuse_output(self.saver, audio_stream_saver(self.output_folder, "music", windows(), sampling_rate,
+                                                           item=work_item(index, prompt, params=params), on_chunk=on_chunk))
 
 
 if __name__=="__main__":
     obj = GEN_MUSIC("outputs")
     prompt = "A rising synth is playing an arpeggio with a lot of reverb. It is backed by pads, sub bass line and soft drums. This song is full of synth sounds creating a soothing and adventurous atmosphere. It may be playing at a festival during two songs for a buildup."
-    obj.generate_music(prompt)
\ No newline at end of file
+    obj.generate_music(prompt)
+    obj.generate_long_music(prompt, duration=120)
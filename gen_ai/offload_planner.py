@@ -0,0 +1,307 @@
+""" Plans where every component of a diffusers pipeline lives for a memory budget, and applies the plan.
+    A dry run reads the sizes from the headers of the safetensors files, nothing is loaded:
+        python -m gen_ai.offload_planner Wan-AI/Wan2.1-T2V-1.3B-Diffusers --dtype bfloat16 --vram-gb 8 --ram-gb 32
+"""
+import os
+import json
+import argparse
+from itertools import chain
+
+
+# Where a component can be, from the fastest to the one that takes the least VRAM.
+# resident stays on the device, model_offload is moved to the device while it runs and back to the RAM after (like
+# enable_model_cpu_offload), group_offload moves one block at a time and the next one while it runs, sequential moves
+# one layer at a time (like enable_sequential_cpu_offload), super slow and only used when nothing else fits.
+PLACEMENTS = ["resident", "model_offload", "group_offload", "sequential"]
+
+# The components that run at every step, they are offloaded last.
+DENOISERS = ["transformer", "unet"]
+
+# The components quantized to int8 weights when nothing else fits, like optimize_model(quantize=True).
+QUANTIZABLE = ["text_encoder", "transformer"]
+
+# The bytes of every safetensors dtype.
+SAFETENSORS_BYTES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "F8_E4M3": 1, "F8_E5M2": 1,
+                     "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+
+# The bytes of the dtypes a pipeline can be loaded in, only the floating point tensors are converted.
+DTYPE_BYTES = {"float32": 4, "float16": 2, "bfloat16": 2}
+
+GB = 1024**3
+
+
+def summarize(tensors, library:str=None) -> dict:
+    """ Adds up the tensors of a component.
+        Args:
+            tensors: The (name, bytes, params, linear) of every tensor, linear if it's a 2D weight that int8 quantization converts.
+            library (str): diffusers or transformers, only the diffusers models can be group offloaded.
+        Returns:
+            dict: The bytes, the bytes with int8 weights, the bytes on the device while it's group offloaded
+                (everything outside its largest list of blocks and two of the blocks, the one running and the next one),
+                and the largest tensor, about what's on the device while it's offloaded one layer at a time.
+    """
+    size = 0
+    quantized = 0
+    largest_tensor = 0
+    blocks = {}
+    for name, nbytes, params, linear in tensors:
+        size += nbytes
+        quantized += params if linear else nbytes
+        largest_tensor = max(largest_tensor, nbytes)
+        # The blocks are in a numbered list right under the model, like transformer_blocks.3.attn1.to_q.weight,
+        # group offloading doesn't look for the lists deeper in the model.
+        parts = name.split(".")
+        if len(parts) > 2 and parts[1].isdigit():
+            blocks.setdefault(parts[0], {}).setdefault(parts[1], 0)
+            blocks[parts[0]][parts[1]] += nbytes
+
+    group = None
+    if blocks and library == "diffusers":
+        largest = max(blocks.values(), key=lambda sizes: sum(sizes.values()))
+        group = size - sum(largest.values()) + 2 * max(largest.values())
+
+    return {"bytes": size, "quantized_bytes": quantized, "group_bytes": group, "leaf_bytes": largest_tensor, "quantizable": True}
+
+
+def pipe_components(pipe) -> dict:
+    """ Measures the components of a loaded pipeline.
+        Returns:
+            dict: The summary of every torch module of the pipeline, see summarize.
+    """
+    import torch
+
+    components = {}
+    for name, module in pipe.components.items():
+        if not isinstance(module, torch.nn.Module):
+            continue
+
+        def tensors():
+            seen = set()
+            for tensor_name, tensor in chain(module.named_parameters(), module.named_buffers()):
+                # Shared weights (like tied embeddings) are counted once.
+                if tensor.device.type == "meta" or tensor.data_ptr() in seen:
+                    continue
+                seen.add(tensor.data_ptr())
+                yield tensor_name, tensor.numel() * tensor.element_size(), tensor.numel(), tensor.dim() == 2
+
+        components[name] = summarize(tensors(), "diffusers" if hasattr(module, "enable_group_offload") else "transformers")
+        # The components loaded through the weight cache are quantized already.
+        components[name]["quantizable"] = all(type(parameter.data) is torch.Tensor for parameter in module.parameters())
+    return components
+
+
+def snapshot_components(model_id:str, dtype:str=None, variant:str=None) -> dict:
+    """ Measures the components of a pipeline from the headers of its safetensors files, without downloading the weights.
+        Args:
+            model_id (str): A HuggingFace repo or a local folder with a model_index.json.
+            dtype (str): The dtype the pipeline is loaded in, like bfloat16, None keeps the dtype of the files.
+            variant (str): The variant of the files, like fp16, the files without it are used if it doesn't exist.
+        Returns:
+            dict: The summary of every component with weights, see summarize.
+    """
+    if os.path.isdir(model_id):
+        files = [os.path.relpath(os.path.join(root, name), model_id).replace(os.sep, "/")
+                 for root, _, names in os.walk(model_id) for name in names]
+        open_file = lambda path: open(os.path.join(model_id, path), "rb")
+    else:
+        from huggingface_hub import HfApi, HfFileSystem
+        files = HfApi().list_repo_files(model_id)
+        # Reads only the bytes asked for, the headers are small.
+        filesystem = HfFileSystem()
+        open_file = lambda path: filesystem.open(f"{model_id}/{path}", "rb")
+
+    with open_file("model_index.json") as f:
+        model_index = json.load(f)
+
+    components = {}
+    for name, value in model_index.items():
+        if not isinstance(value, list) or value[0] not in ["diffusers", "transformers"]:
+            continue
+        weights = [path for path in files if path.startswith(f"{name}/") and path.endswith(".safetensors")]
+        # Like diffusion_pytorch_model.fp16.safetensors, or .fp16-00001-of-00002.safetensors when it's sharded.
+        chosen = [path for path in weights if variant and (f".{variant}." in path or f".{variant}-" in path)]
+        # Without the variant, the files that aren't a variant of another dtype (the only dot is the extension's).
+        chosen = chosen or [path for path in weights if path.rsplit("/", 1)[-1].count(".") == 1]
+        if not chosen:
+            continue
+
+        def tensors(paths=chosen):
+            for path in paths:
+                with open_file(path) as f:
+                    header = json.loads(f.read(int.from_bytes(f.read(8), "little")))
+                for tensor_name, info in header.items():
+                    if tensor_name == "__metadata__":
+                        continue
+                    params = 1
+                    for side in info["shape"]:
+                        params *= side
+                    element = DTYPE_BYTES[dtype] if dtype and info["dtype"].startswith("F") else SAFETENSORS_BYTES[info["dtype"]]
+                    yield tensor_name, params * element, params, len(info["shape"]) == 2
+
+        components[name] = summarize(tensors(), value[0])
+    return components
+
+
+def estimate(components:dict, placements:dict, quantize:list, headroom:int) -> tuple:
+    """ Estimates the peak memory of a plan.
+        Only one offloaded component is on the device at a time, the offloaded ones are kept in the RAM.
+        Returns:
+            tuple: The peak VRAM and RAM in bytes.
+    """
+    def size(name, key="bytes"):
+        component = components[name]
+        ratio = component["quantized_bytes"] / component["bytes"] if name in quantize and component["bytes"] else 1
+        return component[key] * ratio
+
+    resident = sum(size(name) for name, placement in placements.items() if placement == "resident")
+    onload = max([size(name) for name, placement in placements.items() if placement == "model_offload"] +
+                 [size(name, "group_bytes") for name, placement in placements.items() if placement == "group_offload"] +
+                 [size(name, "leaf_bytes") for name, placement in placements.items() if placement == "sequential"] + [0])
+    ram = sum(size(name) for name, placement in placements.items() if placement != "resident")
+    return int(resident + onload + headroom), int(ram)
+
+
+def plan_offload(components:dict, vram:int, ram:int, headroom:int=int(1.5 * GB)) -> dict:
+    """ Picks the placement of every component, the fastest one that fits in the budget.
+        The components are offloaded one at a time till the peak fits, the ones that run once (text encoders, vae)
+        before the ones that run at every step, the largest first. Then they are group offloaded, and only when
+        nothing fits are the text encoder and transformer quantized. When even that doesn't fit, the search is run
+        again with the components offloaded one layer at a time as the last step (fallback in the plan). The components
+        that fit back on the device after that are put back.
+        Args:
+            components (dict): From pipe_components or snapshot_components.
+            vram (int): The bytes of VRAM the pipeline can use.
+            ram (int): The bytes of RAM the offloaded components can use.
+            headroom (int): The bytes of VRAM kept for the activations and the VAE decode.
+        Returns:
+            dict: The placement of every component, the ones to quantize, the expected peaks, if they fit and if the
+                sequential fallback was needed.
+    """
+    by_size = sorted(components, key=lambda name: components[name]["bytes"], reverse=True)
+    order = [name for name in by_size if name not in DENOISERS] + [name for name in by_size if name in DENOISERS]
+    steps = ([("model_offload", name) for name in order] +
+             [("group_offload", name) for name in order if components[name]["group_bytes"] is not None])
+    quantizable = [name for name in by_size if name in QUANTIZABLE and components[name]["quantizable"]]
+
+    def search(steps):
+        # The fewest quantized components, then the first placements of the steps that fit.
+        for count in range(len(quantizable) + 1):
+            quantize = quantizable[:count]
+            placements = {name: "resident" for name in components}
+            for step in [None] + steps:
+                if step:
+                    placements[step[1]] = step[0]
+                peak_vram, peak_ram = estimate(components, placements, quantize, headroom)
+                if peak_vram <= vram and peak_ram <= ram:
+                    return placements, quantize, peak_vram, peak_ram
+        return placements, quantize, peak_vram, peak_ram
+
+    placements, quantize, peak_vram, peak_ram = search(steps)
+    fallback = not (peak_vram <= vram and peak_ram <= ram)
+    if fallback:
+        # Unquantized first, like optimize_model(seq=True), a layer at a time needs little more than the headroom.
+        placements, quantize, peak_vram, peak_ram = search(steps + [("sequential", name) for name in order])
+
+    if peak_vram <= vram and peak_ram <= ram:
+        # Offloading a large component can leave room for the smaller ones offloaded before it, they are put back
+        # on the device (the denoisers first) when the plan still fits.
+        for name in [name for name in reversed(order) if name in DENOISERS] + [name for name in reversed(order) if name not in DENOISERS]:
+            for placement in PLACEMENTS[:PLACEMENTS.index(placements[name])]:
+                if placement == "group_offload" and components[name]["group_bytes"] is None:
+                    continue
+                peaks = estimate(components, {**placements, name: placement}, quantize, headroom)
+                if peaks[0] <= vram and peaks[1] <= ram:
+                    placements[name] = placement
+                    peak_vram, peak_ram = peaks
+                    break
+
+    return {"components": {name: {**components[name], "placement": placements[name], "quantize": name in quantize}
+                           for name in components},
+            "quantize": quantize,
+            "peak_vram": peak_vram,
+            "peak_ram": peak_ram,
+            "vram_budget": vram,
+            "ram_budget": ram,
+            "fits": peak_vram <= vram and peak_ram <= ram,
+            "fallback": fallback}
+
+
+def format_plan(plan:dict) -> str:
+    """ Formats a plan as a table.
+    """
+    lines = [f"{'component':<16}{'size':>10}  {'placement':<15}quantize"]
+    for name, component in plan["components"].items():
+        lines.append(f"{name:<16}{component['bytes'] / GB:>8.2f}GB  {component['placement']:<15}{'int8' if component['quantize'] else '-'}")
+    lines.append(f"peak VRAM {plan['peak_vram'] / GB:.2f}GB of {plan['vram_budget'] / GB:.2f}GB, "
+                 f"RAM {plan['peak_ram'] / GB:.2f}GB of {plan['ram_budget'] / GB:.2f}GB{'' if plan['fits'] else ', DOES NOT FIT'}"
+                 f"{', sequential fallback' if plan['fallback'] else ''}")
+    return "\n".join(lines)
+
+
+def budget_bytes(budget:dict) -> tuple:
+    """ Gets the VRAM and RAM of a budget in bytes, the free memory is used for the ones it doesn't have.
+        Args:
+            budget (dict): vram_gb and ram_gb.
+    """
+    vram = budget.get("vram_gb")
+    ram = budget.get("ram_gb")
+    if vram is None or ram is None:
+        from .gen_ai_utilities import available_memory
+        free = available_memory()
+    return (int(vram * GB) if vram is not None else free["cuda"] or 0,
+            int(ram * GB) if ram is not None else free["cpu"] or 0)
+
+
+def apply_plan(pipe, plan:dict, device:str):
+    """ Quantizes and places the components of a pipeline as planned.
+    """
+    import torch
+    from accelerate import cpu_offload_with_hook
+
+    from .weight_cache import int8_weight_only
+
+    modules = {name: module for name, module in pipe.components.items() if isinstance(module, torch.nn.Module)}
+    for name in plan["quantize"]:
+        int8_weight_only(modules[name])
+
+    # In the order the pipeline runs them, so an offloaded component moves the one before it back to the RAM.
+    sequence = [name for name in pipe.model_cpu_offload_seq.split("->") if name in modules]
+    hooks = []
+    for name in sequence + [name for name in modules if name not in sequence]:
+        placement = plan["components"][name]["placement"]
+        module = modules[name]
+        if placement == "resident":
+            module.to(device)
+        elif placement == "model_offload":
+            _, hook = cpu_offload_with_hook(module, device, prev_module_hook=hooks[-1] if hooks else None)
+            hooks.append(hook)
+        else:
+            from diffusers.hooks import apply_group_offloading
+            # A CUDA stream copies the next block (or layer) while the current one runs. The leaf level works for the
+            # transformers models too, the block level needs the blocks of a diffusers model.
+            if placement == "group_offload":
+                levels = {"offload_type": "block_level", "num_blocks_per_group": 1}
+            else:
+                levels = {"offload_type": "leaf_level"}
+            apply_group_offloading(module, onload_device=torch.device(device), offload_device=torch.device("cpu"),
+                                   use_stream=device.startswith("cuda"), **levels)
+
+    # The first component of the next call moves the last one of this call back to the RAM.
+    if len(hooks) > 1:
+        hooks[0].hook.prev_module_hook = hooks[-1]
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Plans the placement of the components of a pipeline without loading it.")
+    parser.add_argument("model_id", help="A HuggingFace repo or a local folder of a diffusers pipeline.")
+    parser.add_argument("--dtype", choices=list(DTYPE_BYTES), help="The dtype the pipeline is loaded in.")
+    parser.add_argument("--variant", help="The variant of the weights, like fp16.")
+    parser.add_argument("--vram-gb", type=float, help="The VRAM the pipeline can use, defaults to the free VRAM.")
+    parser.add_argument("--ram-gb", type=float, help="The RAM the offloaded components can use, defaults to the free RAM.")
+    parser.add_argument("--headroom-gb", type=float, default=1.5, help="The VRAM kept for the activations.")
+    parser.add_argument("--json", action="store_true", help="Print the plan as json.")
+    args = parser.parse_args()
+
+    vram, ram = budget_bytes({"vram_gb": args.vram_gb, "ram_gb": args.ram_gb})
+    plan = plan_offload(snapshot_components(args.model_id, args.dtype, args.variant), vram, ram, int(args.headroom_gb * GB))
+    print(json.dumps(plan, indent=4) if args.json else format_plan(plan))
@@ -0,0 +1,75 @@
+import queue
+import threading
+
+
+class STREAM_PIPELINE:
+    """ Connects the script detailer to the generators with bounded queues.
+        Every generator runs in its own thread and starts as soon as its first line is detailed,
+        so the LLM calls and file writes overlap with the generation instead of running one stage after another.
+    """
+    def __init__(self, consumers:dict, maxsize:int=4):
+        """ Initialize the stages.
+            Args:
+                consumers (dict): The description type (img, vid, dia or msc) mapped to the function that generates it,
+                    like {"msc": GEN_MUSIC(output_folder).generate_music}. Types without a consumer are skipped.
+                maxsize (int): The number of lines that can wait for a consumer before the producer has to wait.
+        """
+        self.consumers = consumers
+        self.maxsize = maxsize
+
+    def consume(self, desc_type:str):
+        """ Passes every line of a queue to its consumer till the end of the stream.
+            Args:
+                desc_type (str): The description type of the queue.
+        """
+        consumer = self.consumers[desc_type]
+        lines = self.queues[desc_type]
+
+        while True:
+            line = lines.get()
+            if line is None:
+                break
+
+            # After a failure the queue is still drained, else the producer would wait forever on a full queue.
+            if self.errors:
+                continue
+            try:
+                self.results[desc_type].append(consumer(line))
+            except Exception as e:
+                self.errors.append(e)
+
+    def run(self, stream) -> dict:
+        """ Runs the pipeline till the stream is done and every consumer has finished.
+            Args:
+                stream (iterable): Yields the description type and the detailed line, like OLLAMA_SCRIPT.script_detailer_stream().
+            Returns:
+                dict: The paths returned by each consumer in the order of the stream.
+        """
+        self.queues = {desc_type: queue.Queue(maxsize=self.maxsize) for desc_type in self.consumers}
+        self.results = {desc_type: [] for desc_type in self.consumers}
+        self.errors = []
+
+        threads = [threading.Thread(target=self.consume, args=(desc_type,), daemon=True) for desc_type in self.consumers]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for desc_type, line in stream:
+                if self.errors:
+                    break
+                if desc_type in self.queues:
+                    self.queues[desc_type].put(line)
+        finally:
+            # A stream stopped early (an error or a failed consumer) cancels the LLM calls it hasn't started.
+            if hasattr(stream, "close"):
+                stream.close()
+            # None marks the end of the stream for every consumer.
+            for lines in self.queues.values():
+                lines.put(None)
+            for thread in threads:
+                thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        return self.results
@@ -0,0 +1,149 @@
+import gc
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+def model_footprint(model) -> dict:
+    """ Adds up the memory taken by the weights of a model, per device.
+        Args:
+            model: A torch module, a diffusers pipeline or a transformers pipeline.
+        Returns:
+            dict: The bytes used on every device type, like {"cpu": ..., "cuda": ...}.
+    """
+    # A model can only be a torch module once torch is loaded, the worker starts without it.
+    torch = sys.modules.get("torch")
+    if torch is None:
+        modules = []
+    elif isinstance(model, torch.nn.Module):
+        modules = [model]
+    elif hasattr(model, "components"):
+        # Diffusers pipelines keep the text encoders, transformer/unet and vae in components.
+        modules = [module for module in model.components.values() if isinstance(module, torch.nn.Module)]
+    elif isinstance(getattr(model, "model", None), torch.nn.Module):
+        # Transformers pipelines
+        modules = [model.model]
+    else:
+        modules = []
+
+    footprint = {}
+    seen = set()
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            # Shared weights (like tied embeddings) are counted once.
+            if tensor.device.type == "meta" or tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            footprint[tensor.device.type] = footprint.get(tensor.device.type, 0) + tensor.numel() * tensor.element_size()
+
+    return footprint
+
+
+class MODEL_REGISTRY:
+    """ Keeps the loaded models in memory and shares them between the generator objects.
+        The models are loaded when they are used first, and the least recently used ones are
+        unloaded when loading another one would go over the memory budget.
+    """
+    def __init__(self, budget_gb:float=None):
+        """ Initialize the registry.
+            Args:
+                budget_gb (float): The memory (RAM + VRAM) the weights of all the loaded models can use.
+                    None keeps every model that was loaded.
+        """
+        self.budget = budget_gb * 1024**3 if budget_gb else None
+
+        # Ordered from the least to the most recently used.
+        self.models = OrderedDict()
+        self.footprints = {}
+
+        # The size of every model seen so far, so the space can be freed before it's loaded again.
+        self.sizes = {}
+
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key:str, loader):
+        """ Gets a model, loads it if it's not in memory.
+            Args:
+                key (str): The name of the model, the same key always has to load the same weights.
+                loader (function): Loads and returns the model.
+            Returns:
+                The loaded model.
+        """
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            self.fit(self.sizes.get(key, 0))
+
+            start = time.perf_counter()
+            model = loader()
+            self.load_seconds += time.perf_counter() - start
+            self.loads += 1
+            self.models[key] = model
+            self.footprints[key] = model_footprint(model)
+            self.sizes[key] = sum(self.footprints[key].values())
+
+            # The size is known only after the first load.
+            self.fit(0, keep=key)
+            return model
+
+    def size(self) -> int:
+        """ Gets the bytes used by all the loaded models.
+        """
+        return sum(self.sizes[key] for key in self.models)
+
+    def fit(self, incoming:int, keep:str=None):
+        """ Unloads the least recently used models till the incoming model fits in the budget.
+            Args:
+                incoming (int): The bytes that will be loaded.
+                keep (str): A model that must not be unloaded.
+        """
+        if not self.budget:
+            return
+
+        for key in list(self.models):
+            if self.size() + incoming <= self.budget:
+                break
+            if key != keep:
+                self.unload(key)
+
+    def unload(self, key:str):
+        """ Removes a model from the registry and frees its memory.
+            Args:
+                key (str): The name of the model.
+        """
+        with self.lock:
+            if key not in self.models:
+                return
+            del self.models[key]
+            del self.footprints[key]
+            self.evictions += 1
+
+            # The memory is freed only when nothing refers to the model anymore.
+            gc.collect()
+            torch = sys.modules.get("torch")
+            if torch and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        """ Unloads every model.
+        """
+        for key in list(self.models):
+            self.unload(key)
+
+    def stats(self) -> dict:
+        """ Gets the loaded models and their footprint.
+            Returns:
+                dict: The loaded models from the least to the most recently used, the loads with the time they took and the evictions.
+        """
+        return {"models": {key: self.footprints[key] for key in self.models},
+                "size": self.size(),
+                "budget": self.budget,
+                "loads": self.loads,
+                "load_seconds": self.load_seconds,
+                "evictions": self.evictions}
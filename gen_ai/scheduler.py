@@ -0,0 +1,150 @@
+# The stages of a project in the order they have to run, every stage after the script reads its lines from the script stage.
+STAGES = ["script", "music", "speech", "image", "video"]
+
+# Rough seconds to load each model from an SSD on the tested machine (see the README), used to estimate the saving.
+LOAD_SECONDS = {"ollama": 10,
+                "musicgen": 15,
+                "xtts": 20,
+                "sdxl": 60,
+                "sana": 45,
+                "ltx": 120,
+                "wan": 150}
+
+
+def stage_model(job:dict, stage:str) -> str:
+    """ Gets the model that runs a stage of a job.
+        Args:
+            job (dict): The job, image_model and video_model pick between the image and video models.
+            stage (str): One of STAGES.
+        Returns:
+            str: The model name.
+    """
+    match(stage):
+        case "script": return "ollama"
+        case "music": return "musicgen"
+        case "speech": return "xtts"
+        case "image": return job.get("image_model", "sdxl")
+        case "video": return job.get("video_model", "ltx")
+
+
+def count_loads(models:list) -> dict:
+    """ Counts how many times each model is loaded when the work runs in the given order.
+        Args:
+            models (list): The model of every work item in the order they run.
+        Returns:
+            dict: The model name mapped to the number of loads.
+    """
+    loads = {}
+    previous = None
+    for model in models:
+        # Only one model fits in memory at a time, so every change of model is a load.
+        if model != previous:
+            loads[model] = loads.get(model, 0) + 1
+        previous = model
+    return loads
+
+
+class SCHEDULER:
+    """ Orders the work of many projects by model, so every model is loaded as few times as possible.
+        A work item runs only after the items it depends on, the media of a project needs its script first.
+    """
+    def __init__(self, load_seconds:dict=None):
+        """ Initialize the scheduler.
+            Args:
+                load_seconds (dict): The estimated seconds to load each model, defaults to LOAD_SECONDS.
+        """
+        self.load_seconds = load_seconds or LOAD_SECONDS
+        self.items = []
+
+        # The loads measured while the work was running.
+        self.measured = {}
+
+    def add_project(self, job:dict):
+        """ Adds the work items of a project, one per stage.
+            Args:
+                job (dict): The job with its id and stages.
+        """
+        for stage in STAGES:
+            if stage not in job["stages"]:
+                continue
+            after = [(job["id"], "script")] if stage != "script" and "script" in job["stages"] else []
+            self.items.append({"job": job["id"], "stage": stage, "model": stage_model(job, stage), "after": after})
+
+    def order(self) -> list:
+        """ Orders the work items. The loaded model is kept while it has work that's ready,
+            after that the model with the most ready work is loaded.
+            Returns:
+                list: The work items in the order they should run.
+        """
+        done = set()
+        order = []
+        remaining = list(self.items)
+        current = None
+
+        while remaining:
+            ready = [item for item in remaining if all(key in done for key in item["after"])]
+            if not ready:
+                raise ValueError("The work items depend on each other in a cycle.")
+
+            models = [item["model"] for item in ready]
+            if current not in models:
+                # Ties go to the model that was added first, so the order doesn't change between runs.
+                current = max(dict.fromkeys(models), key=models.count)
+
+            group = [item for item in ready if item["model"] == current]
+            order.extend(group)
+            done.update((item["job"], item["stage"]) for item in group)
+            remaining = [item for item in remaining if item not in group]
+
+        return order
+
+    def groups(self) -> list:
+        """ The ordered work items grouped by the model they use.
+            Returns:
+                list: A (model, items) pair for every time a model is used.
+        """
+        groups = []
+        for item in self.order():
+            if groups and groups[-1][0] == item["model"]:
+                groups[-1][1].append(item)
+            else:
+                groups.append((item["model"], [item]))
+        return groups
+
+    def record(self, model:str, loads:int, seconds:float):
+        """ Records the loads that happened while the work of a model was running.
+            Args:
+                model (str): The model name.
+                loads (int): The number of loads.
+                seconds (float): The time spent loading.
+        """
+        measured = self.measured.setdefault(model, {"loads": 0, "seconds": 0.0})
+        measured["loads"] += loads
+        measured["seconds"] += seconds
+
+    def report(self) -> dict:
+        """ Compares the loads of running the projects one after another with the scheduled order.
+            Returns:
+                dict: The loads of both orders, the estimated seconds saved and the seconds saved
+                    with the load times measured by record (the estimate is used for models without a measurement).
+        """
+        naive = count_loads([item["model"] for item in self.items])
+        scheduled = count_loads([item["model"] for item in self.order()])
+
+        estimated_saving = sum((naive[model] - scheduled.get(model, 0)) * self.load_seconds.get(model, 0) for model in naive)
+
+        actual_saving = 0.0
+        for model in naive:
+            measured = self.measured.get(model)
+            loads = measured["loads"] if measured else scheduled.get(model, 0)
+            if measured and measured["loads"]:
+                load_seconds = measured["seconds"] / measured["loads"]
+            else:
+                load_seconds = self.load_seconds.get(model, 0)
+            actual_saving += (naive[model] - loads) * load_seconds
+
+        return {"naive_loads": naive,
+                "scheduled_loads": scheduled,
+                "measured_loads": self.measured,
+                "estimated_saved_seconds": estimated_saving,
+                "actual_saved_seconds": actual_saving}
@@ -1,19 +1,25 @@
 import ollama
 import os
 import atexit
+from concurrent.futures import ThreadPoolExecutor
 
-from .gen_ai_utilities import file_saver, system_prompts
+from .gen_ai_utilities import file_saver, system_prompts, start_item, work_item
+from .llm_cache import LLM_CACHE
+from .telemetry import telemetry
 
 
 class OLLAMA_SCRIPT:
     """ Utilizes Ollama to create scripts.
     """
-    def __init__(self, output_folder:str="outputs", model:str="llama3.1:8b", think=False):
+    def __init__(self, output_folder:str="outputs", model:str="llama3.1:8b", think=False, num_parallel:int=None, use_cache:bool=True):
         """ Initialize Ollama model.
             Args:
                 output_folder (str): The folder where the script will be stored.
                 model (str): The Ollama model you want to use.
                 think (bool): Indicates if it's a thinking model or non-thinking model. Both output differently.
+                num_parallel (int): The number of detailer requests kept in flight at once.
+                    Defaults to the server's OLLAMA_NUM_PARALLEL if it's set, else 1 (one request at a time).
+                use_cache (bool): Reuse the stored responses of earlier runs with the same prompts and seeds.
         """
         self.output_folder = output_folder
 
@@ -21,20 +27,60 @@ class OLLAMA_SCRIPT:
         self.model_name = model
         self.thinking_model = think
 
+        # Ollama only serves OLLAMA_NUM_PARALLEL requests at once, anything above that just waits in its queue.
+        if not num_parallel:
+            num_parallel = int(os.environ.get("OLLAMA_NUM_PARALLEL", 1))
+        self.num_parallel = max(1, num_parallel)
+
+        self.cache = LLM_CACHE() if use_cache else None
+
         self.idea = ""
 
         self.generated_files = {}
 
         atexit.register(self.model_unload)
 
-    def response_handler(self, response):
+    def chat(self, messages:list, options:dict) -> str:
+        """ Sends the messages to Ollama, the response is read from the cache if the same request was made before.
+            Args:
+                messages (list): The chat messages.
+                options (dict): The Ollama options like the seed.
+            Returns:
+                str: The content of the response.
+        """
+        # Without a seed the response is random, so there is nothing to reuse.
+        if not self.cache or "seed" not in options:
+            return self.ollama_chat(messages, options)
+
+        key = LLM_CACHE.make_key(self.model_name, messages, options)
+        content = self.cache.get(key)
+        if content is None:
+            content = self.ollama_chat(messages, options)
+            self.cache.put(key, content)
+
+        return content
+
+    def ollama_chat(self, messages:list, options:dict) -> str:
+        """ Sends the messages to Ollama, the tokens it read and generated are recorded by the telemetry.
+            Args:
+                messages (list): The chat messages.
+                options (dict): The Ollama options like the seed.
+            Returns:
+                str: The content of the response.
+        """
+        with telemetry.span("llm", self.model_name) as span:
+            response = ollama.chat(model=self.model_name, messages=messages, options=options)
+            span["prompt_tokens"] = response.prompt_eval_count or 0
+            span["tokens"] = response.eval_count or 0
+        return response.message.content
+
+    def response_handler(self, message):
         """ Handles the response based on thinking or non thinking model. Also trims unnecessary new lines.
             Args:
-                response (ChatResponse): The response from Ollama chat.
+                message (str): The content of the response from Ollama chat.
             Returns:
                 str: The formatted content.
         """
-        message = response.message.content
         if self.thinking_model:
             message = message.split('</think>')[1]
         
@@ -64,11 +110,19 @@ class OLLAMA_SCRIPT:
             Returns:
                 str: The file path of the generated script.
         """
+        self.idea = prompt
+
+        # A resumed project keeps the script it was started with.
+        done = start_item(self.output_folder, "script", 0, prompt, seed)
+        if done:
+            with open(done, 'r', encoding="utf-8") as f:
+                self.script = f.read()
+            self.generated_files["script"] = done
+            return done
+
         options = {}
         options["seed"] = seed
-        self.idea = prompt
-        response = ollama.chat(
-                model=self.model_name,
+        response = self.chat(
                 messages=[
                     {"role": "system", "content": system_prompts["script"]},
                     {"role": "user", "content": self.prompt_handler(prompt)}],
@@ -77,7 +131,7 @@ class OLLAMA_SCRIPT:
         
         self.script = self.response_handler(response)
 
-        self.generated_files["script"] = file_saver(self.output_folder, script=self.script)
+        self.generated_files["script"] = file_saver(self.output_folder, script=self.script, item=work_item(0, prompt, seed))
     
         return self.generated_files["script"]
     
@@ -93,17 +147,29 @@ class OLLAMA_SCRIPT:
         if seed:
             options["seed"] = seed
         
-        response = ollama.chat(
-                model=self.model_name,
+        response = self.chat(
                 messages=[
                     {"role": "user", "content": prompt}],
                 options=options
             )
     
-        return response.message.content
+        return response
 
     def script_detailer(self):
         """ Adds details to the script it generated and saved them individually.
+            Up to num_parallel lines are detailed at once, the files are still written in the script's order.
+            Returns:
+                dict: The paths of the generated files.
+        """
+        for _ in self.script_detailer_stream():
+            pass
+
+        return self.generated_files
+
+    def script_detailer_stream(self):
+        """ Same as script_detailer, but yields every detailed line as soon as it's written.
+            Yields:
+                tuple: The description type (img, vid, dia or msc) and the detailed line.
         """
         img_pattern = "VISUAL: "
         dia_pattern = "HOST: "
@@ -115,21 +181,32 @@ class OLLAMA_SCRIPT:
         video_file = f"{self.output_folder}/scripts/video.txt"
 
         with open(image_file, 'w+', encoding="utf-8")as im, open(music_file, 'w+', encoding="utf-8")as ms, open(dialogue_file, 'w+', encoding="utf-8")as di, open(video_file, 'w+', encoding="utf-8")as vd:
+            # Collect every request first so they can be sent together, in the order they have to be written.
+            jobs = []
             for line in self.script.split('\n'):
                 if line.startswith(img_pattern):
-                    im.write(self.detailer(line, "img", 44)+"\n")
-                    vd.write(self.detailer(line, "vid", 1)+"\n")
+                    jobs.append((im, line, "img", 44))
+                    jobs.append((vd, line, "vid", 1))
                 elif line.startswith(dia_pattern):
-                    di.write(self.detailer(line, "dia", 86)+"\n")
+                    jobs.append((di, line, "dia", 86))
                 elif line.startswith(music_pattern):
-                    ms.write(self.detailer(line, "msc", 96)+"\n")
+                    jobs.append((ms, line, "msc", 96))
+
+            executor = ThreadPoolExecutor(max_workers=self.num_parallel)
+            try:
+                # map yields the results in the order of jobs, so each line is written as soon as it and the ones before it are done.
+                details = executor.map(lambda job: self.detailer(*job[1:]), jobs)
+                for (file, _, desc_type, _), text in zip(jobs, details):
+                    file.write(text+"\n")
+                    yield desc_type, text
+            finally:
+                # When the consumer stops early, the lines that didn't reach the LLM yet are cancelled instead of waited for.
+                executor.shutdown(wait=True, cancel_futures=True)
         
         self.generated_files["music"] = music_file
         self.generated_files["dialogue"] = dialogue_file
         self.generated_files["image"] = image_file
         self.generated_files["video"] = video_file
-        
-        return self.generated_files
 
     
     def detailer(self, line:str, desc_type:str, seed:int=42):
@@ -154,8 +231,7 @@ class OLLAMA_SCRIPT:
         options["seed"] = seed
 
         input_format = f"{self.idea} : {line}"
-        response = ollama.chat(
-                model=self.model_name,
+        response = self.chat(
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": self.prompt_handler(input_format)}],
@@ -0,0 +1,118 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .manifest import get_manifest, set_manifest_shard
+
+
+# The generator object of a worker process, it's created once when the process starts.
+worker_state = {}
+
+
+def default_devices() -> list:
+    """ Gets a device for every GPU, or the CPU if there is none.
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def split_cores(workers:int) -> list:
+    """ Splits the CPU cores this process can use into a contiguous set per worker, so a worker stays on one socket
+        when the workers are as many as the sockets.
+        Args:
+            workers (int): The number of sets.
+        Returns:
+            list: The cores of every worker.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    size = max(1, len(cores) // workers)
+    return [cores[(i * size) % len(cores):(i * size) % len(cores) + size] for i in range(workers)]
+
+
+def init_worker(slots, generator, output_folder:str, options:dict):
+    """ Sets up a worker process, it takes a device (and its cores) from slots and creates its generator on it.
+    """
+    device, cores = slots.get()
+    if cores:
+        import torch
+
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+
+    # The workers would write over each other's manifest, the parent merges their journals at the end.
+    set_manifest_shard(str(os.getpid()))
+
+    if isinstance(generator, str):
+        import gen_ai
+        generator = getattr(gen_ai, generator)
+    worker_state["generator"] = generator(output_folder, device=device, **(options or {}))
+
+
+def run_items(method:str, prompts:list, seeds:list, indexes:list, chunked:bool, kwargs:dict) -> list:
+    """ Runs the items given to a worker with the generator of the process.
+        Returns:
+            list: The path of every item.
+    """
+    generator = getattr(worker_state["generator"], method)
+    if chunked:
+        # A chunk can mix seeded and unseeded prompts, the generators give the unseeded ones a random seed.
+        with_seeds = any(seed is not None for seed in seeds)
+        return list(generator(prompts, indexes=indexes, **({"seeds": seeds} if with_seeds else {}), **kwargs))
+
+    return [generator(prompt, index=index, **({"seed": seed} if seed is not None else {}), **kwargs)
+            for prompt, seed, index in zip(prompts, seeds, indexes)]
+
+
+def run_sharded(generator, output_folder:str, method:str, prompts:list, seeds:list=None, indexes:list=None, devices:list=None,
+                cores:list=None, options:dict=None, chunk_size:int=None, **kwargs) -> list:
+    """ Shards the work items of a stage over worker processes, one per device, each with its own copy of the model.
+        The items are handed out as the workers get free, so a faster device takes more of them, and the results are
+        gathered in the order of the prompts. Every worker records its items in its own manifest, they are merged
+        into the manifest of the project at the end, so a rerun skips them like with a single process.
+        The processes are spawned, call it under if __name__=="__main__": in a script.
+        Args:
+            generator: A generator class that takes the output folder and a device, like SANA_IMAGE or "SANA_IMAGE".
+            output_folder (str): The folder of the project.
+            method (str): The method that generates the items, like generate_video or generate_images.
+            prompts (list): The prompts.
+            (Optional)
+            seeds (list): A seed for each prompt, None for the prompts without one.
+            indexes (list): The index of each prompt in the project, defaults to the position of the prompt.
+            devices (list): A device for every worker like ["cuda:0", "cuda:1"] or ["cpu", "cpu"], defaults to every GPU.
+            cores (list): The CPU cores of every worker, defaults to an equal share of the cores for each CPU worker.
+            options (dict): The other arguments of the generator class, like {"quality": "base"}.
+            chunk_size (int): The items given to a worker at once, passed as lists to a method that takes the lists of
+                prompts, seeds and indexes (like generate_images). None calls the method once per item (like generate_video).
+            kwargs: The other arguments of the method, like fps.
+        Returns:
+            list: The path of every output in the order of the prompts.
+    """
+    devices = devices or default_devices()
+    if cores is None:
+        cpu_cores = iter(split_cores(devices.count("cpu") or 1))
+        cores = [next(cpu_cores) if device == "cpu" else None for device in devices]
+
+    seeds = seeds or [None] * len(prompts)
+    indexes = list(range(len(prompts))) if indexes is None else indexes
+    size = chunk_size or 1
+    chunks = [slice(start, start + size) for start in range(0, len(prompts), size)]
+
+    # CUDA can't be used in a forked process.
+    context = multiprocessing.get_context("spawn")
+    slots = context.Queue()
+    for slot in zip(devices, cores):
+        slots.put(slot)
+
+    try:
+        with ProcessPoolExecutor(max_workers=len(devices), mp_context=context, initializer=init_worker,
+                                 initargs=(slots, generator, output_folder, options)) as executor:
+            futures = [executor.submit(run_items, method, prompts[chunk], seeds[chunk], indexes[chunk], chunk_size is not None, kwargs)
+                       for chunk in chunks]
+            return [path for future in futures for path in future.result()]
+    finally:
+        # What the workers finished is recorded even if one of them failed.
+        get_manifest(output_folder).merge_shards()
@@ -1,53 +1,222 @@
+import time
+
+import numpy as np
 import torch
 from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts, XttsAudioConfig, XttsArgs
 from TTS.config.shared_configs import BaseDatasetConfig
+from TTS.tts.layers.xtts.tokenizer import split_sentence
 
-from .gen_ai_utilities import file_saver
+from .gen_ai_utilities import start_item, work_item, audio_stream_saver, get_device, SPEECH_SAMPLE_RATE
+from .background_saver import save_output, reuse_output
+from .voice_library import get_voice_library
+from .telemetry import telemetry
 
 
 class XTTSv2_SPEECH:
     """ This converts texts to speech and saves them with the timestamp.
     """
-    def __init__(self, output_folder:str):
+    def __init__(self, output_folder:str, registry=None, saver=None, voice:str="liam", voices_folder:str="models/voices",
+                 model_folder:str="models/XTTS-v2", device:str=None):
         """ Initialize with the model name and the system prompt.
+            Args:
+                output_folder (str): The location to store the generated speech.
+                registry (MODEL_REGISTRY): Loads the model on first use and shares it, else it's loaded right away.
+                saver (BACKGROUND_SAVER): Saves the files in the background, the generate functions then return futures of the paths.
+                voice (str): The default voice, the name of a recording in voices_folder.
+                voices_folder (str): The recordings of the voices, see VOICE_LIBRARY.
+                model_folder (str): The XTTS-v2 checkpoint and config.
+                device (str): The device the model runs on, like cuda:1 or cpu, see get_device.
         """
         self.output_folder = output_folder
+        self.device = get_device(device)
+        self.voice = voice
+        self.voices = get_voice_library(voices_folder)
+        self.model_folder = model_folder
 
         # Load config
         self.config = XttsConfig()
-        self.config.load_json("models/XTTS-v2/config.json")
+        self.config.load_json(f"{model_folder}/config.json")
+
+        self.registry = registry
+        self.saver = saver
+        if not registry:
+            self._model = self.load_model()
+
+    @property
+    def model(self):
+        """ The XTTS-v2 model, from the registry if there is one.
+        """
+        if self.registry:
+            return self.registry.get("xtts_v2", self.load_model)
+        return self._model
 
+    @telemetry.trace("load", "xtts_v2")
+    def load_model(self):
+        """ Loads the XTTS-v2 checkpoint.
+        """
         # Init model
-        self.model = Xtts.init_from_config(self.config)
+        model = Xtts.init_from_config(self.config)
 
         # Allow all required classes
         with torch.serialization.safe_globals({XttsConfig, XttsAudioConfig, BaseDatasetConfig, XttsArgs}):
-            self.model.load_checkpoint(self.config, checkpoint_dir="models/XTTS-v2/", eval=True)
+            model.load_checkpoint(self.config, checkpoint_dir=f"{self.model_folder}/", eval=True)
+
+        model.to(self.device)
+        return model
+
+    def compute_latents(self, recording:str, gpt_cond_len:int) -> tuple:
+        """ Computes the GPT conditioning latents and the speaker embedding of a recording, the VOICE_LIBRARY stores them.
+            Args:
+                recording (str): The recording of the voice.
+                gpt_cond_len (int): The seconds of the recording used to condition the GPT.
+            Returns:
+                tuple: The GPT conditioning latents and the speaker embedding.
+        """
+        with telemetry.span("inference", "xtts_v2_speaker_latents"):
+            return self.model.get_conditioning_latents(audio_path=[recording],
+                                                       gpt_cond_len=gpt_cond_len,
+                                                       gpt_cond_chunk_len=self.config.gpt_cond_chunk_len,
+                                                       max_ref_length=self.config.max_ref_len,
+                                                       sound_norm_refs=self.config.sound_norm_refs)
+
+    def speaker_latents(self, voice:str=None) -> tuple:
+        """ Gets the GPT conditioning latents and the speaker embedding of a voice from the library.
+            Args:
+                voice (str): The voice name, defaults to the voice of the object.
+            Returns:
+                tuple: The GPT conditioning latents and the speaker embedding on the device of the model.
+        """
+        gpt_cond_latent, speaker_embedding = self.voices.get(voice or self.voice, self.compute_latents)
 
-        self.model.cuda()
+        device = self.model.device
+        return gpt_cond_latent.to(device), speaker_embedding.to(device)
 
-    def generate_speech(self, prompt: str) -> str:
+    def inference_settings(self) -> dict:
+        """ The sampling settings of the config, the same ones synthesize uses.
+        """
+        return {"temperature": self.config.temperature,
+                "length_penalty": self.config.length_penalty,
+                "repetition_penalty": self.config.repetition_penalty,
+                "top_k": self.config.top_k,
+                "top_p": self.config.top_p}
+
+    def generate_speech(self, prompt: str, index: int = None, stream: bool = False, on_chunk=None, voice: str = None) -> str:
         """
         Generate a voice based on the user's prompt.
         Args:
             prompt (str): The user's input message.
+            (Optional)
+            index (int): The index of the prompt in the project, the speech is recorded in the manifest and reused on a rerun.
+            stream (bool): Generates the speech in chunks and writes each one to the wav file as soon as it's ready,
+                the first audio comes out after a fraction of the time it takes to generate the whole line.
+            on_chunk (function): Called with every chunk (a numpy array of 24kHz samples) when streaming, to play it right away.
+            voice (str): The name of the voice, defaults to the voice of the object.
         Returns:
             str: The path of the generated wav file.
         """
-        outputs = self.model.synthesize(
-            prompt,
-            self.config,
-            gpt_cond_len=3,
-            language="en",
-            speaker_wav="models/voices/liam.wav",
-            enable_text_splitting=True
-        )
+        voice = voice or self.voice
+        params = {"voice": voice}
+        done = start_item(self.output_folder, "speech", index, prompt, params=params)
+        if done:
+            return reuse_output(self.saver, done)
+
+        model = self.model
+        gpt_cond_latent, speaker_embedding = self.speaker_latents(voice)
+
+        if stream:
+            return reuse_output(self.saver, self.stream_speech(model, prompt, gpt_cond_latent, speaker_embedding, index, on_chunk, params))
+
+        with telemetry.span("inference", "xtts_v2") as span:
+            outputs = model.inference(
+                prompt,
+                "en",
+                gpt_cond_latent,
+                speaker_embedding,
+                enable_text_splitting=True,
+                **self.inference_settings()
+            )
+            span["samples"] = len(outputs["wav"])
+
+        return save_output(self.saver, self.output_folder, speech=outputs, item=work_item(index, prompt, params=params))
+
+    def generate_speech_deduped(self, prompts: list, indexes: list = None, voice: str = None) -> list:
+        """ Generates the speech of many lines, like all the lines of dialogue.txt, without generating a sentence twice.
+            XTTS-v2 splits every line into sentences and generates them one by one, here the sentences of all the lines
+            are split first and a sentence that's in more than one line (or twice in a line) is generated once.
+            The sentences are still generated one at a time, it saves the repeated ones and doesn't batch them.
+            Every line is saved as soon as its sentences are ready, and the audio of a sentence is dropped once no line needs it.
+            Args:
+                prompts (list): The lines.
+                (Optional)
+                indexes (list): The index of each line in the project, the speech is recorded in the manifest and reused on a rerun.
+                voice (str): The name of the voice, defaults to the voice of the object.
+            Returns:
+                list: The paths (or their futures with a saver) of the generated wav files in the order of the lines.
+        """
+        voice = voice or self.voice
+        params = {"voice": voice}
+        indexes = indexes or [None]*len(prompts)
+
+        paths = [start_item(self.output_folder, "speech", index, prompt, params=params) for prompt, index in zip(prompts, indexes)]
+        missing = [i for i, path in enumerate(paths) if not path]
+        paths = [reuse_output(self.saver, path) if path else None for path in paths]
+        if not missing:
+            return paths
+
+        model = self.model
+        gpt_cond_latent, speaker_embedding = self.speaker_latents(voice)
+
+        # The same split inference does with enable_text_splitting.
+        sentences = {i: split_sentence(prompts[i], "en", model.tokenizer.char_limits["en"]) for i in missing}
+        uses = {}
+        for i in missing:
+            for sentence in sentences[i]:
+                uses[sentence] = uses.get(sentence, 0) + 1
+
+        audio = {}
+        for i in missing:
+            for sentence in sentences[i]:
+                if sentence not in audio:
+                    with telemetry.span("inference", "xtts_v2") as span:
+                        audio[sentence] = model.inference(sentence, "en", gpt_cond_latent, speaker_embedding,
+                                                          enable_text_splitting=False, **self.inference_settings())["wav"]
+                        span["samples"] = len(audio[sentence])
+
+            wav = np.concatenate([audio[sentence] for sentence in sentences[i]])
+            paths[i] = save_output(self.saver, self.output_folder, speech={"wav": wav}, item=work_item(indexes[i], prompts[i], params=params))
+
+            for sentence in sentences[i]:
+                uses[sentence] -= 1
+                if not uses[sentence]:
+                    del audio[sentence]
+
+        return paths
+
+    def stream_speech(self, model, prompt:str, gpt_cond_latent, speaker_embedding, index:int=None, on_chunk=None, params:dict=None) -> str:
+        """ Generates the speech with inference_stream and writes the chunks to the wav file as they come.
+            Returns:
+                str: The path of the generated wav file.
+        """
+        with telemetry.span("inference", "xtts_v2_stream") as span:
+            start = time.perf_counter()
+            span["samples"] = 0
+
+            def chunks():
+                for chunk in model.inference_stream(prompt, "en", gpt_cond_latent, speaker_embedding,
+                                                    enable_text_splitting=True, **self.inference_settings()):
+                    if not span["samples"]:
+                        span["first_chunk_seconds"] = time.perf_counter() - start
+                    span["samples"] += chunk.shape[-1]
+                    yield chunk
 
-        return file_saver(self.output_folder, speech=outputs)
+            return audio_stream_saver(self.output_folder, "speech", chunks(), SPEECH_SAMPLE_RATE,
+                                      item=work_item(index, prompt, params=params), on_chunk=on_chunk)
 
 
 if __name__=="__main__":
     obj = XTTSv2_SPEECH("outputs")
     prompt = "In the ancient land of Eldoria, where the skies were painted with shades of mystic hues and the forests whispered secrets of old, there existed a dragon named Zephyros. Unlike the fearsome tales of dragons that plagued human hearts with terror, Zephyros was a creature of wonder and wisdom, revered by all who knew of his existence."
     obj.generate_speech(prompt)
+    obj.generate_speech(prompt, stream=True)
+    print(obj.voices.names())
@@ -0,0 +1,167 @@
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+# The attributes the diffusers transformers keep their blocks in, transformer_blocks for Sana and LTX-Video, blocks for WAN.
+BLOCK_LISTS = ["transformer_blocks", "blocks"]
+
+
+class CACHED_BLOCK(torch.nn.Module):
+    """ Runs a transformer block for STEP_CACHE, the first block decides if the other blocks run at this step.
+    """
+    def __init__(self, block, cache, position:str):
+        """ Wrap the block.
+            Args:
+                block (torch.nn.Module): The block of the transformer.
+                cache (STEP_CACHE): The cache the blocks share.
+                position (str): first, middle or last.
+        """
+        super().__init__()
+        self.block = block
+        self.cache = cache
+        self.position = position
+
+    def forward(self, *args, **kwargs):
+        # Sana and WAN pass the hidden states first, LTX-Video passes them by name.
+        hidden_states = kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
+
+        if self.position == "first":
+            output = self.block(*args, **kwargs)
+            self.cache.first_block(hidden_states, output)
+            return output
+
+        if self.cache.skip:
+            # The blocks in the middle are skipped, the last one adds what they all added the last time they ran.
+            if self.position == "last":
+                return hidden_states + self.cache.slot["residual"]
+            return hidden_states
+
+        output = self.block(*args, **kwargs)
+        if self.position == "last":
+            self.cache.slot["residual"] = output - self.cache.first_output
+        return output
+
+
+class STEP_CACHE:
+    """ Skips the transformer blocks after the first one at the steps where they would change little (first block caching).
+        The output of the first block is compared to the one at the last step the blocks ran, when it changed less than
+        the threshold the other blocks aren't run and what they added to it then is added again.
+        The threshold trades quality for speed, a higher one skips more steps and changes the output more.
+    """
+    def __init__(self, threshold:float=0.05, slots:int=1):
+        """ Initialize the cache.
+            Args:
+                threshold (float): The change of the first block, relative to its output at the last step the blocks ran,
+                    under which the other blocks are skipped.
+                slots (int): The calls of the transformer at every step with different inputs. WAN runs the prompt and
+                    the negative prompt one after the other (2), Sana and LTX-Video run them in one batch (1).
+        """
+        self.threshold = threshold
+        self.slots = slots
+        self.hits = 0
+        self.misses = 0
+        self.reset()
+
+    def reset(self):
+        """ Forgets the outputs of the last generation, they can't be reused by the next one.
+        """
+        self.states = [{} for _ in range(self.slots)]
+        self.calls = 0
+        self.slot = None
+        self.skip = False
+        self.first_output = None
+
+    def first_block(self, hidden_states, output):
+        """ Decides if the blocks after the first one run, called with the input and output of the first block.
+        """
+        self.slot = self.states[self.calls % self.slots]
+        self.calls += 1
+
+        change = output - hidden_states
+        previous = self.slot.get("change")
+        self.skip = (previous is not None and previous.shape == change.shape and "residual" in self.slot and
+                     ((change - previous).abs().mean() / previous.abs().mean().clamp(min=1e-8)).item() < self.threshold)
+
+        if self.skip:
+            self.hits += 1
+        else:
+            self.misses += 1
+            # Compared to the last step the blocks ran, so the skipped steps can't drift away a little at a time.
+            self.slot["change"] = change
+            self.first_output = output
+
+    @contextmanager
+    def attach(self, transformer):
+        """ Wraps the blocks of the transformer inside the with statement, they are put back after it.
+            Args:
+                transformer (torch.nn.Module): A diffusers transformer with its blocks in one of BLOCK_LISTS.
+        """
+        blocks = next((getattr(transformer, name) for name in BLOCK_LISTS if hasattr(transformer, name)), None)
+        if blocks is None:
+            raise ValueError(f"{type(transformer).__name__} has none of {BLOCK_LISTS}.")
+
+        self.reset()
+        # With one block there is nothing to skip.
+        if len(blocks) < 2:
+            yield self
+            return
+
+        originals = list(blocks)
+        for i, block in enumerate(originals):
+            position = "first" if i == 0 else "last" if i == len(originals) - 1 else "middle"
+            blocks[i] = CACHED_BLOCK(block, self, position)
+        try:
+            yield self
+        finally:
+            for i, block in enumerate(originals):
+                blocks[i] = block
+            self.reset()
+
+    def stats(self) -> dict:
+        """ Gets the hit and miss counters.
+            Returns:
+                dict: The calls of the transformer that skipped the blocks (hits), the ones that ran them (misses) and the hit rate.
+        """
+        total = self.hits + self.misses
+        return {"threshold": self.threshold, "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+@contextmanager
+def step_caching(transformer, threshold:float=None, slots:int=1):
+    """ Caches the steps of a transformer inside the with statement, if a threshold is passed.
+        Args:
+            transformer (torch.nn.Module): The transformer of the pipeline.
+            threshold (float): See STEP_CACHE, None doesn't cache.
+            slots (int): See STEP_CACHE.
+        Yields:
+            STEP_CACHE: The cache with its stats, None if it's off.
+    """
+    if threshold is None:
+        yield None
+        return
+
+    cache = STEP_CACHE(threshold, slots)
+    with cache.attach(transformer):
+        yield cache
+
+
+def compare_outputs(reference, output) -> dict:
+    """ Measures how far an output generated with the step cache is from the one generated without it.
+        Args:
+            reference: The images or frames without the cache, PIL images or arrays from 0 to 1 (or uint8).
+            output: The same generated with the cache.
+        Returns:
+            dict: The mean and max absolute difference (0 to 1) and the PSNR in dB.
+    """
+    def to_array(frames):
+        frames = np.stack([np.asarray(frame) for frame in frames]) if isinstance(frames, (list, tuple)) else np.asarray(frames)
+        return frames / 255 if frames.dtype == np.uint8 else frames.astype(np.float64)
+
+    reference, output = to_array(reference), to_array(output)
+    difference = np.abs(reference - output)
+    mse = float((difference ** 2).mean())
+    return {"mean_abs_diff": float(difference.mean()),
+            "max_abs_diff": float(difference.max()),
+            "psnr": float("inf") if mse == 0 else float(10 * np.log10(1 / mse))}
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows, psutil (installed with accelerate) is used instead.
+    resource = None
+
+
+def cuda_memory(reset:bool=False) -> dict:
+    """ Gets the CUDA memory allocated by torch, empty without a GPU.
+        Args:
+            reset (bool): Resets the peak, so the next call gets the peak since now.
+        Returns:
+            dict: The allocated and peak bytes.
+    """
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return {}
+    if reset:
+        torch.cuda.reset_peak_memory_stats()
+        return {}
+    return {"cuda_allocated": torch.cuda.memory_allocated(), "cuda_peak": torch.cuda.max_memory_allocated()}
+
+
+def cpu_memory() -> dict:
+    """ Gets the resident memory of the process and its peak since the process started.
+        Returns:
+            dict: The current (where /proc exists) and peak bytes.
+    """
+    if not resource:
+        try:
+            import psutil
+        except ImportError:
+            return {}
+        info = psutil.Process().memory_info()
+        return {"rss": info.rss, "rss_peak": getattr(info, "peak_wset", info.rss)}
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    memory = {"rss_peak": peak if sys.platform == "darwin" else peak * 1024}
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            memory["rss"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+class TELEMETRY_RECORDER:
+    """ Records spans (a name, a category, the wall time and the memory) around the slow parts of a run:
+        model loads, inference calls, Ollama chats and file writes. It does nothing till it's enabled.
+        The spans can be exported as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev) or as JSON lines.
+    """
+    # The categories used by gen_ai, summary adds up the time of each.
+    CATEGORIES = ["load", "inference", "llm", "io"]
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.open_spans = 0
+        self.origin = time.perf_counter()
+
+    def enable(self, export_path:str=None):
+        """ Starts recording.
+            Args:
+                export_path (str): Exports the spans here when the program exits, as JSON lines if it ends with .jsonl,
+                    else as a Chrome trace.
+        """
+        self.enabled = True
+        if export_path:
+            atexit.register(self.export, export_path)
+
+    def disable(self):
+        """ Stops recording, the recorded spans are kept.
+        """
+        self.enabled = False
+
+    def clear(self):
+        """ Removes the recorded spans.
+        """
+        with self.lock:
+            self.spans = []
+
+    @contextmanager
+    def span(self, category:str, name:str, **args):
+        """ Records the block inside the with statement.
+            Args:
+                category (str): load, inference, llm or io.
+                name (str): What runs, like the model or the stage.
+                args: Anything to keep with the span, like the prompt count.
+            Yields:
+                dict: The args of the span, add the tokens, frames or bytes produced to it.
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        with self.lock:
+            # The CUDA peak can only be reset for everything, so it's measured from the start of the outermost span.
+            if not self.open_spans:
+                cuda_memory(reset=True)
+            self.open_spans += 1
+
+        start = time.perf_counter()
+        error = None
+        try:
+            yield args
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            end = time.perf_counter()
+            span = {"category": category,
+                    "name": name,
+                    "start": start - self.origin,
+                    "seconds": end - start,
+                    "thread": threading.get_ident(),
+                    "thread_name": threading.current_thread().name,
+                    "args": args,
+                    **cuda_memory(),
+                    **cpu_memory()}
+            if error:
+                span["error"] = error
+
+            with self.lock:
+                self.open_spans -= 1
+                self.spans.append(span)
+
+    def trace(self, category:str, name:str=None):
+        """ A decorator recording every call of a function as a span.
+            Args:
+                category (str): load, inference, llm or io.
+                name (str): The name of the spans, defaults to the name of the function.
+        """
+        def decorator(function):
+            def traced(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(category, name or function.__qualname__):
+                    return function(*args, **kwargs)
+            traced.__name__ = function.__name__
+            traced.__qualname__ = function.__qualname__
+            traced.__doc__ = function.__doc__
+            return traced
+        return decorator
+
+    def summary(self) -> dict:
+        """ Adds up the spans of every category, to see if a run is bound by the LLM, the disk or the model loads.
+            Nested spans of the same category are counted once.
+            Returns:
+                dict: The category mapped to its span count, total seconds and what the spans produced.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        summary = {category: {"count": 0, "seconds": 0} for category in self.CATEGORIES}
+        groups = {}
+        for span in spans:
+            summary.setdefault(span["category"], {"count": 0, "seconds": 0})
+            groups.setdefault((span["category"], span["thread"]), []).append(span)
+
+        for (category, _), group in groups.items():
+            totals = summary[category]
+            # Sorted by start and the longest first, a span is inside an earlier one when it ends before the latest end so far.
+            latest_end = None
+            for span in sorted(group, key=lambda span: (span["start"], -span["seconds"])):
+                end = span["start"] + span["seconds"]
+                if latest_end is not None and end <= latest_end:
+                    continue
+                latest_end = end
+                totals["count"] += 1
+                totals["seconds"] += span["seconds"]
+                for key, value in span["args"].items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        totals[key] = totals.get(key, 0) + value
+
+        return summary
+
+    def export_chrome_trace(self, path:str) -> str:
+        """ Writes the spans in the Chrome trace event format.
+            Args:
+                path (str): The json file.
+            Returns:
+                str: The path.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        events = []
+        for span in spans:
+            memory = {key: value for key, value in span.items() if key.startswith(("cuda", "rss"))}
+            events.append({"name": span["name"],
+                           "cat": span["category"],
+                           "ph": "X",
+                           # Microseconds
+                           "ts": span["start"] * 1e6,
+                           "dur": span["seconds"] * 1e6,
+                           "pid": os.getpid(),
+                           "tid": span["thread"],
+                           "args": {**span["args"], **memory, **({"error": span["error"]} if "error" in span else {})}})
+        for thread, name in {span["thread"]: span["thread_name"] for span in spans}.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread, "args": {"name": name}})
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w', encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+        return path
+
+    def export_jsonl(self, path:str) -> str:
+        """ Writes one span per line.
+            Args:
+                path (str): The jsonl file.
+            Returns:
+                str: The path.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w', encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span, default=str) + "\n")
+        return path
+
+    def export(self, path:str) -> str:
+        """ Writes the spans as JSON lines if the path ends with .jsonl, else as a Chrome trace.
+        """
+        if path.endswith(".jsonl"):
+            return self.export_jsonl(path)
+        return self.export_chrome_trace(path)
+
+
+# Shared by the whole package. Setting GEN_AI_TELEMETRY to a file path records every run and exports it on exit.
+telemetry = TELEMETRY_RECORDER()
+if os.environ.get("GEN_AI_TELEMETRY"):
+    telemetry.enable(os.environ["GEN_AI_TELEMETRY"])
@@ -1,50 +1,278 @@
+import numpy as np
 import torch
-from diffusers import AutoencoderKLWan, WanPipeline, LTXPipeline
+from PIL import Image
+from diffusers import AutoencoderKLWan, WanPipeline, LTXPipeline, LTXImageToVideoPipeline
+
+from .gen_ai_utilities import optimize_model, start_item, work_item, video_stream_saver, get_device, make_generator
+from .background_saver import save_output, reuse_output
+from .telemetry import telemetry
+from .embedding_cache import encoded_prompts
+from .weight_cache import weight_cache
+from .step_cache import step_caching
+
+
+def round_frames(frames:int, multiple:int) -> int:
+    """ Rounds a number of frames up to one the video VAE accepts, a multiple of its temporal compression plus one.
+    """
+    return max(0, -(-(frames - 1) // multiple)) * multiple + 1
+
+
+def video_params(params:dict, fps:int) -> dict:
+    """ Adds the fps to the params of a video, unless it's the 12 fps the videos were always saved at (so their names don't change).
+    """
+    return params if fps == 12 else {**(params or {}), "fps": fps}
+
+
+def frame_to_uint8(frame) -> np.ndarray:
+    """ Converts a frame of a pipeline output, a PIL image or an array of floats from 0 to 1, to a uint8 array.
+    """
+    frame = np.asarray(frame)
+    if frame.dtype != np.uint8:
+        frame = (frame * 255).round().clip(0, 255).astype(np.uint8)
+    return frame
 
-from .gen_ai_utilities import file_saver, optimize_model
 
 class WAN_VIDEO:
     """ A class to generate videos.
     """
-    def __init__(self, output_folder:str):
+    def __init__(self, output_folder:str, registry=None, saver=None, device:str=None):
         """ Initialize the class and apply optimizations.
+            Args:
+                output_folder (str): The location to store the generated videos.
+                registry (MODEL_REGISTRY): Loads the model on first use and shares it, else it's loaded right away.
+                saver (BACKGROUND_SAVER): Saves the files in the background, the generate functions then return futures of the paths.
+                device (str): The device the model runs on, like cuda:1 or cpu, see get_device.
         """
         self.output_folder = output_folder
+        self.device = get_device(device)
+        self.registry = registry
+        self.saver = saver
+        # The hits of the step cache in the last video generated with it.
+        self.step_cache_stats = None
+        if not registry:
+            self._pipe = self.load_pipe()
+
+    @property
+    def pipe(self):
+        """ The WanPipeline, from the registry if there is one.
+        """
+        if self.registry:
+            return self.registry.get("wan2.1_t2v", self.load_pipe)
+        return self._pipe
+
+    @telemetry.trace("load", "wan2.1_t2v")
+    def load_pipe(self):
+        """ Loads the WanPipeline with its text encoder and transformer quantized.
+            They are quantized once and stored, later loads map the int8 weights from the disk.
+        """
+        from transformers import UMT5EncoderModel
+        from diffusers import WanTransformer3DModel
+
         model_id = "Wan-AI/Wan2.1-T2V-1.3B-Diffusers"
 
         vae = AutoencoderKLWan.from_pretrained(model_id, subfolder="vae", torch_dtype=torch.bfloat16)
-        self.pipe = WanPipeline.from_pretrained(model_id, vae=vae, torch_dtype=torch.bfloat16)
+        text_encoder = weight_cache.load(UMT5EncoderModel, model_id, "text_encoder", torch.bfloat16, "int8_weight_only")
+        transformer = weight_cache.load(WanTransformer3DModel, model_id, "transformer", torch.bfloat16, "int8_weight_only")
+        pipe = WanPipeline.from_pretrained(model_id, vae=vae, text_encoder=text_encoder, transformer=transformer,
+                                           torch_dtype=torch.bfloat16)
 
-        optimize_model(self.pipe, quantize=True)
+        # Already quantized, like optimize_model(pipe, quantize=True) would.
+        optimize_model(pipe, device=self.device)
+        return pipe
     
-    def generate_video(self, prompt:str, seed=None):
+    def generate_video(self, prompt:str, seed=None, index:int=None, fps:int=12, step_cache:float=None):
         """ Passes the prompt to the model to generate the video.
+            If index (the index of the prompt in the project) is passed, the video is recorded in the manifest and reused on a rerun.
+            The video is saved at fps frames per second.
+            With a step_cache threshold (like 0.05) the transformer skips the steps that would change little, see STEP_CACHE,
+            the hits of the last video are in step_cache_stats.
+        """
+        params = video_params(None, fps)
+        if step_cache is not None:
+            params = {**(params or {}), "step_cache": step_cache}
+        done = start_item(self.output_folder, "video", index, prompt, seed, params)
+        if done:
+            return reuse_output(self.saver, done)
+
+        pipe = self.pipe
+        # WAN runs the transformer for the prompt and the negative prompt one after the other, they are cached apart.
+        with telemetry.span("inference", "wan2.1_t2v") as span, step_caching(pipe.transformer, step_cache, slots=2) as cache:
+            output = pipe(**encoded_prompts(pipe, "wan2.1_t2v", "wan", [prompt]),
+                          **({"generator":make_generator(self.device, seed)} if seed is not None else {})).frames[0]
+            span["frames"] = len(output)
+            if cache:
+                self.step_cache_stats = span["step_cache"] = cache.stats()
+        return save_output(self.saver, self.output_folder, video=output, fps=fps, item=work_item(index, prompt, seed, params))
+
+    def generate_long_video(self, prompt:str, num_frames:int=321, segment_frames:int=81, fps:int=16, seed:int=None, index:int=None):
+        """ Generates a video longer than the model can in one go, in segments that are encoded as soon as they are decoded.
+            Only one segment is in memory at a time, so the memory stays the same for any length.
+            WanPipeline can't be conditioned on a frame, every segment is generated from the prompt on its own (with the next seed),
+            so the cuts between the segments show.
+            Args:
+                prompt (str): The video prompt.
+                (Optional)
+                num_frames (int): The frames of the whole video.
+                segment_frames (int): The frames generated at once, 81 is what WAN 2.1 is trained on.
+                fps (int): The frames per second of the video, WAN 2.1 generates 16.
+                seed (int): The manual seed of the first segment for consistent results.
+                index (int): The index of the prompt in the project, the video is recorded in the manifest and reused on a rerun.
+            Returns:
+                str: The path of the video (or its future with a saver).
         """
-        output = self.pipe(prompt=prompt, 
-                           **({"generator":torch.Generator("cuda").manual_seed(seed)} if seed else {})).frames[0]
-        return file_saver(self.output_folder, video=output)
+        params = {"num_frames": num_frames, "segment_frames": segment_frames, "fps": fps}
+        done = start_item(self.output_folder, "video", index, prompt, seed, params)
+        if done:
+            return reuse_output(self.saver, done)
+
+        pipe = self.pipe
+        embeds = encoded_prompts(pipe, "wan2.1_t2v", "wan", [prompt])
+
+        def segments():
+            written = 0
+            segment = 0
+            while written < num_frames:
+                new = min(num_frames - written, segment_frames)
+                with telemetry.span("inference", "wan2.1_t2v", segment=segment) as span:
+                    video = pipe(**embeds,
+                                 num_frames=round_frames(new, 4),
+                                 **({"generator":make_generator(self.device, seed + segment)} if seed is not None else {})).frames[0][:new]
+                    span["frames"] = len(video)
+                if not len(video):
+                    break
+                yield [frame_to_uint8(frame) for frame in video]
+                written += len(video)
+                segment += 1
+
+        return reuse_output(self.saver, video_stream_saver(self.output_folder, segments(), fps, item=work_item(index, prompt, seed, params)))
 
 
 class LTX_VIDEO:
     """ Generates video using LTX-Video.
     """
-    def __init__(self, output_folder:str):
+    def __init__(self, output_folder:str, registry=None, saver=None, device:str=None):
         """ Init the model.
+            Args:
+                output_folder (str): The location to store the generated videos.
+                registry (MODEL_REGISTRY): Loads the model on first use and shares it, else it's loaded right away.
+                saver (BACKGROUND_SAVER): Saves the files in the background, the generate functions then return futures of the paths.
+                device (str): The device the model runs on, like cuda:1 or cpu, see get_device.
         """
         self.output_folder = output_folder
-        self.pipe = LTXPipeline.from_pretrained("Lightricks/LTX-Video", torch_dtype=torch.float16)
+        self.device = get_device(device)
+        self.registry = registry
+        self.saver = saver
+        # The image to video pipeline and the pipe it was made from, see image_to_video.
+        self._image_to_video = None
+        # The hits of the step cache in the last video generated with it.
+        self.step_cache_stats = None
+        if not registry:
+            self._pipe = self.load_pipe()
+
+    @property
+    def pipe(self):
+        """ The LTXPipeline, from the registry if there is one.
+        """
+        if self.registry:
+            return self.registry.get("ltx_video", self.load_pipe)
+        return self._pipe
+
+    @telemetry.trace("load", "ltx_video")
+    def load_pipe(self):
+        """ Loads the LTXPipeline.
+        """
+        pipe = LTXPipeline.from_pretrained("Lightricks/LTX-Video", torch_dtype=torch.float16)
         
-        optimize_model(self.pipe)
+        optimize_model(pipe, device=self.device)
+        return pipe
     
-    def generate_video(self, prompt: str, num_frames: int =241, seed: int=None):
+    def image_to_video(self, pipe):
+        """ The LTXImageToVideoPipeline made from the components of the text to video pipe, it takes no more memory.
+            Both run the text encoder, transformer and vae in the same order, so the CPU offload hooks of the pipe work for it too.
+        """
+        if self._image_to_video is None or self._image_to_video[0] is not pipe:
+            self._image_to_video = (pipe, LTXImageToVideoPipeline.from_pipe(pipe))
+        return self._image_to_video[1]
+
+    def generate_video(self, prompt: str, num_frames: int =241, seed: int=None, index: int=None, fps: int=12, step_cache: float=None):
         """ Generate videos from text prompt.
+            If index (the index of the prompt in the project) is passed, the video is recorded in the manifest and reused on a rerun.
+            The video is saved at fps frames per second.
+            With a step_cache threshold (like 0.05) the transformer skips the steps that would change little, see STEP_CACHE,
+            the hits of the last video are in step_cache_stats.
         """
-        video = self.pipe(prompt=prompt, 
-                        num_frames=num_frames,
-                        **({"generator":torch.Generator("cuda").manual_seed(seed)} if seed else {})
-                        ).frames[0]
+        params = video_params({"num_frames": num_frames}, fps)
+        if step_cache is not None:
+            params = {**params, "step_cache": step_cache}
+        done = start_item(self.output_folder, "video", index, prompt, seed, params)
+        if done:
+            return reuse_output(self.saver, done)
+
+        pipe = self.pipe
+        with telemetry.span("inference", "ltx_video") as span, step_caching(pipe.transformer, step_cache) as cache:
+            video = pipe(**encoded_prompts(pipe, "ltx_video", "ltx", [prompt]), 
+                         num_frames=num_frames,
+                         **({"generator":make_generator(self.device, seed)} if seed is not None else {})
+                         ).frames[0]
+            span["frames"] = len(video)
+            if cache:
+                self.step_cache_stats = span["step_cache"] = cache.stats()
+
+        return save_output(self.saver, self.output_folder, video=video, fps=fps, item=work_item(index, prompt, seed, params))
+
+    def generate_long_video(self, prompt: str, num_frames: int = 721, segment_frames: int = 121, fps: int = 24, seed: int = None,
+                            index: int = None):
+        """ Generates a video longer than the model can in one go, in segments that are encoded as soon as they are decoded.
+            Every segment after the first is generated by LTXImageToVideoPipeline from the last frame of the one before,
+            which it starts with and isn't written again. Only one segment is in memory at a time, so the memory stays the same for any length.
+            Args:
+                prompt (str): The video prompt.
+                (Optional)
+                num_frames (int): The frames of the whole video.
+                segment_frames (int): The frames generated at once, with the frame shared with the segment before.
+                fps (int): The frames per second of the video, the model is told the frame rate as well.
+                seed (int): The manual seed of the first segment for consistent results.
+                index (int): The index of the prompt in the project, the video is recorded in the manifest and reused on a rerun.
+            Returns:
+                str: The path of the video (or its future with a saver).
+        """
+        params = {"num_frames": num_frames, "segment_frames": segment_frames, "fps": fps}
+        done = start_item(self.output_folder, "video", index, prompt, seed, params)
+        if done:
+            return reuse_output(self.saver, done)
+
+        pipe = self.pipe
+        embeds = encoded_prompts(pipe, "ltx_video", "ltx", [prompt])
+
+        def segments():
+            written = 0
+            segment = 0
+            last = None
+            while written < num_frames:
+                # The first frame of a segment after the first one is the last frame of the segment before.
+                shared = 0 if last is None else 1
+                new = min(num_frames - written, segment_frames - shared)
+                arguments = {**embeds,
+                             "num_frames": round_frames(new + shared, 8),
+                             "frame_rate": fps,
+                             **({"generator":make_generator(self.device, seed + segment)} if seed is not None else {})}
+
+                with telemetry.span("inference", "ltx_video", segment=segment) as span:
+                    if last is None:
+                        video = pipe(**arguments).frames[0]
+                    else:
+                        video = self.image_to_video(pipe)(image=Image.fromarray(last), **arguments).frames[0]
+                    video = [frame_to_uint8(frame) for frame in video[shared:shared + new]]
+                    span["frames"] = len(video)
+                if not video:
+                    break
+
+                yield video
+                last = video[-1]
+                written += len(video)
+                segment += 1
 
-        return file_saver(self.output_folder, video=video)
+        return reuse_output(self.saver, video_stream_saver(self.output_folder, segments(), fps, item=work_item(index, prompt, seed, params)))
 
 if __name__=="__main__":
     from diffusers import MochiPipeline
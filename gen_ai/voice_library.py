@@ -0,0 +1,172 @@
+import os
+import json
+import threading
+
+import numpy as np
+import torch
+
+from .manifest import file_hash
+
+
+# The recordings that can be used as a voice.
+AUDIO_EXTENSIONS = [".wav", ".flac", ".mp3"]
+
+
+class VOICE_LIBRARY:
+    """ The voices of XTTS-v2, one per recording in the voices folder, named after the file (models/voices/liam.wav is liam).
+        The conditioning latents and the speaker embedding of every voice are stored in a .npz file in the index folder,
+        with a manifest.json recording the recording they came from. Loading a voice reads its .npz, the recording isn't decoded again.
+    """
+    def __init__(self, voices_folder:str="models/voices", index_folder:str=None, gpt_cond_len:int=3):
+        """ Initialize the library and read its manifest.
+            Args:
+                voices_folder (str): The folder with the recordings.
+                index_folder (str): Where the .npz files and the manifest are stored, defaults to .index inside the voices folder.
+                gpt_cond_len (int): The seconds of the recordings used to condition the GPT, changing it computes the voices again.
+        """
+        self.voices_folder = voices_folder
+        self.index_folder = index_folder or os.path.join(voices_folder, ".index")
+        self.manifest_path = os.path.join(self.index_folder, "manifest.json")
+        self.gpt_cond_len = gpt_cond_len
+
+        self.lock = threading.Lock()
+        # The voices loaded so far.
+        self.loaded = {}
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding="utf-8") as f:
+                self.voices = json.load(f)["voices"]
+        else:
+            self.voices = {}
+
+    def scan(self) -> dict:
+        """ Finds the recordings in the voices folder. A wav is picked over a flac or mp3 with the same name.
+            Returns:
+                dict: The voice name mapped to its recording.
+        """
+        recordings = {}
+        for file in sorted(os.listdir(self.voices_folder)):
+            name, extension = os.path.splitext(file)
+            if extension.lower() not in AUDIO_EXTENSIONS:
+                continue
+            current = recordings.get(name)
+            if not current or AUDIO_EXTENSIONS.index(extension.lower()) < AUDIO_EXTENSIONS.index(os.path.splitext(current)[1].lower()):
+                recordings[name] = os.path.join(self.voices_folder, file)
+        return recordings
+
+    def names(self) -> list:
+        """ Gets the names of the voices that can be used.
+        """
+        return list(self.scan())
+
+    def save_manifest(self):
+        """ Writes the manifest to a temporary file and renames it, so it's never half written.
+        """
+        os.makedirs(self.index_folder, exist_ok=True)
+        with open(f"{self.manifest_path}.tmp", 'w', encoding="utf-8") as f:
+            json.dump({"voices": self.voices}, f, indent=4)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def is_current(self, name:str, recording:str) -> bool:
+        """ Checks if the stored voice was computed from the recording as it is now, with the same settings.
+        """
+        entry = self.voices.get(name)
+        if not entry or entry["recording"] != recording or entry["gpt_cond_len"] != self.gpt_cond_len:
+            return False
+        if not os.path.exists(os.path.join(self.index_folder, entry["file"])):
+            return False
+
+        stat = os.stat(recording)
+        if (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime):
+            return True
+        # The file was touched, it's only stale if its content changed.
+        if file_hash(recording) != entry["hash"]:
+            return False
+        entry["mtime"] = stat.st_mtime
+        self.save_manifest()
+        return True
+
+    def add(self, name:str, recording:str, compute):
+        """ Computes a voice and stores it in the index.
+            Args:
+                name (str): The voice name.
+                recording (str): The recording of the voice.
+                compute (function): Takes the recording and gpt_cond_len, returns the GPT conditioning latents and the speaker embedding.
+            Returns:
+                tuple: The GPT conditioning latents and the speaker embedding.
+        """
+        gpt_cond_latent, speaker_embedding = compute(recording, self.gpt_cond_len)
+
+        os.makedirs(self.index_folder, exist_ok=True)
+        path = os.path.join(self.index_folder, f"{name}.npz")
+        # np.savez adds .npz to a name without it.
+        with open(f"{path}.tmp", 'wb') as f:
+            np.savez(f, gpt_cond_latent=gpt_cond_latent.float().cpu().numpy(),
+                     speaker_embedding=speaker_embedding.float().cpu().numpy())
+        os.replace(f"{path}.tmp", path)
+
+        stat = os.stat(recording)
+        self.voices[name] = {"recording": recording,
+                             "hash": file_hash(recording),
+                             "size": stat.st_size,
+                             "mtime": stat.st_mtime,
+                             "gpt_cond_len": self.gpt_cond_len,
+                             "file": f"{name}.npz"}
+        self.save_manifest()
+        return gpt_cond_latent, speaker_embedding
+
+    def get(self, name:str, compute) -> tuple:
+        """ Gets a voice, it's computed and stored the first time it's used or when its recording changed.
+            Args:
+                name (str): The voice name.
+                compute (function): Takes the recording and gpt_cond_len, returns the GPT conditioning latents and the speaker embedding.
+            Returns:
+                tuple: The GPT conditioning latents and the speaker embedding on the CPU.
+        """
+        with self.lock:
+            if name in self.loaded:
+                return self.loaded[name]
+
+            recordings = self.scan()
+            if name not in recordings:
+                raise ValueError(f"Unknown voice {name}, the voices in {self.voices_folder} are: {list(recordings)}")
+
+            if self.is_current(name, recordings[name]):
+                with np.load(os.path.join(self.index_folder, self.voices[name]["file"])) as data:
+                    latents = (torch.from_numpy(data["gpt_cond_latent"]), torch.from_numpy(data["speaker_embedding"]))
+            else:
+                latents = self.add(name, recordings[name], compute)
+
+            self.loaded[name] = latents
+            return latents
+
+    def build(self, compute) -> list:
+        """ Computes every voice that's missing or stale, so the first line of each voice doesn't wait for it.
+            Args:
+                compute (function): Takes the recording and gpt_cond_len, returns the GPT conditioning latents and the speaker embedding.
+            Returns:
+                list: The names of the voices.
+        """
+        names = self.names()
+        for name in names:
+            self.get(name, compute)
+        return names
+
+
+# One library per voices folder, shared by every XTTSv2_SPEECH object.
+libraries = {}
+libraries_lock = threading.Lock()
+
+
+def get_voice_library(voices_folder:str="models/voices") -> VOICE_LIBRARY:
+    """ Gets the library of a voices folder.
+        Args:
+            voices_folder (str): The folder with the recordings.
+        Returns:
+            VOICE_LIBRARY: The library shared by every object using the folder.
+    """
+    key = os.path.abspath(voices_folder)
+    with libraries_lock:
+        if key not in libraries:
+            libraries[key] = VOICE_LIBRARY(voices_folder)
+        return libraries[key]
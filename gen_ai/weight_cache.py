@@ -0,0 +1,238 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+from .telemetry import telemetry
+
+
+def int8_weight_only(model):
+    """ Quantizes the linear layers of a model to int8 weights with torchao, like optimize_model(quantize=True).
+    """
+    from torchao.quantization import quantize_, int8_weight_only
+
+    quantize_(model, int8_weight_only())
+
+
+# The conversions that can be cached, by the name used in the keys.
+QUANTIZATIONS = {"int8_weight_only": int8_weight_only}
+
+
+def model_revision(model_id:str, subfolder:str=None) -> str:
+    """ Gets the version of the weights of a model on this machine, the cached weights are made again when it changes.
+        Args:
+            model_id (str): A HuggingFace repo (its downloaded snapshot is used) or a local folder.
+            subfolder (str): The folder of the component.
+        Returns:
+            str: The commit of the snapshot, or the last change of a local folder, None if the model isn't on this machine yet.
+    """
+    if os.path.isdir(model_id):
+        folder = os.path.join(model_id, subfolder or "")
+        return str(max(entry.stat().st_mtime for entry in os.scandir(folder)))
+    try:
+        from huggingface_hub import snapshot_download
+        return os.path.basename(snapshot_download(model_id, local_files_only=True))
+    except (OSError, ValueError):
+        return None
+
+
+def empty_model(cls, model_id:str, subfolder:str):
+    """ Creates a component from its config without allocating its weights, they are assigned from the cache.
+        Args:
+            cls: The diffusers or transformers model class.
+            model_id (str): The model.
+            subfolder (str): The folder of the component.
+        Returns:
+            The model with its parameters on the meta device.
+    """
+    from accelerate import init_empty_weights
+
+    with init_empty_weights():
+        # Diffusers models read their config with load_config, transformers models have a config class.
+        if hasattr(cls, "load_config"):
+            return cls.from_config(cls.load_config(model_id, subfolder=subfolder))
+        return cls._from_config(cls.config_class.from_pretrained(model_id, subfolder=subfolder))
+
+
+class WEIGHT_CACHE:
+    """ Stores the weights of a model component after its dtype conversion and quantization, so the next load reads
+        them as they are instead of loading the full precision weights and converting them again.
+        Plain tensors are stored as safetensors. The quantized tensors of torchao aren't plain tensors, they are stored
+        with torch.save, the way torchao serializes them. Both are memory mapped on load.
+        The key has the model, its revision, the dtype, the quantization and the versions of torch and torchao. The file
+        name has the dtype and the quantization too, so the variants of a component are kept side by side and only the
+        file of the same variant with an older key is removed when the new one is written.
+    """
+    def __init__(self, cache_folder:str="models/.cache/weights"):
+        """ Initialize the cache folder.
+            Args:
+                cache_folder (str): The folder of the weights, one file per component.
+        """
+        self.cache_folder = cache_folder
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model_id:str, subfolder:str, dtype, quantization:str=None) -> str:
+        """ Creates the key of a component.
+            Returns:
+                str: The sha256 of the settings, None if the revision of the model isn't known.
+        """
+        import torch
+
+        revision = model_revision(model_id, subfolder)
+        if revision is None:
+            return None
+
+        versions = {"torch": torch.__version__}
+        if quantization:
+            from importlib.metadata import version
+            versions["torchao"] = version("torchao")
+
+        settings = json.dumps({"model_id": model_id, "subfolder": subfolder, "revision": revision, "dtype": str(dtype),
+                               "quantization": quantization, "versions": versions}, sort_keys=True)
+        return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+    def prefix(self, model_id:str, subfolder:str) -> str:
+        """ The start of the file names of a component, the key comes after it.
+        """
+        return f"{model_id.replace('/', '--').replace(os.sep, '--')}--{subfolder}--"
+
+    def variant(self, model_id:str, subfolder:str, dtype, quantization:str=None) -> str:
+        """ The start of the file names of a variant of a component, like its bfloat16 and its int8 weights.
+        """
+        return f"{self.prefix(model_id, subfolder)}{str(dtype).replace('torch.', '')}--{quantization or 'none'}--"
+
+    def path(self, model_id:str, subfolder:str, dtype, key:str, quantization:str=None) -> str:
+        """ The file of a component.
+        """
+        extension = ".pt" if quantization else ".safetensors"
+        variant = self.variant(model_id, subfolder, dtype, quantization)
+        return os.path.join(self.cache_folder, f"{variant}{key[:16]}{extension}")
+
+    def read(self, cls, model_id:str, subfolder:str, path:str, quantization:str=None):
+        """ Creates a component from the stored weights.
+            Returns:
+                The component, None if the file can't be used.
+        """
+        import torch
+
+        try:
+            if quantization:
+                state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+            else:
+                from safetensors.torch import load_file
+                state_dict = load_file(path)
+        except (OSError, RuntimeError, ValueError, pickle.UnpicklingError):
+            return None
+
+        model = empty_model(cls, model_id, subfolder)
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        # safetensors keeps one copy of the tied weights (like the embeddings of T5).
+        if hasattr(model, "tie_weights"):
+            model.tie_weights()
+        if any(parameter.is_meta for parameter in model.parameters()):
+            return None
+        return model.eval()
+
+    def lock(self, model_id:str, subfolder:str):
+        """ A lock on the files of a component shared by the processes, like the workers of run_sharded.
+        """
+        # filelock comes with huggingface_hub.
+        from filelock import FileLock
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        return FileLock(os.path.join(self.cache_folder, f"{self.prefix(model_id, subfolder)}.lock"))
+
+    def write(self, model, model_id:str, subfolder:str, dtype, key:str, quantization:str=None):
+        """ Stores the weights of a component and removes the ones of the same variant stored with an older key.
+            Called with the lock of the component held.
+        """
+        import torch
+
+        path = self.path(model_id, subfolder, dtype, key, quantization)
+        prefix = self.prefix(model_id, subfolder)
+        variant = self.variant(model_id, subfolder, dtype, quantization)
+        # Write to a temporary file of its own first so a crash never leaves half written weights.
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_folder, prefix=prefix, suffix=".tmp")
+        os.close(handle)
+        try:
+            if quantization:
+                torch.save(model.state_dict(), temp_path)
+            else:
+                from safetensors.torch import save_model
+                save_model(model, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        # Nothing else writes while the lock is held, so the temporary files left are from a crash.
+        # The other dtypes and quantizations are kept, the configurations in use don't replace each other.
+        for entry in os.scandir(self.cache_folder):
+            stale = entry.name.startswith(variant) and entry.path != path
+            if stale or (entry.name.startswith(prefix) and entry.name.endswith(".tmp")):
+                os.remove(entry.path)
+
+    def cached(self, cls, model_id:str, subfolder:str, dtype, key:str, quantization:str=None):
+        """ Reads a component if it's stored with the key.
+            Returns:
+                The component, None if it isn't stored or can't be used.
+        """
+        if not key:
+            return None
+        path = self.path(model_id, subfolder, dtype, key, quantization)
+        if not os.path.exists(path):
+            return None
+        with telemetry.span("load", f"{subfolder}_cached", model_id=model_id):
+            return self.read(cls, model_id, subfolder, path, quantization)
+
+    def load(self, cls, model_id:str, subfolder:str, dtype, quantization:str=None):
+        """ Loads a component, from the cache if it was converted before.
+            Args:
+                cls: The diffusers or transformers model class, like WanTransformer3DModel.
+                model_id (str): The model.
+                subfolder (str): The folder of the component, like transformer.
+                dtype (torch.dtype): The dtype of the weights.
+                quantization (str): One of QUANTIZATIONS, None to only convert the dtype.
+            Returns:
+                The component in eval mode.
+        """
+        key = self.key(model_id, subfolder, dtype, quantization)
+        model = self.cached(cls, model_id, subfolder, dtype, key, quantization)
+        if model is not None:
+            self.hits += 1
+            return model
+
+        # Processes that miss together wait for the first one, then read what it stored instead of converting it again.
+        with self.lock(model_id, subfolder):
+            # The first load downloads the model, its revision is known after it.
+            key = key or self.key(model_id, subfolder, dtype, quantization)
+            model = self.cached(cls, model_id, subfolder, dtype, key, quantization)
+            if model is not None:
+                self.hits += 1
+                return model
+            self.misses += 1
+
+            model = cls.from_pretrained(model_id, subfolder=subfolder, torch_dtype=dtype)
+            model.to(dtype)
+            if quantization:
+                QUANTIZATIONS[quantization](model)
+
+            key = key or self.key(model_id, subfolder, dtype, quantization)
+            if key:
+                self.write(model, model_id, subfolder, dtype, key, quantization)
+        return model
+
+    def stats(self) -> dict:
+        """ Gets the hit and miss counters.
+            Returns:
+                dict: The hits, misses and the hit rate.
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+# Shared by every generator.
+weight_cache = WEIGHT_CACHE()
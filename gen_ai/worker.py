@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import sqlite3
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .gen_ai_utilities import initialize_project
+from .registry import MODEL_REGISTRY
+from .scheduler import SCHEDULER, STAGES, stage_model
+
+
+def default_generators() -> dict:
+    """ The generator classes used for every model, all of them take the output folder and the registry.
+        Returns:
+            dict: The model name mapped to a function that creates the generator.
+    """
+    from .image import SANA_IMAGE, SDXL_IMAGE
+    from .music import GEN_MUSIC
+    from .script import OLLAMA_SCRIPT
+    from .speech import XTTSv2_SPEECH
+    from .video import WAN_VIDEO, LTX_VIDEO
+
+    return {"ollama": lambda output_folder, registry: OLLAMA_SCRIPT(output_folder),
+            "musicgen": lambda output_folder, registry: GEN_MUSIC(output_folder, registry=registry),
+            "xtts": lambda output_folder, registry: XTTSv2_SPEECH(output_folder, registry=registry),
+            "sdxl": lambda output_folder, registry: SDXL_IMAGE(output_folder, registry=registry),
+            "sana": lambda output_folder, registry: SANA_IMAGE(output_folder, registry=registry),
+            "ltx": lambda output_folder, registry: LTX_VIDEO(output_folder, registry=registry),
+            "wan": lambda output_folder, registry: WAN_VIDEO(output_folder, registry=registry)}
+
+
+class JOB_QUEUE:
+    """ A persistent job queue stored in sqlite, the jobs survive a restart of the worker.
+    """
+    def __init__(self, db_path:str="outputs/.worker/jobs.db"):
+        """ Initialize the database.
+            Args:
+                db_path (str): The sqlite file.
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                              id TEXT PRIMARY KEY, job TEXT, status TEXT, result TEXT, error TEXT,
+                              created REAL, updated REAL)""")
+            # Jobs that were running when the worker stopped are started again.
+            db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    def connect(self):
+        """ Opens a connection, every thread uses its own.
+        """
+        return sqlite3.connect(self.db_path)
+
+    def submit(self, idea:str, stages:list=None, **options) -> str:
+        """ Adds a project to the queue.
+            Args:
+                idea (str): The idea of the project.
+                stages (list): The stages to run, None runs all of them.
+                options: image_model (sdxl or sana), video_model (ltx or wan), voice (a voice of the VOICE_LIBRARY) and output_folder.
+            Returns:
+                str: The job id.
+        """
+        stages = STAGES if stages is None else stages
+        if not stages:
+            raise ValueError("No stages to run, pass None to run all of them.")
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages: {unknown}")
+
+        job_id = uuid.uuid4().hex
+        job = {"idea": idea, "stages": [stage for stage in STAGES if stage in stages], **options}
+        with self.lock, self.connect() as db:
+            db.execute("INSERT INTO jobs VALUES (?, ?, 'queued', NULL, NULL, ?, ?)",
+                       (job_id, json.dumps(job), time.time(), time.time()))
+        return job_id
+
+    def update(self, job_id:str, status:str, result:dict=None, error:str=None, output_folder:str=None):
+        """ Updates the status of a job.
+            Args:
+                job_id (str): The job id.
+                status (str): queued, running, done or failed.
+                result (dict): The generated files.
+                error (str): Why the job failed.
+                output_folder (str): The folder of the project, stored with the job so it's resumed there if it's run again.
+        """
+        with self.lock, self.connect() as db:
+            if output_folder:
+                job = json.loads(db.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+                job["output_folder"] = output_folder
+                db.execute("UPDATE jobs SET job = ? WHERE id = ?", (json.dumps(job), job_id))
+            db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?",
+                       (status, json.dumps(result) if result else None, error, time.time(), job_id))
+
+    def get(self, job_id:str) -> dict:
+        """ Gets a job with its status and result.
+            Args:
+                job_id (str): The job id.
+            Returns:
+                dict: The job, None if the id doesn't exist.
+        """
+        with self.connect() as db:
+            row = db.execute("SELECT id, job, status, result, error, created, updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.to_dict(row) if row else None
+
+    def list(self, status:str=None) -> list:
+        """ Gets all the jobs in the order they were submitted.
+            Args:
+                status (str): Only the jobs with this status.
+            Returns:
+                list: The jobs.
+        """
+        query = "SELECT id, job, status, result, error, created, updated FROM jobs"
+        with self.connect() as db:
+            if status:
+                rows = db.execute(query + " WHERE status = ? ORDER BY created", (status,)).fetchall()
+            else:
+                rows = db.execute(query + " ORDER BY created").fetchall()
+        return [self.to_dict(row) for row in rows]
+
+    @staticmethod
+    def to_dict(row) -> dict:
+        """ Converts a row of the jobs table.
+        """
+        job_id, job, status, result, error, created, updated = row
+        return {"id": job_id, **json.loads(job), "status": status, "result": json.loads(result) if result else None,
+                "error": error, "created": created, "updated": updated}
+
+
+class GEN_WORKER:
+    """ A long running worker that keeps the models loaded and runs the queued projects.
+        All the queued jobs are taken together and ordered by the SCHEDULER, so every model is loaded once for all of them.
+    """
+    def __init__(self, queue:JOB_QUEUE, registry:MODEL_REGISTRY=None, generators:dict=None):
+        """ Initialize the worker.
+            Args:
+                queue (JOB_QUEUE): The queue to take the jobs from.
+                registry (MODEL_REGISTRY): Keeps the models loaded between jobs.
+                generators (dict): The model name mapped to a function creating its generator, defaults to default_generators().
+                    The functions take the output folder and the registry.
+        """
+        self.queue = queue
+        self.registry = registry or MODEL_REGISTRY()
+        self.generators = generators or default_generators()
+
+        # The load report of the last run.
+        self.schedule_report = None
+
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+
+    def run_stage(self, stage:str, job:dict, files:dict):
+        """ Runs a stage of a job.
+            Args:
+                stage (str): One of STAGES.
+                job (dict): The job.
+                files (dict): The files generated by the job so far, the result of this stage is added to it.
+            Returns:
+                The generator that ran the stage.
+        """
+        generator = self.generators[stage_model(job, stage)](job["output_folder"], self.registry)
+
+        if stage == "script":
+            try:
+                files["script"] = generator.generate_script(job["idea"])
+                files["details"] = dict(generator.script_detailer())
+            finally:
+                # A client is made for every job, its exit hook would keep all of them for the life of the worker.
+                # run_once unloads the LLM after the script stages.
+                if hasattr(generator, "model_unload"):
+                    atexit.unregister(generator.model_unload)
+            return generator
+
+        source = {"music": "music", "speech": "dialogue", "image": "image", "video": "video"}[stage]
+        # Without the script stage, the details of an earlier run in the same output folder are used.
+        details = files.get("details", {}).get(source, f"{job['output_folder']}/scripts/{source}.txt")
+        with open(details, 'r', encoding="utf-8") as f:
+            lines = [line.rstrip("\n") for line in f.readlines()]
+
+        match(stage):
+            # The indexes record every item in the project's manifest, so a job that's run again only generates what's missing.
+            case "music": files["music"] = generator.generate_music_batch(lines, indexes=list(range(len(lines))))
+            case "speech": files["speech"] = generator.generate_speech_deduped(lines, indexes=list(range(len(lines))), voice=job.get("voice"))
+            case "image": files["image"] = generator.generate_images(lines, indexes=list(range(len(lines))))
+            case "video": files["video"] = [generator.generate_video(line, index=index) for index, line in enumerate(lines)]
+
+        return generator
+
+    def run_once(self) -> int:
+        """ Runs all the queued jobs.
+            Returns:
+                int: The number of jobs that were run.
+        """
+        jobs = self.queue.list("queued")
+        if not jobs:
+            return 0
+
+        files = {}
+        for job in jobs:
+            job["output_folder"] = initialize_project(job["idea"], job.get("output_folder"))
+            files[job["id"]] = {"output_folder": job["output_folder"]}
+            # A job started again after a crash resumes in the same folder, its manifest skips what's done.
+            self.queue.update(job["id"], "running", output_folder=job["output_folder"])
+
+        scheduler = SCHEDULER()
+        for job in jobs:
+            scheduler.add_project(job)
+        jobs_by_id = {job["id"]: job for job in jobs}
+
+        failed = {}
+        for model, items in scheduler.groups():
+            loads, load_seconds = self.registry.loads, self.registry.load_seconds
+
+            generator = None
+            for item in items:
+                job = jobs_by_id[item["job"]]
+                if job["id"] in failed:
+                    continue
+                try:
+                    generator = self.run_stage(item["stage"], job, files[job["id"]])
+                except Exception as e:
+                    failed[job["id"]] = f"{item['stage']}: {e!r}"
+
+            # Ollama keeps the LLM in VRAM, free it before the media models are used.
+            if hasattr(generator, "model_unload"):
+                generator.model_unload()
+            else:
+                scheduler.record(model, self.registry.loads - loads, self.registry.load_seconds - load_seconds)
+
+        self.schedule_report = scheduler.report()
+
+        for job in jobs:
+            if job["id"] in failed:
+                self.queue.update(job["id"], "failed", files[job["id"]], failed[job["id"]])
+            else:
+                self.queue.update(job["id"], "done", files[job["id"]])
+
+        return len(jobs)
+
+    def serve_forever(self, poll_interval:float=5):
+        """ Runs the jobs as they are queued till stop is called.
+            Args:
+                poll_interval (float): Seconds to wait for new jobs before the queue is checked again.
+        """
+        while not self.stopped.is_set():
+            if not self.run_once():
+                self.wake_up.wait(poll_interval)
+                self.wake_up.clear()
+
+    def stop(self):
+        """ Stops serve_forever after the running jobs.
+        """
+        self.stopped.set()
+        self.wake_up.set()
+
+
+def make_handler(worker:GEN_WORKER):
+    """ Creates the HTTP handler of a worker.
+        POST /jobs with {"idea": ..., "stages": [...]} queues a project, GET /jobs/<id> gets its status and result,
+        GET /jobs lists all the jobs and GET /stats shows the loaded models and the load report of the last run.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code:int, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/jobs":
+                self.send_json(200, worker.queue.list())
+            elif self.path.startswith("/jobs/"):
+                job = worker.queue.get(self.path[len("/jobs/"):])
+                if job:
+                    self.send_json(200, job)
+                else:
+                    self.send_json(404, {"error": "Job not found"})
+            elif self.path == "/stats":
+                self.send_json(200, {"registry": worker.registry.stats(), "schedule": worker.schedule_report})
+            else:
+                self.send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                self.send_json(404, {"error": "Not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                job_id = worker.queue.submit(**body)
+            except (ValueError, TypeError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            worker.wake_up.set()
+            self.send_json(201, {"id": job_id})
+
+    return Handler
+
+
+def serve(worker:GEN_WORKER, host:str="127.0.0.1", port:int=8765):
+    """ Runs the worker with a local HTTP server till it's interrupted.
+        Args:
+            worker (GEN_WORKER): The worker running the jobs.
+            host (str): The address to listen on.
+            port (int): The port to listen on.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(worker))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Worker listening on http://{host}:{server.server_address[1]}")
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+        server.shutdown()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Runs the generators as a service that keeps the models loaded between jobs.")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="The port to listen on.")
+    parser.add_argument("--db", default="outputs/.worker/jobs.db", help="The sqlite file of the job queue.")
+    parser.add_argument("--budget-gb", type=float, default=None, help="The memory the loaded models can use, unlimited by default.")
+    args = parser.parse_args()
+
+    serve(GEN_WORKER(JOB_QUEUE(args.db), MODEL_REGISTRY(args.budget_gb)), args.host, args.port)
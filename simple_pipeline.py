@@ -5,10 +5,18 @@ from gen_ai import *
 
 # _____Generate Script_____
 idea = "What if the earth was flat?"
-output_folder = INIT_PROJECT(idea)
+# To resume a run that stopped midway, set this to its folder (like "outputs/WITEWF_05_06_2025_10_00_00").
+# The items recorded as done in its manifest.json are skipped.
+output_folder = None
+output_folder = INIT_PROJECT(idea, output_folder)
 print(output_folder)
 
+# Records the time and memory of every model load, generation, Ollama chat and file write.
+# Open trace.json in chrome://tracing or ui.perfetto.dev to see what the run spent its time on.
+TELEMETRY.enable(f"{output_folder}/trace.json")
+
 # Initialize the script generator
+# The detailer sends as many requests at once as the server's OLLAMA_NUM_PARALLEL, pass num_parallel to override it.
 obj = OLLAMA_SCRIPT(output_folder)
 obj.generate_script(idea)
 generated_files = obj.script_detailer()
@@ -17,29 +25,40 @@ print(generated_files)
 # Release memory for the other models as the Ollama model gets unloaded.
 del obj
 
+# OR
+
+# _____Stream the detailed lines straight into the generators_____
+# Music and speech start while the script is still being detailed, pick the generators that fit in memory together.
+# obj = OLLAMA_SCRIPT(output_folder)
+# obj.generate_script(idea)
+# pipeline = STREAM_PIPELINE({"msc": GEN_MUSIC(output_folder).generate_music,
+#                             "dia": XTTSv2_SPEECH(output_folder).generate_speech})
+# print(pipeline.run(obj.script_detailer_stream()))
+# generated_files = obj.generated_files
+
 # _____Generate the music_____
+# The cues are generated 8 at a time, grouped by length.
 obj = GEN_MUSIC(output_folder)
 with open(generated_files["music"], 'r', encoding="utf-8")as f:
-    for line in f.readlines():
-        line = line.rstrip("\n")
-        print(obj.generate_music(line))
+    lines = [line.rstrip("\n") for line in f.readlines()]
+    print(obj.generate_music_batch(lines, batch_size=8, indexes=list(range(len(lines)))))
 
 
 
 # _____Generate the speech_____
+# A sentence that repeats across the lines is generated once.
 obj = XTTSv2_SPEECH(output_folder)
 with open(generated_files["dialogue"], 'r', encoding="utf-8")as f:
-    for line in f.readlines():
-        line = line.rstrip("\n")
-        print(obj.generate_speech(line))
+    lines = [line.rstrip("\n") for line in f.readlines()]
+    print(obj.generate_speech_deduped(lines, indexes=list(range(len(lines)))))
 
 
 # _____Generate the images using the SDXL model_____
+# The prompts are generated in batches, lower the batch_size if it's too slow on your GPU.
 obj = SDXL_IMAGE(output_folder)
 with open(generated_files["image"], 'r', encoding="utf-8")as f:
-    for line in f.readlines():
-        line = line.rstrip("\n")
-        print(obj.generate_image(line))
+    lines = [line.rstrip("\n") for line in f.readlines()]
+    print(obj.generate_images(lines, batch_size=2, indexes=list(range(len(lines)))))
 
 
 # OR
@@ -47,16 +66,21 @@ with open(generated_files["image"], 'r', encoding="utf-8")as f:
 # _____Generate the images using the Sana model_____
 # obj = SANA_IMAGE(output_folder)
 # with open(generated_files["image"], 'r', encoding="utf-8")as f:
-#     for line in f.readlines():
-#         line = line.rstrip("\n")
-#         print(obj.generate_image(line))
+#     lines = [line.rstrip("\n") for line in f.readlines()]
+#     print(obj.generate_images(lines, batch_size=2, indexes=list(range(len(lines)))))
 
 
 # _____Generate the video using LTX-Video_____
-obj = LTX_VIDEO(output_folder)
+# The videos are encoded in the background while the next one is generated, flush waits for all of them.
+saver = BACKGROUND_SAVER(max_pending=2)
+obj = LTX_VIDEO(output_folder, saver=saver)
+videos = []
 with open(generated_files["video"], 'r', encoding="utf-8")as f:
-    for line in f.readlines():
+    for index, line in enumerate(f.readlines()):
         line = line.rstrip("\n")
-        print(obj.generate_video(line))
-
+        videos.append(obj.generate_video(line, index=index))
+saver.flush()
+print([video.result() for video in videos])
 
+# The seconds spent loading models, generating, waiting for Ollama and writing files.
+print(TELEMETRY.summary())